@@ -0,0 +1,189 @@
+"""Benchmarks of the backend against a real database and the OpenMOLE
+simulator (see `bench.openmole_sim`), set up with the same environment
+variables as the backend. From the backend directory:
+
+    python -m bench.benchmark [--repeat N] [--results bench/results.jsonl]
+
+It measures:
+
+- launch_to_results: from the creation of a run to its posterior sample in
+  the database, the job lasting SIM_JOB_DURATION seconds in the simulator,
+- put_posterior_sample: storing a posterior sample of the size sent by the
+  simulator,
+- the endpoints of `src.app` about that run, each with an empty response
+  cache ("cold") and with the response cached ("warm").
+
+Every benchmark appends a line to the results file with the commit, the time
+and the median of each measure in seconds. The measures are compared with
+those of the previous line."""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import tempfile
+from datetime import datetime
+from os import environ, makedirs
+from os.path import join
+from statistics import median
+from time import perf_counter
+from typing import Awaitable, Callable, Optional
+
+JOB_DIR = "openmole"
+SCRIPT = "Colony_fission_ABC.oms"
+
+
+def git(*args: str, cwd: Optional[str] = None) -> str:
+    return subprocess.run(["git", *args], cwd = cwd, check = True,
+            capture_output = True, text = True).stdout.strip()
+
+
+def make_job_repository() -> tuple[str, str]:
+    """A git repository with a job directory, as the backend packs for
+    OpenMOLE, and the hash of its commit."""
+    path = tempfile.mkdtemp(prefix = "bench_job_repo_")
+    makedirs(join(path, JOB_DIR))
+    with open(join(path, JOB_DIR, SCRIPT), "w") as f:
+        f.write("// Simulated OpenMOLE script.\n")
+    git("init", "--quiet", cwd = path)
+    git("add", ".", cwd = path)
+    git("-c", "user.name=bench", "-c", "user.email=bench@localhost",
+            "commit", "--quiet", "-m", "Benchmark job", cwd = path)
+    return path, git("rev-parse", "HEAD", cwd = path)
+
+
+async def timed(f: Callable[[], Awaitable[object]], repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        await f()
+        durations.append(perf_counter() - start)
+    return median(durations)
+
+
+async def benchmark(repeat: int, commit_hash: str) -> dict[str, float]:
+    # Imported once the environment is set up, see `main`.
+    import httpx
+    from src import db, openmole, response_cache, tasks
+    from src.app import app
+    from src.data import Code, Run, RunState
+
+    await db.init()
+    await openmole.init()
+
+    results = {}
+
+    try:
+        run = Run(
+                code = Code(commit_hash = commit_hash, branch = "bench",
+                    description = "Benchmark run"),
+                timestamp = datetime.now().timestamp(),
+                job_dir = JOB_DIR,
+                output_dir = "output",
+                script = SCRIPT,
+                state = RunState.RUNNING)
+
+        start = perf_counter()
+        run_id = (await db.create_run(run)).id
+        jobs = {j.run.id: j for j in await db.lease_jobs(tasks.WORKER_ID, 1000, 3600)}
+        await tasks.do_run(jobs[run_id])
+        results["launch_to_results"] = perf_counter() - start
+
+        columns = await db.get_posterior_sample_columns(run_id)
+        if columns is None or len(columns) == 0:
+            raise RuntimeError(f"The benchmark run {run_id} has no posterior sample.")
+
+        results["put_posterior_sample"] = await timed(
+                lambda: db.put_posterior_sample(run_id, columns), repeat)
+
+        endpoints = {
+            "all_runs": "/all_runs",
+            "run": f"/run/{run_id}",
+            "logs": f"/logs/{run_id}",
+            "output": f"/output/{run_id}",
+            "posterior_sample": f"/posterior_sample/{run_id}",
+            "posterior_sample_columns": f"/posterior_sample/{run_id}?columns=true",
+            "posterior_summary": f"/posterior_summary/{run_id}",
+        }
+
+        transport = httpx.ASGITransport(app = app)
+        async with httpx.AsyncClient(transport = transport, base_url = "http://bench") as client:
+
+            async def get(url: str) -> None:
+                response = await client.get(url)
+                response.raise_for_status()
+
+            async def get_cold(url: str) -> None:
+                response_cache.cache.clear()
+                response_cache.cache_size = 0
+                await get(url)
+
+            for name, url in endpoints.items():
+                results[f"{name}_cold"] = await timed(lambda: get_cold(url), repeat)
+                results[f"{name}_warm"] = await timed(lambda: get(url), repeat)
+
+    finally:
+        await db.release_leases(tasks.WORKER_ID)
+        await openmole.close()
+        await db.engine.dispose()
+
+    return results
+
+
+def compare(previous: dict, current: dict) -> None:
+    print(f"{'measure':<32} {'previous (s)':>14} {'current (s)':>14} {'ratio':>8}")
+    for name, value in current["results"].items():
+        before = previous["results"].get(name) if previous is not None else None
+        if before is None:
+            print(f"{name:<32} {'':>14} {value:>14.6f} {'':>8}")
+        else:
+            print(f"{name:<32} {before:>14.6f} {value:>14.6f} {value / before:>8.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type = int, default = 20,
+            help = "Number of times each measure is repeated (default 20).")
+    parser.add_argument("--results", default = join("bench", "results.jsonl"),
+            help = "File the results are appended to (default bench/results.jsonl).")
+    args = parser.parse_args()
+
+    repository_path, commit_hash = make_job_repository()
+    environ["JOB_REPO_LOCAL"] = repository_path
+
+    results = asyncio.run(benchmark(args.repeat, commit_hash))
+
+    try:
+        commit = git("rev-parse", "HEAD")
+    except subprocess.CalledProcessError:
+        commit = None
+
+    current = {
+        "commit": commit,
+        "time": datetime.now().isoformat(timespec = "seconds"),
+        "repeat": args.repeat,
+        "simulator": {name: environ[name] for name in
+            ["SIM_LATENCY", "SIM_JOB_DURATION", "SIM_JOB_COUNT", "SIM_POSTERIOR_SIZE"]
+            if name in environ},
+        "results": results,
+    }
+
+    previous = None
+    try:
+        with open(args.results) as f:
+            lines = [line for line in f if line.strip() != ""]
+            if len(lines) > 0:
+                previous = json.loads(lines[-1])
+    except FileNotFoundError:
+        pass
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(current) + "\n")
+
+    if previous is not None:
+        compare(previous, current)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""Load test of the backend API: simulated browsers use it the way the
+frontend does (see `frontend/src/Requests.js` and `frontend/src/App.js`),
+against a real database set up with the same environment variables as the
+backend. From the backend directory:
+
+    python -m bench.loadtest [--browsers N] [--runs M] [--duration S]
+
+The backend is served by uvicorn in this process, without the run queue and
+OpenMOLE. M runs are created and kept running: logs and output are written to
+each of them every --write-interval seconds, as the watcher does. Some runs
+are created finished with a posterior sample (--finished-runs). Each browser:
+
+- loads the first page of the run list, then polls its changes every
+  --list-interval seconds (REACT_APP_RUN_STATE_UPDATE_INTERVAL of the
+  frontend, by default),
+- opens a run chosen at random and follows its event stream, fetching the
+  posterior summary when the stream announces results, then opens another
+  run after --view-duration seconds on average.
+
+The browsers run in --client-processes other processes, so that they do not
+slow down the backend. The report gives, for each endpoint, the number of
+requests and errors, the throughput and the percentiles of the latency (the
+time to the first event for the event stream). It also gives the time from
+the write of logs to their event reaching a browser, and the lag of the event
+loop of the backend: how late a task waking up every --lag-interval seconds
+is.
+
+The runs are created with the branch "loadtest" and are not deleted: use a
+database dedicated to load tests."""
+
+import argparse
+import asyncio
+import json
+import random
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from os import environ
+from time import perf_counter, time
+from typing import Optional
+import numpy as np
+
+BRANCH = "loadtest"
+
+# Points of the posterior sample of each finished run.
+POSTERIOR_SIZE = 500
+
+
+@dataclass
+class Samples:
+    """Measures taken by the browsers, in seconds, by endpoint."""
+    latencies: defaultdict[str, list[float]] = field(default_factory = lambda: defaultdict(list))
+    errors: defaultdict[str, int] = field(default_factory = lambda: defaultdict(int))
+    # From the write of logs to the reception of their event.
+    delivery: list[float] = field(default_factory = list)
+
+    def merge(self, other: "Samples") -> None:
+        for name, latencies in other.latencies.items():
+            self.latencies[name] += latencies
+        for name, count in other.errors.items():
+            self.errors[name] += count
+        self.delivery += other.delivery
+
+
+class Browser:
+
+    def __init__(self, base_url: str, run_ids: list[int], samples: Samples,
+            list_interval: float, view_duration: float, deadline: float) -> None:
+        import httpx
+        self.client = httpx.AsyncClient(base_url = base_url, timeout = None)
+        self.run_ids = run_ids
+        self.samples = samples
+        self.list_interval = list_interval
+        self.view_duration = view_duration
+        self.deadline = deadline
+
+    async def get(self, name: str, url: str, params: Optional[dict] = None) -> Optional[dict]:
+        start = perf_counter()
+        try:
+            response = await self.client.get(url, params = params)
+            response.raise_for_status()
+            json_response = response.json()
+        except Exception:
+            self.samples.errors[name] += 1
+            return None
+        self.samples.latencies[name].append(perf_counter() - start)
+        return json_response
+
+    async def run_list(self) -> None:
+        page = await self.get("all_runs", "/all_runs")
+        changed_since = page["changed_since"] if page is not None else None
+
+        while True:
+            await asyncio.sleep(self.list_interval)
+            if changed_since is None:
+                page = await self.get("all_runs", "/all_runs")
+            else:
+                page = await self.get("all_runs_changes", "/all_runs",
+                        {"changed_since": changed_since})
+            if page is not None:
+                changed_since = page["changed_since"]
+
+    async def run_view(self, run_id: int) -> None:
+        start = perf_counter()
+        # The logs written before are sent at once when the stream opens.
+        opened = time()
+        first = True
+        event: Optional[str] = None
+
+        try:
+            async with self.client.stream("GET", f"/events/{run_id}") as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                        if first:
+                            self.samples.latencies["events"].append(perf_counter() - start)
+                            first = False
+                    elif line.startswith("data: ") and event == "logs":
+                        received = time()
+                        self.samples.delivery += [received - l["timestamp"]
+                                for log_list in json.loads(line[len("data: "):]).values()
+                                for l in log_list if l["timestamp"] >= opened]
+                    elif line.startswith("data: ") and event == "results":
+                        await self.get("posterior_summary", f"/posterior_summary/{run_id}")
+                    elif line.startswith("data: ") and event == "end":
+                        # The frontend closes the stream and keeps showing the run.
+                        await asyncio.sleep(float("inf"))
+        except Exception:
+            self.samples.errors["events"] += 1
+
+    async def run_views(self) -> None:
+        while True:
+            view = asyncio.create_task(self.run_view(random.choice(self.run_ids)))
+            try:
+                await asyncio.sleep(random.expovariate(1 / self.view_duration))
+            finally:
+                view.cancel()
+                await asyncio.gather(view, return_exceptions = True)
+
+    async def run(self) -> None:
+        # Browsers do not all open the page at the same time.
+        await asyncio.sleep(random.uniform(0, self.list_interval))
+
+        tasks = [asyncio.create_task(self.run_list()), asyncio.create_task(self.run_views())]
+        try:
+            await asyncio.sleep(max(self.deadline - time(), 0))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            await self.client.aclose()
+
+
+def run_browsers(base_url: str, run_ids: list[int], browsers: int,
+        list_interval: float, view_duration: float, deadline: float) -> Samples:
+    """Simulate `browsers` browsers until `deadline`. Run in a client
+    process."""
+    samples = Samples()
+
+    async def main() -> None:
+        await asyncio.gather(*(Browser(base_url, run_ids, samples, list_interval,
+            view_duration, deadline).run() for _ in range(browsers)))
+
+    asyncio.run(main())
+    return samples
+
+
+async def measure_lag(interval: float, lags: list[float]) -> None:
+    while True:
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - start - interval)
+
+
+async def write_runs(run_ids: list[int], interval: float) -> None:
+    """Write logs and output to the runs, as the watcher does for running runs."""
+    from src import db
+    from src.data import Logs, Run, RunOutput, RunState, log_now
+
+    offsets = {run_id: await db.get_run_output_length(run_id) for run_id in run_ids}
+    runs: dict[int, Run] = {}
+    for run_id in run_ids:
+        run = await db.get_run(run_id)
+        if run is None:
+            raise RuntimeError(f"Run {run_id} not found.")
+        runs[run_id] = run
+
+    while True:
+        await asyncio.sleep(interval)
+        updates: list[tuple[int, Optional[RunState], Logs, RunOutput]] = []
+        for run_id, run in runs.items():
+            text = f"Load test output at {time()}.\n"
+            logs = Logs.new((run, "openmole",
+                log_now(stdout = f"Load test log of run {run_id}.", stderr = "")))
+            updates.append((run_id, None, logs, RunOutput(text = text, offset = offsets[run_id])))
+            offsets[run_id] += len(text)
+        await db.put_run_updates(updates)
+
+
+async def create_runs(running: int, finished: int) -> tuple[list[int], list[int]]:
+    from src import db
+    from src.data import Code, PosteriorSampleColumns, Run, RunState
+
+    def new_run() -> Run:
+        return Run(
+                code = Code(commit_hash = "0" * 40, branch = BRANCH,
+                    description = "Load test run"),
+                timestamp = time(),
+                job_dir = "openmole",
+                output_dir = "output",
+                script = "loadtest.oms",
+                state = RunState.RUNNING)
+
+    # Runs are always created running.
+    running_ids = [(await db.create_run(new_run())).id for _ in range(running)]
+    finished_ids = [(await db.create_run(new_run())).id for _ in range(finished)]
+
+    rng = np.random.default_rng(0)
+    for run_id in finished_ids:
+        await db.put_posterior_sample(run_id, PosteriorSampleColumns(
+            colony_id = rng.integers(1, 20, POSTERIOR_SIZE),
+            nest_quality_assessment_error = rng.uniform(0, 1, POSTERIOR_SIZE),
+            percentage_foragers = rng.uniform(0, 100, POSTERIOR_SIZE),
+            number_nests = rng.integers(1, 21, POSTERIOR_SIZE),
+            exploring_phase = rng.integers(0, 20001, POSTERIOR_SIZE)))
+        await db.put_run_state(run_id, RunState.FINISHED)
+
+    # Nothing is to be executed for these runs: only their jobs are taken out
+    # of the queue.
+    await db.delete_jobs(running_ids + finished_ids)
+
+    return running_ids, finished_ids
+
+
+def percentiles(values: list[float]) -> tuple[float, ...]:
+    if len(values) == 0:
+        return (float("nan"),) * 4
+    return tuple(float(v) * 1000 for v in np.percentile(values, [50, 95, 99, 100]))
+
+
+def report(samples: Samples, lags: list[float], duration: float) -> None:
+    print(f"{'endpoint':<20} {'requests':>9} {'errors':>7} {'req/s':>8} "
+            f"{'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for name in sorted(set(samples.latencies) | set(samples.errors)):
+        latencies = samples.latencies[name]
+        p50, p95, p99, p100 = percentiles(latencies)
+        print(f"{name:<20} {len(latencies):>9} {samples.errors[name]:>7} "
+                f"{len(latencies) / duration:>8.1f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {p100:>9.1f}")
+
+    print()
+    for name, values in [("log delivery", samples.delivery), ("event loop lag", lags)]:
+        p50, p95, p99, p100 = percentiles(values)
+        print(f"{name:<20} {len(values):>9} {'':>7} {'':>8} "
+                f"{p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {p100:>9.1f}")
+
+
+async def load_test(args: argparse.Namespace) -> None:
+    # Imported here: the client processes do not use the backend.
+    import uvicorn
+    from src import db, events
+    from src.app import app
+    from src.data import RunState
+
+    await db.init()
+    await events.init()
+
+    server = uvicorn.Server(uvicorn.Config(app, host = "127.0.0.1", port = args.port,
+        lifespan = "off", log_level = "warning"))
+    server_task = asyncio.create_task(server.serve())
+
+    lags: list[float] = []
+    background: list[asyncio.Task] = []
+    running_ids: list[int] = []
+    finished_ids: list[int] = []
+
+    try:
+        running_ids, finished_ids = await create_runs(args.runs, args.finished_runs)
+
+        while not server.started:
+            if server_task.done():
+                server_task.result()
+                raise RuntimeError("The server stopped before starting.")
+            await asyncio.sleep(0.05)
+
+        background = [
+            asyncio.create_task(write_runs(running_ids, args.write_interval)),
+            asyncio.create_task(measure_lag(args.lag_interval, lags)),
+        ]
+
+        deadline = time() + args.duration
+        base_url = f"http://127.0.0.1:{args.port}"
+        loop = asyncio.get_running_loop()
+
+        shares = [args.browsers // args.client_processes
+                + (1 if i < args.browsers % args.client_processes else 0)
+                for i in range(args.client_processes)]
+
+        samples = Samples()
+        with ProcessPoolExecutor(args.client_processes) as pool:
+            for client_samples in await asyncio.gather(*(
+                    loop.run_in_executor(pool, run_browsers, base_url,
+                        running_ids + finished_ids, share, args.list_interval,
+                        args.view_duration, deadline)
+                    for share in shares if share > 0)):
+                samples.merge(client_samples)
+
+        report(samples, lags, args.duration)
+
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions = True)
+
+        # The runs must not look like they are still running.
+        for run_id in running_ids + finished_ids:
+            await db.put_run_state(run_id, RunState.FINISHED)
+
+        server.should_exit = True
+        await server_task
+        await events.close()
+        await db.engine.dispose()
+
+
+def main() -> None:
+    default_list_interval = float(environ.get("REACT_APP_RUN_STATE_UPDATE_INTERVAL", "1000")) / 1000
+
+    parser = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--browsers", type = int, default = 100,
+            help = "Number of simulated browsers (default 100).")
+    parser.add_argument("--runs", type = int, default = 10,
+            help = "Number of running runs (default 10).")
+    parser.add_argument("--finished-runs", type = int, default = 10,
+            help = "Number of finished runs, with a posterior sample (default 10).")
+    parser.add_argument("--duration", type = float, default = 60,
+            help = "Seconds the browsers are simulated for (default 60).")
+    parser.add_argument("--list-interval", type = float, default = default_list_interval,
+            help = f"Seconds between two polls of the run list (default {default_list_interval}).")
+    parser.add_argument("--view-duration", type = float, default = 20,
+            help = "Average seconds a browser stays on a run (default 20).")
+    parser.add_argument("--write-interval", type = float, default = 1,
+            help = "Seconds between two writes to the running runs (default 1).")
+    parser.add_argument("--lag-interval", type = float, default = 0.05,
+            help = "Seconds between two measures of the event loop lag (default 0.05).")
+    parser.add_argument("--client-processes", type = int, default = 1,
+            help = "Number of processes simulating the browsers (default 1).")
+    parser.add_argument("--port", type = int, default = 8765,
+            help = "Port the backend is served on (default 8765).")
+    args = parser.parse_args()
+
+    asyncio.run(load_test(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""A stand-in for the REST API of OpenMOLE, limited to what `src.openmole`
+uses, to run the backend without OpenMOLE (see `bench.benchmark`). From the
+backend directory:
+
+    uvicorn bench.openmole_sim:app --port 8080
+
+then point OPENMOLE_HOST and OPENMOLE_PORT to it. With the default settings,
+`test_do_run` passes against it. Configured with the environment variables:
+
+- SIM_LATENCY: seconds added to each response (default 0),
+- SIM_JOB_DURATION: seconds from the submission of a job to its end (default 10),
+- SIM_JOB_COUNT: number of OpenMOLE jobs reported in the progress of a job
+  (default 100),
+- SIM_POSTERIOR_SIZE: number of points of the posterior sample of each
+  colony (default 500),
+- SIM_FAIL: "1" for every job to fail at its end (default 0),
+- COLONY_COUNT: number of colonies (default 19)."""
+
+import gzip
+import re
+import numpy as np
+from asyncio import sleep
+from functools import lru_cache
+from os import environ
+from time import time
+from typing import Awaitable, Callable
+from uuid import uuid4
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+LATENCY = float(environ.get("SIM_LATENCY", "0"))
+JOB_DURATION = float(environ.get("SIM_JOB_DURATION", "10"))
+JOB_COUNT = int(environ.get("SIM_JOB_COUNT", "100"))
+POSTERIOR_SIZE = int(environ.get("SIM_POSTERIOR_SIZE", "500"))
+FAIL = environ.get("SIM_FAIL", "0") == "1"
+COLONY_COUNT = int(environ.get("COLONY_COUNT", "19"))
+
+# Lines of output written by a job over its duration.
+OUTPUT_LINES = 200
+
+RESULT_FILENAME = "posteriorSample_50000.csv.gz"
+
+app = FastAPI()
+
+# Submission time of each job, by job id.
+jobs: dict[str, float] = {}
+
+
+@app.middleware("http")
+async def latency(request: Request,
+        call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    if LATENCY > 0:
+        await sleep(LATENCY)
+    return await call_next(request)
+
+
+def elapsed_fraction(job_id: str) -> float:
+    return min((time() - jobs[job_id]) / JOB_DURATION, 1.0) if JOB_DURATION > 0 else 1.0
+
+
+def unknown_job(job_id: str) -> JSONResponse:
+    return JSONResponse({"message": f"Job {job_id} not found."}, status_code = 404)
+
+
+@app.post("/job")
+async def post_job(request: Request) -> JSONResponse:
+    # The archive is read and dropped.
+    async for _ in request.stream():
+        pass
+
+    job_id = uuid4().hex
+    jobs[job_id] = time()
+    return JSONResponse({"id": job_id})
+
+
+@app.get("/job/{job_id}/state")
+async def get_state(job_id: str) -> JSONResponse:
+    if job_id not in jobs:
+        return unknown_job(job_id)
+
+    fraction = elapsed_fraction(job_id)
+
+    if fraction >= 1.0 and FAIL:
+        return JSONResponse({"state": "failed",
+            "error": {"message": "Simulated failure.", "stackTrace": ""}})
+    elif fraction >= 1.0:
+        return JSONResponse({"state": "finished"})
+
+    completed = int(fraction * JOB_COUNT)
+    running = min(JOB_COUNT - completed, max(JOB_COUNT // 10, 1))
+    ready = JOB_COUNT - completed - running
+
+    return JSONResponse({
+        "state": "running",
+        "ready": ready,
+        "running": running,
+        "completed": completed,
+        "environments": [{
+            "name": "local",
+            "submitted": ready,
+            "running": running,
+            "done": completed,
+            "failed": 0,
+            "errors": [],
+        }],
+    })
+
+
+@app.get("/job/{job_id}/output")
+async def get_output(job_id: str) -> Response:
+    if job_id not in jobs:
+        return unknown_job(job_id)
+
+    lines = int(elapsed_fraction(job_id) * OUTPUT_LINES)
+    return PlainTextResponse("".join(f"Simulated output line {i} of job {job_id}.\n"
+        for i in range(lines)))
+
+
+def colony_of(path: str) -> int:
+    match = re.search(r"posteriorSample_(\d+)", path)
+    if match is None:
+        raise ValueError(f"No colony in path {path}.")
+    return int(match.group(1))
+
+
+@app.api_route("/job/{job_id}/workDirectory/{path:path}", methods = ["PROPFIND"])
+async def list_directory(job_id: str, path: str) -> JSONResponse:
+    if job_id not in jobs:
+        return unknown_job(job_id)
+
+    if elapsed_fraction(job_id) < 1.0 or FAIL:
+        return JSONResponse({"entries": []})
+
+    return JSONResponse({"entries": [{
+        "name": RESULT_FILENAME,
+        "size": len(posterior_sample_csv(colony_of(path))),
+        "modified": int(jobs[job_id] + JOB_DURATION) * 1000,
+        "type": "file",
+    }]})
+
+
+@app.get("/job/{job_id}/workDirectory/{path:path}")
+async def get_file(job_id: str, path: str) -> Response:
+    if job_id not in jobs:
+        return unknown_job(job_id)
+
+    if not path.endswith(RESULT_FILENAME) or elapsed_fraction(job_id) < 1.0:
+        return JSONResponse({"message": f"File {path} not found."}, status_code = 404)
+
+    return Response(posterior_sample_csv(colony_of(path)),
+            media_type = "application/octet-stream")
+
+
+@lru_cache(maxsize = None)
+def posterior_sample_csv(colony_id: int) -> bytes:
+    """The gzipped CSV of the posterior sample of the colony, as written by the
+    ABC: parameters with their bounds, the integer ones as doubles."""
+    rng = np.random.default_rng(colony_id)
+    columns = {
+        "nest_quality_assessment_error": rng.uniform(0, 1, POSTERIOR_SIZE),
+        "percentage_foragers": rng.uniform(0, 100, POSTERIOR_SIZE),
+        "number_nests_dbl": rng.uniform(1, 20, POSTERIOR_SIZE),
+        "exploring_phase_dbl": rng.uniform(0, 20000, POSTERIOR_SIZE),
+        "epsilon": rng.uniform(0, 1, POSTERIOR_SIZE),
+    }
+
+    lines = [",".join(columns)]
+    lines += [",".join(repr(float(v)) for v in row) for row in zip(*columns.values())]
+
+    return gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
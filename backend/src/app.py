@@ -1,17 +1,46 @@
 #!/usr/bin/env python3
 
-from typing import Optional
+import json
+from typing import Awaitable, Callable, Optional, Tuple, Union
 from collections import namedtuple
+from time import perf_counter, time
 from src.constants import ALLOWED_CORS
-from fastapi import FastAPI, Response, status, BackgroundTasks
+from fastapi import FastAPI, Header, Query, Request, Response, status, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.routing import Match
 from markupsafe import escape
-from src.data import Code, RunState, Run, RunWithId, RunOutput, Logs, PosteriorSample, Log
+from src.data import Code, RunState, Run, RunWithId, RunPage, RunOutput, Logs, PosteriorSample, \
+        PosteriorSummary, Log, RunTimeline, TimelineSummary
 from src import db
-from src.tasks import launch_run
+from src import openmole
+from src import events
+from src import response_cache
+from src import tasks
+from src import metrics
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def startup() -> None:
+    await db.init()
+    await openmole.init()
+    await events.init()
+    await tasks.start()
+    await metrics.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await metrics.stop()
+    await tasks.stop()
+    await events.close()
+    await openmole.close()
+    await db.engine.dispose()
+
+
 allowed_origins = ALLOWED_CORS
 
 app.add_middleware(
@@ -22,6 +51,34 @@ app.add_middleware(
         allow_headers=["*"],
 )
 
+
+def route_path(request: Request) -> str:
+    """The path of the route matching the request, such as `/run/{run_id}`, so
+    that the requests about all the runs are measured together."""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unknown")
+    return "unknown"
+
+
+@app.middleware("http")
+async def measure_request(request: Request,
+        call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    start = perf_counter()
+    response = await call_next(request)
+    metrics.REQUEST_SECONDS.labels(request.method, route_path(request),
+            response.status_code).observe(perf_counter() - start)
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """The metrics of this worker in the Prometheus text format, see
+    `src.metrics`."""
+    return Response(generate_latest(), media_type = CONTENT_TYPE_LATEST)
+
+
 @app.get("/launch/{commit_hash}")
 async def launch(
         commit_hash: str,
@@ -43,63 +100,179 @@ async def launch(
             script = script,
             state = RunState.RUNNING)
 
-    run_with_id = launch_run(run)
+    run_with_id = await tasks.launch_run(run)
     return run_with_id
 
 
+RUN_PAGE_SIZE = 100
+RUN_PAGE_MAX_SIZE = 1000
+
+# A change is only visible once its transaction commits, possibly a bit after
+# the time it records. The `changed_since` returned to clients is set back by
+# this many seconds so that such changes are not missed, at the cost of
+# sending some runs twice.
+CHANGED_SINCE_MARGIN = 5.0
+
+
+def format_run_cursor(run: RunWithId) -> str:
+    return f"{run.timestamp}:{run.id}"
+
+
+def parse_run_cursor(cursor: str) -> Optional[Tuple[float, int]]:
+    try:
+        timestamp, run_id = cursor.split(":")
+        return float(timestamp), int(run_id)
+    except ValueError:
+        return None
+
+
 @app.get("/all_runs")
-async def run_list() -> list[RunWithId]:
-    runs = [db.get_all_runs()]
-    return db.get_all_runs()
+async def run_list(
+        response: Response,
+        limit: int = Query(RUN_PAGE_SIZE, ge = 1, le = RUN_PAGE_MAX_SIZE),
+        after: Optional[str] = None,
+        branch: Optional[str] = None,
+        commit_hash: Optional[str] = None,
+        state: Optional[str] = None,
+        changed_since: Optional[float] = None) -> Optional[RunPage]:
+    """The runs, most recent first, `limit` at a time: the next page is
+    requested with `after` set to the `next` cursor of the current one. The
+    runs can be filtered by `branch`, `commit_hash` and `state` (a name of
+    `RunState`). With `changed_since`, only the runs created or whose state
+    changed since then are returned (see `RunPage`)."""
+    after_key = None
+    if after is not None:
+        after_key = parse_run_cursor(after)
+        if after_key is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return None
 
+    run_state = None
+    if state is not None:
+        if state not in RunState.__members__:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return None
+        run_state = RunState[state]
 
-@app.get("/run/{run_id}")
-async def get_run(run_id: str, response: Response) -> Optional[Run]:
-    result = db.get_run(int(run_id))
+    now = time()
 
-    if result is None:
-        response.status_code = status.HTTP_404_NOT_FOUND
+    # One more run than asked for tells whether there is a next page.
+    runs = await db.get_all_runs(
+            limit = limit + 1,
+            after = after_key,
+            branch = branch,
+            commit_hash = commit_hash,
+            state = run_state,
+            changed_since = changed_since)
 
-    return result
+    return RunPage(
+            runs = runs[:limit],
+            next = format_run_cursor(runs[limit - 1]) if len(runs) > limit else None,
+            changed_since = now - CHANGED_SINCE_MARGIN)
 
 
-@app.get("/output/{run_id}")
-async def get_output(run_id: str, response: Response) -> Optional[RunOutput]:
-    result = db.get_run_output(int(run_id))
+# The responses about a single run are cached once the run will not change
+# anymore, see `src.response_cache`.
 
-    if result is None:
-        response.status_code = status.HTTP_404_NOT_FOUND
+@app.get("/run/{run_id}", response_model = Run)
+async def get_run(run_id: int, request: Request) -> Response:
+    async def load(run: Run) -> Optional[bytes]:
+        return run.json().encode("utf-8")
 
-    return result
+    return await response_cache.run_response(request, run_id, load)
 
 
-@app.get("/logs/{run_id}")
-async def get_logs(response: Response, run_id: str,
-        from_time: Optional[float] = None) -> Optional[dict[str, list[Log]]]:
-    logs = db.get_logs(int(run_id), from_time)
+@app.get("/output/{run_id}", response_model = RunOutput)
+async def get_output(run_id: int, request: Request,
+        from_offset: int = 0) -> Response:
+    """With `from_offset`, only the output from that many characters on is
+    returned."""
+    async def load(run: Run) -> Optional[bytes]:
+        result = await db.get_run_output(run_id, from_offset)
+        return None if result is None else result.json().encode("utf-8")
 
-    if logs is None:
-        response.status_code = status.HTTP_404_NOT_FOUND
+    return await response_cache.run_response(request, run_id, load)
+
+
+@app.get("/logs/{run_id}", response_model = dict[str, list[Log]])
+async def get_logs(request: Request, run_id: int,
+        from_time: Optional[float] = None) -> Response:
+    async def load(run: Run) -> Optional[bytes]:
+        logs = await db.get_logs(run_id, from_time)
+
+        # If there is no log whose timestamp is greater than `from_time`, the
+        # logs are empty. Otherwise there is only one run in the logs
+        # dictionary: extract the corresponding contexts and logs.
+        result = {} if logs.is_empty() else next(iter(logs.logs.values()))
 
-    # If there is no log whose timestamp is `from_time` or greater, the logs are
-    # empty.
-    if logs.is_empty():
-        return {}
+        return json.dumps({context: [log.dict() for log in log_list]
+            for context, log_list in result.items()}).encode("utf-8")
 
-    # There is at most one run in the logs dictionary. Extract the corresponding
-    # contexts and logs.
-    result = next(iter(logs.logs.values()))
+    return await response_cache.run_response(request, run_id, load)
 
-    return result
 
+@app.get("/posterior_sample/{run_id}", response_model = PosteriorSample)
+async def get_posterior_sample(run_id: int, request: Request,
+        columns: bool = False) -> Response:
+    """With `columns`, the sample is returned as one list per parameter (see
+    `PosteriorSampleColumns`) instead of a list of points."""
+    async def load(run: Run) -> Optional[bytes]:
+        result_columns = await db.get_posterior_sample_columns(run_id)
 
-@app.get("/posterior_sample/{run_id}")
-async def get_posterior_sample(run_id: int, response: Response) -> Optional[PosteriorSample]:
-    result = db.get_posterior_sample(int(run_id))
+        if result_columns is None:
+            return None
+        elif columns:
+            return json.dumps(result_columns.to_dict()).encode("utf-8")
+        else:
+            return result_columns.to_sample().json().encode("utf-8")
 
-    if result is None:
+    return await response_cache.run_response(request, run_id, load)
+
+
+@app.get("/posterior_summary/{run_id}", response_model = PosteriorSummary)
+async def get_posterior_summary(run_id: int, request: Request) -> Response:
+    """The densities, quantiles and means of the parameters of each colony in
+    the posterior sample, to be plotted instead of the whole sample."""
+    async def load(run: Run) -> Optional[bytes]:
+        result_columns = await db.get_posterior_sample_columns(run_id)
+
+        if result_columns is None:
+            return None
+        else:
+            return PosteriorSummary.from_columns(result_columns).json().encode("utf-8")
+
+    return await response_cache.run_response(request, run_id, load)
+
+
+@app.get("/run/{run_id}/timeline")
+async def get_run_timeline(run_id: int, response: Response) -> Optional[RunTimeline]:
+    """Where the time of the run went, as a waterfall of the steps of its
+    execution (see `src.timeline`)."""
+    if await db.get_run(run_id) is None:
         response.status_code = status.HTTP_404_NOT_FOUND
+        return None
+
+    return RunTimeline.from_spans(run_id, await db.get_spans(run_id))
+
 
-    return result
+@app.get("/timeline_summary")
+async def get_timeline_summary(
+        limit: int = Query(RUN_PAGE_SIZE, ge = 1, le = RUN_PAGE_MAX_SIZE)) -> TimelineSummary:
+    """The statistics of the steps of the `limit` most recent runs, to spot
+    those that are systematically slow."""
+    return TimelineSummary.from_spans(await db.get_recent_spans(limit))
 
 
+@app.get("/events/{run_id}")
+async def get_events(run_id: int,
+        last_event_id: Optional[str] = Header(None)) -> StreamingResponse:
+    """Server-sent events announcing the changes to the run, see
+    `events.run_event_stream`."""
+    return StreamingResponse(
+            events.run_event_stream(run_id, last_event_id),
+            media_type = "text/event-stream",
+            headers = {
+                "Cache-Control": "no-cache",
+                # Tell nginx not to buffer the stream.
+                "X-Accel-Buffering": "no",
+            })
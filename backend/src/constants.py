@@ -12,11 +12,26 @@ COLONY_COUNT = int(getenv_checked("COLONY_COUNT"))
 OPENMOLE_HOST = getenv_checked("OPENMOLE_HOST")
 OPENMOLE_SEND_JOB_TIMEOUT = int(getenv_checked("OPENMOLE_SEND_JOB_TIMEOUT"))
 OPENMOLE_PORT = getenv_checked("OPENMOLE_PORT")
+OPENMOLE_MAX_CONNECTIONS = int(getenv_checked("OPENMOLE_MAX_CONNECTIONS"))
+OPENMOLE_MAX_KEEPALIVE_CONNECTIONS = int(getenv_checked("OPENMOLE_MAX_KEEPALIVE_CONNECTIONS"))
 OPENMOLE_STATE_PULL_DELAY = int(getenv_checked("OPENMOLE_STATE_PULL_DELAY"))
+OPENMOLE_STATE_PULL_MAX_DELAY = int(getenv_checked("OPENMOLE_STATE_PULL_MAX_DELAY"))
+OPENMOLE_STATE_PULL_BACKOFF = float(getenv_checked("OPENMOLE_STATE_PULL_BACKOFF"))
+OPENMOLE_WATCH_CONCURRENCY = int(getenv_checked("OPENMOLE_WATCH_CONCURRENCY"))
 OPENMOLE_PASSWORD = getenv_checked("OPENMOLE_PASSWORD")
 DB_HOST = getenv_checked("DB_HOST")
 DB_PORT = getenv_checked("DB_PORT")
 DB_USER = getenv_checked("DB_USER")
 DB_PASSWORD = getenv_checked("DB_PASSWORD")
+DB_POOL_SIZE = int(getenv_checked("DB_POOL_SIZE"))
+DB_MAX_OVERFLOW = int(getenv_checked("DB_MAX_OVERFLOW"))
 REPOSITORY_PATH = getenv_checked("JOB_REPO_LOCAL")
 TMP_DIR = getenv_checked("TMP_DIR")
+ARCHIVE_CACHE_MAX_SIZE = int(getenv_checked("ARCHIVE_CACHE_MAX_SIZE"))
+RESPONSE_CACHE_MAX_SIZE = int(getenv_checked("RESPONSE_CACHE_MAX_SIZE"))
+RESULTS_PARSE_WORKERS = int(getenv_checked("RESULTS_PARSE_WORKERS"))
+RUN_QUEUE_CONCURRENCY = int(getenv_checked("RUN_QUEUE_CONCURRENCY"))
+RUN_QUEUE_LEASE_DURATION = int(getenv_checked("RUN_QUEUE_LEASE_DURATION"))
+RUN_QUEUE_POLL_INTERVAL = int(getenv_checked("RUN_QUEUE_POLL_INTERVAL"))
+RUN_QUEUE_MAX_ATTEMPTS = int(getenv_checked("RUN_QUEUE_MAX_ATTEMPTS"))
+RUN_QUEUE_RETRY_DELAY = int(getenv_checked("RUN_QUEUE_RETRY_DELAY"))
@@ -2,8 +2,8 @@ from abc import ABC, abstractmethod
 from pydantic import BaseModel, validator
 from enum import Enum
 import time
-from typing import Tuple, Union, TextIO, Iterable
-from math import floor
+from typing import Optional, Sequence, Tuple, Union, TextIO, Iterable
+import numpy as np
 from src.constants import *
 from textwrap import dedent, indent
 from itertools import chain
@@ -32,6 +32,110 @@ class RunState(Enum):
     FINISHED = 3
 
 
+class JobStage(Enum):
+    """What remains to be done to execute a run, see `src.tasks`."""
+    SUBMIT = 1
+    WATCH = 2
+    RESULTS = 3
+
+
+class RunJob(BaseModel, frozen=True):
+    """A run in the queue of the runs to execute, at `stage`, which failed
+    `attempts` times so far. `om_run_id` is the id of the OpenMOLE job, once
+    it is submitted."""
+    run: RunWithId
+    stage: JobStage
+    attempts: int
+    om_run_id: Optional[str]
+
+
+class RunPage(BaseModel, frozen=True):
+    """A page of the run list. `next` is the cursor of the next page, None if
+    this is the last one. Passing `changed_since` as the `changed_since` of a
+    later request gets the runs that were created or changed since this
+    page was read."""
+    runs: list[RunWithId]
+    next: Optional[str]
+    changed_since: float
+
+
+class Span(BaseModel, frozen=True, orm_mode = True):
+    """A step of the execution of a run, from `start` to `end` (seconds since
+    the epoch), see `src.timeline`."""
+    name: str
+    start: float
+    end: float
+
+
+class TimelineBar(BaseModel, frozen=True):
+    """A span placed on the timeline of its run: it starts `offset` seconds
+    after the first span of the run."""
+    name: str
+    offset: float
+    duration: float
+
+
+class RunTimeline(BaseModel, frozen=True):
+    """The spans of a run as a waterfall, in the order they started. `start`
+    is the start of the first span (None if there is none) and `duration` the
+    time from then to the end of the last one. Spans may overlap: a span
+    covers the spans that happened within it."""
+    run_id: int
+    start: Optional[float]
+    duration: float
+    bars: list[TimelineBar]
+
+    @staticmethod
+    def from_spans(run_id: int, spans: list[Span]) -> "RunTimeline":
+        if len(spans) == 0:
+            return RunTimeline(run_id = run_id, start = None, duration = 0.0, bars = [])
+
+        start = min(s.start for s in spans)
+        return RunTimeline(
+                run_id = run_id,
+                start = start,
+                duration = max(s.end for s in spans) - start,
+                bars = [TimelineBar(name = s.name, offset = s.start - start,
+                    duration = s.end - s.start)
+                    for s in sorted(spans, key = lambda s: (s.start, s.name))])
+
+
+class SpanStats(BaseModel, frozen=True):
+    """Durations of the spans of one name across runs, in seconds. `total` is
+    their sum."""
+    name: str
+    count: int
+    total: float
+    mean: float
+    p50: float
+    p95: float
+    max: float
+
+
+class TimelineSummary(BaseModel, frozen=True):
+    """Where the time of `runs` runs went: the statistics of their spans by
+    name, the name with the largest total first."""
+    runs: int
+    spans: list[SpanStats]
+
+    @staticmethod
+    def from_spans(spans_by_run: dict[int, list[Span]]) -> "TimelineSummary":
+        durations: dict[str, list[float]] = {}
+        for spans in spans_by_run.values():
+            for s in spans:
+                durations.setdefault(s.name, []).append(s.end - s.start)
+
+        stats = []
+        for name, values in durations.items():
+            array = np.array(values)
+            p50, p95 = np.quantile(array, [0.5, 0.95])
+            stats.append(SpanStats(name = name, count = len(array), total = array.sum(),
+                mean = array.mean(), p50 = p50, p95 = p95, max = array.max()))
+
+        return TimelineSummary(runs = len(spans_by_run),
+                spans = sorted(stats, key = lambda s: -s.total))
+
+
 class PosteriorSamplePoint(BaseModel, frozen=True):
     colony_id: int
     nest_quality_assessment_error: float
@@ -79,18 +183,7 @@ class PosteriorSample(BaseModel, frozen=True):
 
     @staticmethod
     def from_csv_string(csv_data: str, colony: "Colony") -> "PosteriorSample":
-        reader = csv.DictReader(csv_data.splitlines())
-        data = []
-        colony_id = colony.colony_id
-        for row in reader:
-            data.append(PosteriorSamplePoint(
-                colony_id = colony_id,
-                nest_quality_assessment_error = row['nest_quality_assessment_error'],
-                percentage_foragers = row['percentage_foragers'],
-                number_nests = floor(float(row['number_nests_dbl'])),
-                exploring_phase = floor(float(row['exploring_phase_dbl']))))
-
-        return PosteriorSample(data = data)
+        return PosteriorSampleColumns.from_csv_string(csv_data, colony).to_sample()
 
 
     @staticmethod
@@ -98,6 +191,282 @@ class PosteriorSample(BaseModel, frozen=True):
         return PosteriorSample(data = [row for row in chain.from_iterable(r.data for r in data)])
 
 
+# Storage type of each column of a posterior sample. The byte order is explicit
+# so that the raw buffers stored in the database do not depend on the host.
+POSTERIOR_SAMPLE_DTYPES: dict[str, np.dtype] = {
+    "colony_id": np.dtype("<i4"),
+    "nest_quality_assessment_error": np.dtype("<f8"),
+    "percentage_foragers": np.dtype("<f8"),
+    "number_nests": np.dtype("<i4"),
+    "exploring_phase": np.dtype("<i4"),
+}
+
+
+class PosteriorSampleColumns(BaseModel, frozen=True, arbitrary_types_allowed=True):
+    """Columnar representation of a posterior sample: one array per field of
+    `PosteriorSamplePoint`, all of the same length. Row `i` of each array
+    describes the same point."""
+    colony_id: np.ndarray
+    nest_quality_assessment_error: np.ndarray
+    percentage_foragers: np.ndarray
+    number_nests: np.ndarray
+    exploring_phase: np.ndarray
+
+    @validator('*', pre=True)
+    def as_typed_array(cls, v: Iterable, field) -> np.ndarray: # type: ignore
+        return np.ascontiguousarray(v, dtype = POSTERIOR_SAMPLE_DTYPES[field.name])
+
+    @validator('exploring_phase')
+    def columns_must_have_same_length(cls, v: np.ndarray, values: dict) -> np.ndarray:
+        for name, col in values.items():
+            if len(col) != len(v):
+                raise ValueError(f"Column {name} has length {len(col)}, expected {len(v)}.")
+        return v
+
+    def __len__(self) -> int:
+        return len(self.colony_id)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, PosteriorSampleColumns):
+            return False
+        return all(np.array_equal(getattr(self, name), getattr(other, name))
+                for name in POSTERIOR_SAMPLE_DTYPES)
+
+    def to_dict(self) -> dict[str, list]:
+        """Plain python lists, ready to be serialized to JSON."""
+        return {name: getattr(self, name).tolist() for name in POSTERIOR_SAMPLE_DTYPES}
+
+    def to_buffers(self) -> dict[str, bytes]:
+        return {name: getattr(self, name).tobytes() for name in POSTERIOR_SAMPLE_DTYPES}
+
+    def to_sample(self) -> PosteriorSample:
+        return PosteriorSample(data = [
+            PosteriorSamplePoint(
+                colony_id = c,
+                nest_quality_assessment_error = e,
+                percentage_foragers = f,
+                number_nests = n,
+                exploring_phase = p)
+            for c, e, f, n, p in zip(*self.to_dict().values())])
+
+    @staticmethod
+    def from_buffers(size: int, buffers: dict[str, bytes]) -> "PosteriorSampleColumns":
+        columns = {}
+        for name, dtype in POSTERIOR_SAMPLE_DTYPES.items():
+            buf = buffers[name]
+            if len(buf) != size * dtype.itemsize:
+                raise ValueError(f"Corrupted posterior sample column {name}: expected {size * dtype.itemsize} bytes, got {len(buf)}.")
+            columns[name] = np.frombuffer(buf, dtype = dtype)
+        return PosteriorSampleColumns(**columns)
+
+    def check_bounds(self, rows: Optional[Sequence[int]] = None) -> None:
+        """Raise a ValueError naming the first row whose values are out of the
+        bounds checked by `PosteriorSamplePoint`: its number in `rows`, or its
+        index without. Each column is checked at once."""
+        checks = [
+            ("colony_id", (self.colony_id >= 0) & (self.colony_id < COLONY_COUNT),
+                f"Colony id should be >= 0 and < {COLONY_COUNT}."),
+            ("nest_quality_assessment_error", self.nest_quality_assessment_error >= 0,
+                "NestQualityAssessmentError must be positive"),
+            ("percentage_foragers",
+                (self.percentage_foragers >= 0) & (self.percentage_foragers <= 100),
+                "PercentageForagers be a percentage."),
+            ("number_nests", self.number_nests >= 0, "NumberNests must positive."),
+            ("exploring_phase", self.exploring_phase >= 0, "ExploringPhase must positive."),
+        ]
+
+        for name, valid, message in checks:
+            invalid = np.flatnonzero(~valid)
+            if len(invalid) > 0:
+                i = invalid[0]
+                row = i if rows is None else rows[i]
+                raise ValueError(f"Row {row}, {name} = {getattr(self, name)[i]}: {message}")
+
+    @staticmethod
+    def from_csv_string(csv_data: str, colony: "Colony") -> "PosteriorSampleColumns":
+        """Read the posterior sample of a colony from the CSV written by the ABC
+        (with a header line), all the values of a column at once. Errors name
+        the row at fault, that is the line of the CSV, the header being row
+        1."""
+        lines = csv_data.splitlines()
+        if len(lines) == 0:
+            raise ValueError("Empty CSV, the header line is missing.")
+
+        header = [name.strip() for name in
+                next(csv.reader(lines[:1], skipinitialspace = True))]
+        csv_columns = ["nest_quality_assessment_error", "percentage_foragers",
+                "number_nests_dbl", "exploring_phase_dbl"]
+        missing = [name for name in csv_columns if name not in header]
+        if len(missing) > 0:
+            raise ValueError(f"Missing columns in the CSV: {', '.join(missing)}.")
+
+        # The number of each non blank line after the header: blank lines are
+        # skipped but still counted.
+        rows = [row for row, line in enumerate(lines[1:], start = 2) if line.strip() != ""]
+        if len(rows) == 0:
+            return PosteriorSampleColumns.empty()
+
+        indices = [header.index(name) for name in csv_columns]
+
+        # `np.loadtxt` misreads quoted fields, so the rows of a CSV with any are
+        # split like the header, which is slower.
+        split_rows: Optional[list[list[str]]] = None
+        if '"' in csv_data:
+            split_rows = list(csv.reader([lines[row - 1] for row in rows],
+                skipinitialspace = True))
+
+        try:
+            if split_rows is None:
+                values = np.loadtxt([lines[row - 1] for row in rows], delimiter = ",",
+                        dtype = np.float64, comments = None, usecols = indices, ndmin = 2)
+            else:
+                values = np.array([[fields[i] for i in indices] for fields in split_rows],
+                        dtype = np.float64)
+        except (ValueError, IndexError) as e:
+            # Only on errors: find the row at fault line by line.
+            for j, row in enumerate(rows):
+                fields = lines[row - 1].split(",") if split_rows is None else split_rows[j]
+                try:
+                    [float(fields[i]) for i in indices]
+                except (ValueError, IndexError) as line_error:
+                    raise ValueError(f"Row {row}: {line_error!r}") from e
+            raise
+
+        # Checked before the integer columns are cast.
+        not_finite = np.flatnonzero(~np.isfinite(values).all(axis = 1))
+        if len(not_finite) > 0:
+            raise ValueError(f"Row {rows[not_finite[0]]}: values must be finite numbers.")
+
+        error, foragers, nests, exploring = values.T
+        nests = np.floor(nests)
+        exploring = np.floor(exploring)
+
+        # Casting a value out of range would silently wrap around.
+        for name, column in [("number_nests", nests), ("exploring_phase", exploring)]:
+            bounds = np.iinfo(POSTERIOR_SAMPLE_DTYPES[name])
+            out_of_range = np.flatnonzero((column < bounds.min) | (column > bounds.max))
+            if len(out_of_range) > 0:
+                i = out_of_range[0]
+                raise ValueError(f"Row {rows[i]}, {name} = {column[i]}: "
+                        f"must be between {bounds.min} and {bounds.max}.")
+
+        columns = PosteriorSampleColumns(
+                colony_id = np.full(len(values), colony.colony_id),
+                nest_quality_assessment_error = error,
+                percentage_foragers = foragers,
+                number_nests = nests,
+                exploring_phase = exploring)
+
+        columns.check_bounds(rows)
+
+        return columns
+
+    @staticmethod
+    def from_sample(sample: PosteriorSample) -> "PosteriorSampleColumns":
+        def column(name: str) -> np.ndarray:
+            return np.array([getattr(p, name) for p in sample.data])
+
+        return PosteriorSampleColumns(
+                colony_id = column("colony_id"),
+                nest_quality_assessment_error = column("nest_quality_assessment_error"),
+                percentage_foragers = column("percentage_foragers"),
+                number_nests = column("number_nests"),
+                exploring_phase = column("exploring_phase"))
+
+    @staticmethod
+    def from_list(data: list["PosteriorSampleColumns"]) -> "PosteriorSampleColumns":
+        def column(name: str) -> np.ndarray:
+            return np.concatenate([getattr(d, name) for d in data]) \
+                    if len(data) > 0 else np.array([])
+
+        return PosteriorSampleColumns(
+                colony_id = column("colony_id"),
+                nest_quality_assessment_error = column("nest_quality_assessment_error"),
+                percentage_foragers = column("percentage_foragers"),
+                number_nests = column("number_nests"),
+                exploring_phase = column("exploring_phase"))
+
+    @staticmethod
+    def empty() -> "PosteriorSampleColumns":
+        return PosteriorSampleColumns.from_list([])
+
+
+# Parameters of the model estimated by the ABC, in the order they are shown.
+POSTERIOR_PARAMETERS = ["nest_quality_assessment_error", "percentage_foragers",
+        "number_nests", "exploring_phase"]
+
+# Points at which the density of each parameter is evaluated.
+DENSITY_STEPS = 50
+
+QUANTILE_LEVELS = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class ParameterSummary(BaseModel, frozen=True):
+    """Summary of the posterior distribution of one parameter for one colony.
+    `density[i]` is the Gaussian kernel density estimate at `x[i]`, and
+    `quantiles[i]` the quantile of level `QUANTILE_LEVELS[i]`."""
+    mean: float
+    quantiles: list[float]
+    x: list[float]
+    density: list[float]
+
+    @staticmethod
+    def from_values(values: np.ndarray) -> "ParameterSummary":
+        values = values.astype(np.float64)
+        bandwidth = kde_bandwidth(values)
+        x = np.linspace(values.min() - 3 * bandwidth, values.max() + 3 * bandwidth,
+                DENSITY_STEPS)
+        z = (x[:, np.newaxis] - values[np.newaxis, :]) / bandwidth
+        density = np.exp(-0.5 * z * z).sum(axis = 1) \
+                / (len(values) * bandwidth * np.sqrt(2 * np.pi))
+        return ParameterSummary(
+                mean = values.mean(),
+                quantiles = np.quantile(values, QUANTILE_LEVELS).tolist(),
+                x = x.tolist(),
+                density = density.tolist())
+
+
+def kde_bandwidth(values: np.ndarray) -> float:
+    """Scott's rule, as in the density transform of Vega. Values that are all
+    equal get an arbitrary positive bandwidth."""
+    sd = values.std(ddof = 1) if len(values) > 1 else 0.0
+    q1, q3 = np.quantile(values, [0.25, 0.75])
+    spread = min(sd, (q3 - q1) / 1.34) if q3 > q1 else sd
+    if spread <= 0:
+        return max(abs(float(values[0])) * 0.01, 1e-3)
+    return 1.06 * spread * len(values) ** (-1 / 5)
+
+
+class ColonySummary(BaseModel, frozen=True):
+    colony_id: int
+    size: int
+    parameters: dict[str, ParameterSummary]
+
+
+class PosteriorSummary(BaseModel, frozen=True):
+    """What is plotted of a posterior sample: a summary of each parameter (see
+    `POSTERIOR_PARAMETERS`) for each colony, much smaller than the sample."""
+    quantile_levels: list[float]
+    colonies: list[ColonySummary]
+
+    @staticmethod
+    def from_columns(columns: PosteriorSampleColumns) -> "PosteriorSummary":
+        order = np.argsort(columns.colony_id, kind = "stable")
+        colony_ids, starts = np.unique(columns.colony_id[order], return_index = True)
+        ends = np.append(starts[1:], len(order))
+
+        colonies = []
+        for colony_id, start, end in zip(colony_ids, starts, ends):
+            rows = order[start:end]
+            colonies.append(ColonySummary(
+                colony_id = colony_id,
+                size = end - start,
+                parameters = {name: ParameterSummary.from_values(getattr(columns, name)[rows])
+                    for name in POSTERIOR_PARAMETERS}))
+
+        return PosteriorSummary(quantile_levels = QUANTILE_LEVELS, colonies = colonies)
+
+
 class ResultsRessourceAlloc(BaseModel, frozen=True, orm_mode = True):
     data: list[Tuple["Colony", "Resource", "NestCount"]]
 
@@ -194,14 +563,33 @@ class NestCount(BaseModel, frozen=True, orm_mode = True):
         return val
 
 
+class JobProgress(BaseModel, frozen=True):
+    """Number of OpenMOLE jobs of a run in each stage."""
+    ready: int
+    running: int
+    completed: int
+
+    def completed_fraction(self) -> float:
+        total = self.ready + self.running + self.completed
+        return self.completed / total if total > 0 else 0.0
+
+
 class RunOutput(BaseModel, frozen = True, orm_mode = True):
+    """The output of a run, or the part of it that starts `offset` characters
+    into it."""
     text: str
+    offset: int = 0
 
 
 class Log(BaseModel, frozen=True, orm_mode = True):
+    """An entry of the logs of a run. The same progress entry written `repeat`
+    times in a row is stored once (see `db.put_log_rows`): `timestamp` is then
+    its first occurrence and `last_timestamp` its last."""
     timestamp: float
     stdout: str
     stderr: str
+    last_timestamp: Optional[float] = None
+    repeat: int = 1
 
     def append(self, log: "Log") -> "Log":
         return Log(
@@ -210,6 +598,10 @@ class Log(BaseModel, frozen=True, orm_mode = True):
                 stderr = self.stderr + "\n" + log.stderr)
 
 
+# The context of the progress of the OpenMOLE jobs, logged at each poll.
+PROGRESS_CONTEXT = "progress"
+
+
 def log_now(stdout: str, stderr: str) -> "Log":
     return Log(
             timestamp = time.time(),
@@ -221,32 +613,16 @@ class Logs(BaseModel, frozen=True, orm_mode = True):
     logs: dict[Run, dict[str, list[Log]]]
 
     def add(self, run: Run, context: str, log: Log) -> "Logs":
-        new_logs = self.logs.copy()
-        if run in self.logs:
-            new_logs[run] = self.logs[run].copy()
-            if context in self.logs[run]:
-                new_logs[run][context].append(log)
-            else:
-                new_logs[run][context] = [log]
-        else:
-            new_logs[run] = {context: [log]}
-        return Logs(logs = new_logs)
+        builder = LogsBuilder()
+        builder.add_all(self)
+        builder.add(run, context, log)
+        return builder.build()
 
     def add_all(self, logs: "Logs") -> "Logs":
-        new_logs = self.logs.copy()
-        for (run, context_dict) in logs.logs.items():
-            if run in new_logs:
-                new_logs[run] = self.logs[run].copy()
-                for context, log_list in context_dict.items():
-                    if context in new_logs[run]:
-                        new_logs[run][context].append(*log_list)
-                    else:
-                        new_logs[run][context] = log_list
-            else:
-                new_logs[run] = {}
-                for context, log_list in context_dict.items():
-                    new_logs[run][context] = log_list
-        return Logs(logs = new_logs)
+        builder = LogsBuilder()
+        builder.add_all(self)
+        builder.add_all(logs)
+        return builder.build()
 
     def is_empty(self) -> bool:
         return len(self.logs) == 0
@@ -257,10 +633,10 @@ class Logs(BaseModel, frozen=True, orm_mode = True):
 
     @staticmethod
     def new(*args: Tuple[Run, str, Log]) -> "Logs":
-        new_logs = Logs.empty()
+        builder = LogsBuilder()
         for run, context, log in args:
-            new_logs = new_logs.add(run, context, log)
-        return new_logs
+            builder.add(run, context, log)
+        return builder.build()
 
     def __getitem__(self, key: Tuple[Run, str]) -> list[Log]:
         run, context = key
@@ -291,9 +667,46 @@ class Logs(BaseModel, frozen=True, orm_mode = True):
         return s
 
 
+class LogsBuilder:
+    """Mutable accumulator of logs, to be turned into `Logs` with `build`.
+    Adding a log is amortized O(1) whereas `Logs.add` copies all the logs.
+    `build` hands the accumulated logs over to the `Logs` without copying or
+    validating them again, and empties the builder.
+
+    The logs stay keyed by the whole `Run`, as in `Logs`: `Run` has no id, and
+    the logs of runs not stored yet are built too. Hashing a run hashes all its
+    fields, so the contexts of the last run are kept, and a run is only hashed
+    when logs of another one are added."""
+
+    def __init__(self) -> None:
+        self.logs: dict[Run, dict[str, list[Log]]] = {}
+        self.last_run: Optional[Run] = None
+        self.last_contexts: dict[str, list[Log]] = {}
+
+    def add(self, run: Run, context: str, log: Log) -> None:
+        if run is not self.last_run:
+            self.last_run = run
+            self.last_contexts = self.logs.setdefault(run, {})
+        self.last_contexts.setdefault(context, []).append(log)
+
+    def add_all(self, logs: Logs) -> None:
+        for run, context, log_list in logs.items():
+            self.logs.setdefault(run, {}).setdefault(context, []).extend(log_list)
+
+    def is_empty(self) -> bool:
+        return len(self.logs) == 0
+
+    def build(self) -> Logs:
+        logs = Logs.construct(logs = self.logs)
+        self.logs = {}
+        self.last_run = None
+        return logs
+
+
 # See https://pydantic-docs.helpmanual.io/usage/postponed_annotations/#self-referencing-models
 PosteriorSamplePoint.update_forward_refs()
 PosteriorSample.update_forward_refs()
+PosteriorSampleColumns.update_forward_refs()
 Run.update_forward_refs()
 RunWithId.update_forward_refs()
 
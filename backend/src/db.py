@@ -1,18 +1,32 @@
-# TODO: make interaction with the db asynchronous
-
 import src.data as data
-from typing import Optional, Tuple
+from src import migrations
+from src.metrics import DB_POOL_CHECKED_OUT, timed_db_write
+from typing import Callable, Optional, Sequence, Tuple
 from src.util import logger
 from pprint import pformat
-from sqlalchemy import create_engine, text, Table, MetaData, Column, Integer, \
-        Float, String, Enum, ForeignKey, select, update
-from sqlalchemy.orm import declarative_base, relationship, Session
-from src.constants import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD
+from time import time
+from sqlalchemy import text, Table, MetaData, Column, Integer, \
+        Float, String, Enum, ForeignKey, LargeBinary, select, insert, update, delete, func, tuple_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.sql import Select
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import declarative_base, relationship, selectinload, \
+        contains_eager
+from src.constants import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, \
+        DB_POOL_SIZE, DB_MAX_OVERFLOW
 import urllib
+import zlib
+import numpy as np
 
+# Changes to these tables once created, and their secondary indexes, are in
+# `src.migrations`.
 Base = declarative_base()
 
 class Log(Base):
+    """An entry of the logs of a run (see `data.Log`). A text longer than
+    `LOG_COMPRESS_MIN_SIZE` is stored compressed with zlib in `stdout_zlib` or
+    `stderr_zlib`, the text column being left empty."""
     __tablename__ = "log"
 
     id = Column(Integer, primary_key = True)
@@ -21,6 +35,10 @@ class Log(Base):
     timestamp = Column(Float, nullable = False)
     stdout = Column(String, nullable = False)
     stderr = Column(String, nullable = False)
+    last_timestamp = Column(Float, nullable = True)
+    repeat = Column(Integer, nullable = False, default = 1)
+    stdout_zlib = Column(LargeBinary, nullable = True)
+    stderr_zlib = Column(LargeBinary, nullable = True)
 
     run: "Run" = relationship("Run", back_populates = "logs")
 
@@ -45,11 +63,26 @@ class Run(Base):
     job_dir = Column(String, nullable = False)
     output_dir = Column(String, nullable = False)
     script = Column(String, nullable = False)
-
-    code: "Code" = relationship("Code", back_populates = "runs")
+    # Time of the creation of the run or of the last change of its state, for
+    # clients to fetch only the runs that changed (see `get_all_runs`).
+    changed = Column(Float, nullable = False, default = time, onupdate = time)
+    # Id of the OpenMOLE job, once submitted.
+    om_run_id = Column(String, nullable = True)
+
+    # Loaded eagerly: lazy loading is not available with asyncio and every
+    # conversion to `data.Run` needs the code.
+    code: "Code" = relationship("Code", back_populates = "runs", lazy = "selectin")
     logs: "Log" = relationship("Log", back_populates = "run")
     posterior_sample: "PosteriorSample" = relationship("PosteriorSample", back_populates = "run")
+    posterior_sample_columns: "PosteriorSampleColumns" = relationship("PosteriorSampleColumns", back_populates = "run",
+            cascade = "all, delete-orphan")
     run_output: "RunOutput" = relationship("RunOutput", back_populates = "run")
+    run_output_chunks: list["RunOutputChunk"] = relationship("RunOutputChunk", back_populates = "run",
+            cascade = "all, delete-orphan")
+    job: "RunJob" = relationship("RunJob", back_populates = "run",
+            cascade = "all, delete-orphan")
+    spans: list["RunSpan"] = relationship("RunSpan", back_populates = "run",
+            cascade = "all, delete-orphan")
 
 
 class RunOutput(Base):
@@ -61,6 +94,50 @@ class RunOutput(Base):
     run: Run = relationship("Run", back_populates = "run_output")
 
 
+class RunOutputChunk(Base):
+    """A part of the output of a run, starting `offset` characters into it.
+    Chunks are appended as the output grows. The table `run_output` (the
+    whole text in one row) is only read for runs started before this table
+    existed."""
+    __tablename__ = "run_output_chunk"
+
+    run_id = Column(Integer, ForeignKey("run.id"), primary_key = True)
+    offset = Column(Integer, primary_key = True)
+    text = Column(String, nullable = False)
+
+    run: Run = relationship("Run", back_populates = "run_output_chunks")
+
+
+class RunJob(Base):
+    """The runs still to be executed, see `src.tasks`. A job is leased by
+    a backend worker, `lease_owner`, until `lease_expires`: the other workers
+    leave it alone until then. It is not attempted before `next_attempt`."""
+    __tablename__ = "run_job"
+
+    run_id = Column(Integer, ForeignKey("run.id"), primary_key = True)
+    stage = Column(Enum(data.JobStage), nullable = False)
+    attempts = Column(Integer, nullable = False, default = 0)
+    next_attempt = Column(Float, nullable = False)
+    lease_owner = Column(String, nullable = True)
+    lease_expires = Column(Float, nullable = True)
+    last_error = Column(String, nullable = True)
+
+    run: Run = relationship("Run", back_populates = "job")
+
+
+class RunSpan(Base):
+    """A timed step of the execution of a run, see `src.timeline`."""
+    __tablename__ = "run_span"
+
+    id = Column(Integer, primary_key = True)
+    run_id = Column(Integer, ForeignKey("run.id"), nullable = False)
+    name = Column(String, nullable = False)
+    start = Column(Float, nullable = False)
+    end = Column(Float, nullable = False)
+
+    run: Run = relationship("Run", back_populates = "spans")
+
+
 class PosteriorSample(Base):
     __tablename__ = "posterior_sample"
 
@@ -75,12 +152,31 @@ class PosteriorSample(Base):
     run: Run = relationship("Run", back_populates = "posterior_sample")
 
 
-def create_run(run: data.Run) -> data.RunWithId:
+class PosteriorSampleColumns(Base):
+    """A whole posterior sample stored in a single row, each column being the
+    raw buffer of a typed array (see `data.POSTERIOR_SAMPLE_DTYPES`). The table
+    `posterior_sample` (one row per point) is only read for runs ingested
+    before this table existed."""
+    __tablename__ = "posterior_sample_columns"
+
+    run_id = Column(Integer, ForeignKey("run.id"), primary_key = True)
+    size = Column(Integer, nullable = False)
+    colony_id = Column(LargeBinary, nullable = False)
+    nest_quality_assessment_error = Column(LargeBinary, nullable = False)
+    percentage_foragers = Column(LargeBinary, nullable = False)
+    number_nests = Column(LargeBinary, nullable = False)
+    exploring_phase = Column(LargeBinary, nullable = False)
+
+    run: Run = relationship("Run", back_populates = "posterior_sample_columns")
+
+
+@timed_db_write
+async def create_run(run: data.Run) -> data.RunWithId:
     logger.info(f"Putting run into db: {run}.")
 
-    with Session(engine) as session:
+    async with new_session() as session:
 
-        code_orm = session.get(Code, run.code.commit_hash)
+        code_orm = await session.get(Code, run.code.commit_hash)
         if not code_orm:
             code_orm = Code(
                 commit_hash = run.code.commit_hash,
@@ -97,7 +193,15 @@ def create_run(run: data.Run) -> data.RunWithId:
             code = code_orm)
         session.add(run_orm)
 
-        session.commit()
+        # Queued in the same transaction, so that no run is left without
+        # anyone to execute it.
+        session.add(RunJob(
+            stage = data.JobStage.SUBMIT, # type: ignore # https://github.com/sqlalchemy/sqlalchemy/issues/6435
+            attempts = 0,
+            next_attempt = time(),
+            run = run_orm))
+
+        await session.commit()
 
         run_id = run_orm.id
 
@@ -109,9 +213,9 @@ def create_run(run: data.Run) -> data.RunWithId:
         return run_with_id
 
 
-def get_run(run_id: int) -> Optional[data.Run]:
-    with Session(engine) as session:
-        run_orm = session.get(Run, run_id)
+async def get_run(run_id: int) -> Optional[data.Run]:
+    async with new_session() as session:
+        run_orm = await session.get(Run, run_id)
 
         if run_orm is None:
             result = None
@@ -121,164 +225,672 @@ def get_run(run_id: int) -> Optional[data.Run]:
     return result
 
 
-def get_all_runs() -> list[data.RunWithId]:
-    with Session(engine) as session:
-        stmt = select(Run).order_by(Run.timestamp.desc())
+async def get_all_runs(
+        limit: Optional[int] = None,
+        after: Optional[Tuple[float, int]] = None,
+        branch: Optional[str] = None,
+        commit_hash: Optional[str] = None,
+        state: Optional[data.RunState] = None,
+        changed_since: Optional[float] = None) -> list[data.RunWithId]:
+    """The runs, most recent first (by timestamp, then by id), at most `limit`
+    of them. With `after`, the `(timestamp, id)` of a run, only the runs that
+    come after it are returned, which is how the list is paginated. The other
+    arguments filter the runs: `changed_since` keeps the runs created or whose
+    state changed after that time."""
+    stmt = all_runs_query(limit, after, branch, commit_hash, state, changed_since)
 
-        runs = [data.RunWithId.from_orm(r) for r in session.execute(stmt).scalars()]
+    async with new_session() as session:
+        runs = [data.RunWithId.from_orm(r) for r in (await session.execute(stmt)).scalars()]
 
     return runs
 
 
-def put_logs(run_id: int, logs: data.Logs) -> None:
+def all_runs_query(
+        limit: Optional[int] = None,
+        after: Optional[Tuple[float, int]] = None,
+        branch: Optional[str] = None,
+        commit_hash: Optional[str] = None,
+        state: Optional[data.RunState] = None,
+        changed_since: Optional[float] = None) -> Select:
+    stmt = select(Run).join(Run.code).options(contains_eager(Run.code))
+
+    if after is not None:
+        after_timestamp, after_id = after
+        stmt = stmt.where(tuple_(Run.timestamp, Run.id) < tuple_(after_timestamp, after_id))
+    if branch is not None:
+        stmt = stmt.where(Code.branch == branch)
+    if commit_hash is not None:
+        stmt = stmt.where(Run.code_id == commit_hash)
+    if state is not None:
+        stmt = stmt.where(Run.state == state)
+    if changed_since is not None:
+        stmt = stmt.where(Run.changed > changed_since)
+
+    stmt = stmt.order_by(Run.timestamp.desc(), Run.id.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    return stmt
+
+
+@timed_db_write
+async def put_logs(run_id: int, logs: data.Logs) -> None:
     logger.info("Putting logs into db")
 
-    with Session(engine) as session:
+    async with new_session() as session:
 
-        run_orm = session.get(Run, run_id)
+        run_orm = await session.get(Run, run_id)
         if not run_orm:
             raise RuntimeError(f"Run {run_id} not found in the database while trying to put related logs.")
 
-        for _, context, log_list in logs.items():
-            for log in log_list:
-                logs_orm = Log(
-                    context = context,
-                    timestamp = log.timestamp,
-                    stdout = log.stdout,
-                    stderr = log.stderr,
-                    run = run_orm)
-                session.add(logs_orm)
+        await put_log_rows(session, log_rows(run_id, logs))
 
-        session.commit()
+        await notify(session, run_id, "logs")
+        await session.commit()
 
 
-def get_logs(run_id: int, from_time: Optional[float] = None) -> data.Logs:
-    if from_time is None:
-        stmt = select(Log).where(Log.run_id == run_id)
-    else:
-        stmt = select(Log) \
-            .where(Log.run_id == run_id, Log.timestamp > from_time) \
-            .order_by(Log.timestamp)
+# Texts shorter than this are stored as they are: compressing them would not
+# save much.
+LOG_COMPRESS_MIN_SIZE = 256
+
 
-    log_list: list[Tuple[data.Run, str, data.Log]] = []
-    with Session(engine) as session:
-        for l in session.execute(stmt).scalars():
-            run = data.Run.from_orm(l.run)
-            context = l.context
-            log = data.Log(timestamp = l.timestamp, stdout = l.stdout,
-                    stderr = l.stderr)
-            log_list.append((run, context, log))
+def compress_text(text: str) -> Tuple[str, Optional[bytes]]:
+    """The values of a text column and of its zlib column."""
+    if len(text) < LOG_COMPRESS_MIN_SIZE:
+        return text, None
+    else:
+        return "", zlib.compress(text.encode("utf-8"))
 
-    result = data.Logs.new(*log_list)
 
-    return result
+def decompress_text(text: Optional[str], compressed: Optional[bytes]) -> str:
+    if compressed is not None:
+        return zlib.decompress(compressed).decode("utf-8")
+    else:
+        return text or ""
+
+
+def log_rows(run_id: int, logs: data.Logs) -> list[dict]:
+    return [{"run_id": run_id,
+            "context": context,
+            "timestamp": log.timestamp,
+            "stdout": log.stdout,
+            "stderr": log.stderr,
+            "last_timestamp": log.last_timestamp,
+            "repeat": log.repeat}
+        for _, context, log_list in logs.items()
+        for log in log_list]
+
+
+def same_text(row: dict, other: dict) -> bool:
+    return row["stdout"] == other["stdout"] and row["stderr"] == other["stderr"]
+
+
+def repeat_row(row: dict, repeated: dict) -> None:
+    """Count `repeated`, a later entry with the same text, in `row`."""
+    row["last_timestamp"] = max(row["last_timestamp"] or row["timestamp"],
+            repeated["last_timestamp"] or repeated["timestamp"])
+    row["repeat"] += repeated["repeat"]
+
+
+async def last_log_rows(session: AsyncSession, keys: list[Tuple[int, str]]
+        ) -> dict[Tuple[int, str], dict]:
+    """The last stored row of each `(run_id, context)` of `keys` that has one,
+    read with a single query."""
+    if len(keys) == 0:
+        return {}
+
+    ranked = select(Log.id, Log.run_id, Log.context, Log.timestamp, Log.stdout,
+            Log.stderr, Log.stdout_zlib, Log.stderr_zlib, Log.last_timestamp, Log.repeat,
+            func.row_number().over(partition_by = (Log.run_id, Log.context),
+                order_by = (Log.timestamp.desc(), Log.id.desc())).label("rank")) \
+        .where(tuple_(Log.run_id, Log.context).in_(keys)) \
+        .subquery()
+    stmt = select(ranked).where(ranked.c.rank == 1)
+
+    last = {}
+    for row in (await session.execute(stmt)).all():
+        last[(row.run_id, row.context)] = {
+            "id": row.id,
+            "timestamp": row.timestamp,
+            "stdout": decompress_text(row.stdout, row.stdout_zlib),
+            "stderr": decompress_text(row.stderr, row.stderr_zlib),
+            "last_timestamp": row.last_timestamp,
+            "repeat": row.repeat}
+    return last
+
+
+async def put_log_rows(session: AsyncSession, rows: list[dict],
+        previous: Optional[dict[Tuple[int, str], dict]] = None) -> None:
+    """Store the log rows (see `log_rows`). A progress entry (see
+    `data.PROGRESS_CONTEXT`) with the same text as the previous one of its
+    run, the progress of a job that did not change between two polls, is only
+    counted in that one (see `data.Log`), whose timestamp is left as it was.
+    The new rows are inserted with a single statement executed for all of
+    them, which the driver sends in one batch, rather than one ORM object
+    each. `previous` has the last rows of the runs (see `last_log_rows`) if
+    they were read already, and is kept up to date."""
+    # The previous progress row of each run: the last stored one, then the
+    # last new one.
+    if previous is None:
+        previous = await last_log_rows(session, list({(row["run_id"], row["context"])
+            for row in rows if row["context"] == data.PROGRESS_CONTEXT}))
+    new_rows = []
+    # Stored rows counting new entries, by id.
+    repeated: dict[int, dict] = {}
+
+    for row in rows:
+        key = (row["run_id"], row["context"])
+        last = previous.get(key) if row["context"] == data.PROGRESS_CONTEXT else None
+        if last is not None and same_text(last, row):
+            repeat_row(last, row)
+            if "id" in last:
+                repeated[last["id"]] = last
+        else:
+            new_row = dict(row)
+            new_rows.append(new_row)
+            previous[key] = new_row
+
+    for log_id, last in repeated.items():
+        await session.execute(update(Log).where(Log.id == log_id).values(
+            last_timestamp = last["last_timestamp"],
+            repeat = last["repeat"]))
+
+    if len(new_rows) > 0:
+        await session.execute(insert(Log), [compressed_row(r) for r in new_rows])
+
+
+def compressed_row(row: dict) -> dict:
+    stdout, stdout_zlib = compress_text(row["stdout"])
+    stderr, stderr_zlib = compress_text(row["stderr"])
+    return {**row, "stdout": stdout, "stderr": stderr,
+            "stdout_zlib": stdout_zlib, "stderr_zlib": stderr_zlib}
+
+
+async def get_logs(run_id: int, from_time: Optional[float] = None) -> data.Logs:
+    """The logs of the run, optionally only those after `from_time`, in
+    chronological order within each context. A repeated entry is ordered by
+    its first occurrence."""
+    logs, _ = await get_logs_after(run_id, (from_time, None) if from_time is not None else None)
+    return logs
+
+
+async def get_logs_after(run_id: int, after: Optional[Tuple[float, Optional[int]]] = None
+        ) -> Tuple[data.Logs, Optional[Tuple[float, int]]]:
+    """The logs of the run as `get_logs`, with the `(timestamp, id)` of the
+    last entry returned, or None if there is none. With `after`, the
+    `(timestamp, id)` of an entry, only the entries that come after it are
+    returned, so that an entry with the same timestamp as the last one read is
+    not missed. An id of None only keeps the entries after the timestamp."""
+    stmt = logs_query(run_id, after)
+
+    async with new_session() as session:
+        rows = (await session.execute(stmt)).all()
+
+        if len(rows) == 0:
+            return data.Logs.empty(), None
+
+        run_orm = await session.get(Run, run_id)
+        run = data.Run.from_orm(run_orm)
+
+    logs = data.LogsBuilder()
+    for context, timestamp, stdout, stderr, stdout_zlib, stderr_zlib, last_timestamp, repeat, _ in rows:
+        logs.add(run, context, data.Log(
+            timestamp = timestamp,
+            stdout = decompress_text(stdout, stdout_zlib),
+            stderr = decompress_text(stderr, stderr_zlib),
+            last_timestamp = last_timestamp,
+            repeat = repeat))
+
+    last = rows[-1]
+    return logs.build(), (last.timestamp, last.id)
+
+
+def logs_query(run_id: int, after: Optional[Tuple[float, Optional[int]]] = None) -> Select:
+    stmt = select(Log.context, Log.timestamp, Log.stdout, Log.stderr, Log.stdout_zlib,
+            Log.stderr_zlib, Log.last_timestamp, Log.repeat, Log.id) \
+        .where(Log.run_id == run_id)
+    if after is not None:
+        after_timestamp, after_id = after
+        if after_id is None:
+            stmt = stmt.where(Log.timestamp > after_timestamp)
+        else:
+            # The first condition bounds the scan of the index on the timestamp.
+            stmt = stmt.where(Log.timestamp >= after_timestamp,
+                    tuple_(Log.timestamp, Log.id) > tuple_(after_timestamp, after_id))
+    return stmt.order_by(Log.timestamp, Log.id)
 
 
-def put_run_output(run_id: int, text: data.RunOutput) -> None:
+@timed_db_write
+async def put_run_output(run_id: int, output: data.RunOutput) -> None:
+    """Append `output` to the output of the run. `output.offset` must be the
+    length of the output already stored."""
     logger.info("Putting run output into db.")
 
-    with Session(engine) as session:
+    async with new_session() as session:
 
-        run_orm = session.get(Run, run_id)
+        run_orm = await session.get(Run, run_id)
         if not run_orm:
             raise RuntimeError(f"Run {run_id} not found in the database while trying to put related run outputs.")
 
-        run_output_orm = session.get(RunOutput, run_id)
-        if not run_output_orm:
-            run_output_orm = RunOutput(
-                    text = text.text,
-                    run = run_orm)
-        else:
-            run_output_orm.text = text.text
+        if len(output.text) > 0:
+            await put_output_chunk(session, run_id, output)
+            await notify(session, run_id, "output")
 
-        session.add(run_output_orm)
-        session.commit()
+        await session.commit()
 
 
-def get_run_output(run_id: int) -> Optional[data.RunOutput]:
-    logger.info("Putting run output into db.")
+async def put_output_chunk(session: AsyncSession, run_id: int, output: data.RunOutput) -> None:
+    """Store `output` as a chunk of the output of the run. A chunk already
+    stored at the same offset, by an attempt that failed after writing it, is
+    kept."""
+    await session.execute(pg_insert(RunOutputChunk)
+            .values(run_id = run_id, offset = output.offset, text = output.text)
+            .on_conflict_do_nothing())
+
 
-    with Session(engine) as session:
+async def get_run_output(run_id: int, from_offset: int = 0) -> Optional[data.RunOutput]:
+    """The output of the run from `from_offset` characters on, or None if the
+    run does not exist."""
+    logger.info("Retrieving run output from db.")
 
-        run_orm = session.get(RunOutput, run_id)
+    async with new_session() as session:
+
+        run_orm = await session.get(Run, run_id)
         if run_orm is None:
-            result = None
-        else:
-            result =  data.RunOutput.from_orm(run_orm)
+            return None
+
+        chunks = (await session.execute(run_output_query(run_id, from_offset))).all()
+
+        if len(chunks) == 0:
+            # Runs started before output chunks were introduced.
+            legacy_orm = await session.get(RunOutput, run_id)
+            text = (legacy_orm.text or "")[from_offset:] if legacy_orm is not None else ""
+            return data.RunOutput(text = text, offset = from_offset)
+
+    first_offset = chunks[0].offset
+    text = "".join(c.text for c in chunks)
+
+    if from_offset > first_offset:
+        return data.RunOutput(text = text[from_offset - first_offset:], offset = from_offset)
+    else:
+        return data.RunOutput(text = text, offset = first_offset)
 
-    return result
 
+def run_output_query(run_id: int, from_offset: int = 0) -> Select:
+    return select(RunOutputChunk.offset, RunOutputChunk.text) \
+        .where(RunOutputChunk.run_id == run_id,
+                RunOutputChunk.offset + func.length(RunOutputChunk.text) > from_offset) \
+        .order_by(RunOutputChunk.offset)
 
-def put_run_state(run_id: int, run_state: data.RunState) -> None:
+
+async def get_run_output_length(run_id: int) -> int:
+    """Length of the output of the run stored so far."""
+    async with new_session() as session:
+        length = (await session.execute(
+            select(func.max(RunOutputChunk.offset + func.length(RunOutputChunk.text)))
+            .where(RunOutputChunk.run_id == run_id))).scalar()
+    return length or 0
+
+
+@timed_db_write
+async def put_run_state(run_id: int, run_state: data.RunState) -> None:
     logger.info(f"Putting run state into db: \n{run_state}")
 
-    with Session(engine) as session:
+    async with new_session() as session:
 
-        run_orm = session.get(Run, run_id)
+        run_orm = await session.get(Run, run_id)
         if not run_orm:
             raise RuntimeError(f"Run {run_id} not found in the database while trying to put a new state.")
         else:
-            run_orm.state = run_state.name  # The enum setter requires a string
+            run_orm.state = run_state.name  # type: ignore[assignment] # The enum setter requires a string
+
+        await notify(session, run_id, "state")
+        await session.commit()
+
+
+@timed_db_write
+async def put_run_updates(updates: list[Tuple[int, Optional[data.RunState], data.Logs, data.RunOutput]]
+        ) -> dict[int, Exception]:
+    """For each `(run_id, run_state, logs, run_output)`, set the state of the
+    run (unless it is None), add the logs and append the output (see
+    `put_run_output`), all in a single transaction. The updates of each run
+    are written in a savepoint: the runs whose updates fail are returned with
+    their error, and the others are written all the same."""
+    if len(updates) == 0:
+        return {}
 
-        session.commit()
+    logger.info(f"Putting updates of {len(updates)} runs into db.")
 
+    run_ids = [run_id for run_id, _, _, _ in updates]
+    failed: dict[int, Exception] = {}
 
-def put_posterior_sample(run_id: int, results: data.PosteriorSample) -> None:
+    async with new_session() as session:
+
+        runs = {r.id: r for r in (await session.execute(
+            select(Run).where(Run.id.in_(run_ids)))).scalars()}
+        last_progress = await last_log_rows(session,
+                [(run_id, data.PROGRESS_CONTEXT) for run_id in run_ids])
+
+        for run_id, run_state, logs, run_output in updates:
+            try:
+                async with session.begin_nested():
+                    await put_run_update(session, runs.get(run_id), last_progress,
+                            run_id, run_state, logs, run_output)
+            except Exception as e:
+                logger.error(f"Could not put the updates of run {run_id} into db: {e!r}")
+                failed[run_id] = e
+
+        await session.commit()
+
+    return failed
+
+
+async def put_run_update(session: AsyncSession, run_orm: Optional[Run],
+        last_progress: dict[Tuple[int, str], dict], run_id: int,
+        run_state: Optional[data.RunState], logs: data.Logs, run_output: data.RunOutput) -> None:
+    if run_orm is None:
+        raise RuntimeError(f"Run {run_id} not found in the database while trying to put updates.")
+
+    if run_state is not None:
+        run_orm.state = run_state.name  # type: ignore[assignment] # The enum setter requires a string
+        await notify(session, run_id, "state")
+
+    if not logs.is_empty():
+        await notify(session, run_id, "logs")
+
+    await put_log_rows(session, log_rows(run_id, logs), last_progress)
+
+    if len(run_output.text) > 0:
+        await put_output_chunk(session, run_id, run_output)
+        await notify(session, run_id, "output")
+
+    # Written now, so that a failure is one of this run.
+    await session.flush()
+
+
+@timed_db_write
+async def put_posterior_sample(run_id: int, results: data.PosteriorSampleColumns) -> None:
     logger.info(f"Putting ABC results into db.")
 
-    with Session(engine) as session:
+    async with new_session() as session:
 
-        run_orm = session.get(Run, run_id)
+        run_orm = await session.get(Run, run_id)
         if not run_orm:
             raise RuntimeError(f"Run {run_id} not found in the database while trying to put a posterior sample.")
 
-        for point in results.data:
-            p = PosteriorSample(
-                colony_id = point.colony_id,
-                nest_quality_assessment_error = point.nest_quality_assessment_error,
-                percentage_foragers = point.percentage_foragers,
-                number_nests = point.number_nests,
-                exploring_phase = point.exploring_phase,
-                run = run_orm)
-            session.add(p)
+        await session.merge(PosteriorSampleColumns(
+            run_id = run_id,
+            size = len(results),
+            **results.to_buffers()))
 
-        session.commit()
+        await notify(session, run_id, "results")
+        await session.commit()
 
 
-def get_posterior_sample(run_id: int) -> Optional[data.PosteriorSample]:
+async def has_posterior_sample(run_id: int) -> bool:
+    async with new_session() as session:
+        stmt = select(PosteriorSampleColumns.run_id) \
+            .where(PosteriorSampleColumns.run_id == run_id)
+        if (await session.execute(stmt)).first() is not None:
+            return True
+
+        stmt = select(PosteriorSample.id) \
+            .where(PosteriorSample.run_id == run_id).limit(1)
+        return (await session.execute(stmt)).first() is not None
+
+
+async def get_posterior_sample_columns(run_id: int) -> Optional[data.PosteriorSampleColumns]:
     logger.info(f"Retrieving posterior sample for run \n{run_id}.")
 
-    with Session(engine) as session:
-        run = session.get(Run, run_id)
+    async with new_session() as session:
+        run = await session.get(Run, run_id)
         if run is None:
-            result = None
-        else:
-            stmt = select(PosteriorSample).where(PosteriorSample.run_id == run_id)
-            result = data.PosteriorSample(
-                    data = [data.PosteriorSamplePoint(
-                             colony_id = x.colony_id,
-                             nest_quality_assessment_error = x.nest_quality_assessment_error,
-                             percentage_foragers = x.percentage_foragers,
-                             number_nests = x.number_nests,
-                             exploring_phase = x.exploring_phase)
-                            for x in session.execute(stmt).scalars()])
+            return None
+
+        columns_orm = await session.get(PosteriorSampleColumns, run_id)
+        if columns_orm is not None:
+            return data.PosteriorSampleColumns.from_buffers(
+                    columns_orm.size or 0,
+                    {name: getattr(columns_orm, name)
+                        for name in data.POSTERIOR_SAMPLE_DTYPES})
+
+        # Runs ingested before the columnar table was introduced.
+        rows = (await session.execute(posterior_sample_query(run_id))).all()
+
+    if len(rows) == 0:
+        return data.PosteriorSampleColumns.empty()
+    else:
+        colony_id, error, foragers, nests, exploring = map(np.array, zip(*rows))
+        return data.PosteriorSampleColumns(
+                colony_id = colony_id,
+                nest_quality_assessment_error = error,
+                percentage_foragers = foragers,
+                number_nests = nests,
+                exploring_phase = exploring)
+
+
+def posterior_sample_query(run_id: int) -> Select:
+    return select(*[getattr(PosteriorSample, name)
+                for name in data.POSTERIOR_SAMPLE_DTYPES]) \
+            .where(PosteriorSample.run_id == run_id)
 
-    return result
 
-def delete_run(run_id: int) -> None:
+async def get_posterior_sample(run_id: int) -> Optional[data.PosteriorSample]:
+    columns = await get_posterior_sample_columns(run_id)
+
+    if columns is None:
+        return None
+    else:
+        return columns.to_sample()
+
+def run_job_from_orm(job_orm: RunJob) -> data.RunJob:
+    # Both columns are non nullable, only the ORM typing leaves them optional.
+    assert job_orm.stage is not None and job_orm.attempts is not None
+    return data.RunJob(
+            run = data.RunWithId.from_orm(job_orm.run),
+            stage = job_orm.stage,
+            attempts = job_orm.attempts,
+            om_run_id = job_orm.run.om_run_id)
+
+
+async def lease_jobs(owner: str, limit: int, lease_duration: float,
+        exclude: Sequence[int] = ()) -> list[data.RunJob]:
+    """Lease at most `limit` jobs that are due and not leased by another
+    worker, for `lease_duration` seconds, except those of the runs in
+    `exclude`. Concurrent workers never lease the same job: rows locked by
+    another transaction are skipped."""
+    now = time()
+
+    async with new_session() as session:
+        stmt = select(RunJob) \
+            .where(RunJob.next_attempt <= now,
+                    or_(RunJob.lease_expires.is_(None), RunJob.lease_expires < now),
+                    RunJob.run_id.not_in(exclude)) \
+            .order_by(RunJob.next_attempt) \
+            .limit(limit) \
+            .with_for_update(skip_locked = True) \
+            .options(selectinload(RunJob.run))
+
+        jobs_orm = (await session.execute(stmt)).scalars().all()
+
+        for job_orm in jobs_orm:
+            job_orm.lease_owner = owner
+            job_orm.lease_expires = now + lease_duration  # type: ignore[assignment] # https://github.com/sqlalchemy/sqlalchemy/issues/6435
+
+        await session.commit()
+
+        return [run_job_from_orm(j) for j in jobs_orm]
+
+
+async def renew_leases(owner: str, run_ids: list[int], lease_duration: float) -> None:
+    if len(run_ids) == 0:
+        return
+
+    async with new_session() as session:
+        await session.execute(update(RunJob)
+            .where(RunJob.run_id.in_(run_ids), RunJob.lease_owner == owner)
+            .values(lease_expires = time() + lease_duration))
+        await session.commit()
+
+
+async def release_leases(owner: str) -> None:
+    """Give up the jobs leased by `owner`, for other workers to resume them
+    right away."""
+    async with new_session() as session:
+        await session.execute(update(RunJob)
+            .where(RunJob.lease_owner == owner)
+            .values(lease_owner = None, lease_expires = None))
+        await session.commit()
+
+
+@timed_db_write
+async def put_job_stage(run_id: int, owner: str, stage: data.JobStage,
+        om_run_id: Optional[str] = None) -> bool:
+    """Move the job to `stage`, with no failed attempt, and store the id of its
+    OpenMOLE job if given. Returns False, changing nothing, if the job is not
+    leased by `owner` anymore."""
+    async with new_session() as session:
+        job_orm = await session.get(RunJob, run_id)
+        if job_orm is None or job_orm.lease_owner != owner:
+            return False
+
+        job_orm.stage = stage.name  # type: ignore[assignment] # The enum setter requires a string
+        job_orm.attempts = 0
+        job_orm.last_error = None
+        if om_run_id is not None:
+            run_orm = await session.get(Run, run_id)
+            if run_orm is not None:
+                run_orm.om_run_id = om_run_id
+
+        await session.commit()
+
+    return True
+
+
+@timed_db_write
+async def retry_job(run_id: int, owner: str, error: str,
+        retry_delay: Callable[[int], Optional[float]]) -> bool:
+    """Record a failed attempt at the current stage of the job and release it
+    until `retry_delay(attempts)` seconds from now, `attempts` counting this
+    one. Returns False if the job should not be retried (`retry_delay` returned
+    None), in which case it stays leased."""
+    async with new_session() as session:
+        job_orm = await session.get(RunJob, run_id)
+        if job_orm is None or job_orm.lease_owner != owner:
+            return True
+
+        job_orm.attempts = (job_orm.attempts or 0) + 1
+        job_orm.last_error = error
+
+        delay = retry_delay(job_orm.attempts)
+        if delay is not None:
+            job_orm.next_attempt = time() + delay  # type: ignore[assignment] # https://github.com/sqlalchemy/sqlalchemy/issues/6435
+            job_orm.lease_owner = None
+            job_orm.lease_expires = None
+
+        await session.commit()
+
+    return delay is not None
+
+
+@timed_db_write
+async def finish_job(run_id: int, owner: str) -> None:
+    async with new_session() as session:
+        await session.execute(delete(RunJob)
+            .where(RunJob.run_id == run_id, RunJob.lease_owner == owner))
+        await session.commit()
+
+
+async def delete_jobs(run_ids: Sequence[int]) -> None:
+    """Take the runs out of the queue, whichever worker leases them."""
+    async with new_session() as session:
+        await session.execute(delete(RunJob).where(RunJob.run_id.in_(run_ids)))
+        await session.commit()
+
+
+@timed_db_write
+async def put_span(run_id: int, span: data.Span) -> None:
+    async with new_session() as session:
+        session.add(RunSpan(run_id = run_id, name = span.name, start = span.start,
+            end = span.end))
+        await session.commit()
+
+
+async def get_spans(run_id: int) -> list[data.Span]:
+    """The spans of the run, in the order they started."""
+    async with new_session() as session:
+        spans = (await session.execute(spans_query(run_id))).scalars()
+        return [data.Span.from_orm(s) for s in spans]
+
+
+def spans_query(run_id: int) -> Select:
+    return select(RunSpan).where(RunSpan.run_id == run_id) \
+            .order_by(RunSpan.start, RunSpan.id)
+
+
+async def get_recent_spans(limit: int) -> dict[int, list[data.Span]]:
+    """The spans of the `limit` most recently created runs that have any, by
+    run id."""
+    recent_runs = select(RunSpan.run_id).group_by(RunSpan.run_id) \
+            .order_by(RunSpan.run_id.desc()).limit(limit)
+
+    async with new_session() as session:
+        spans = (await session.execute(select(RunSpan)
+            .where(RunSpan.run_id.in_(recent_runs.scalar_subquery()))
+            .order_by(RunSpan.run_id, RunSpan.start, RunSpan.id))).scalars()
+
+        spans_by_run: dict[int, list[data.Span]] = {}
+        for s in spans:
+            spans_by_run.setdefault(s.run_id or 0, []).append(data.Span.from_orm(s))
+        return spans_by_run
+
+
+@timed_db_write
+async def delete_run(run_id: int) -> None:
     logger.info(f"Deleting run {run_id}.")
 
-    with Session(engine) as session:
-        run_orm = session.get(Run, run_id)
-        session.delete(run_orm)
-        session.commit()
+    async with new_session() as session:
+        run_orm = await session.get(Run, run_id)
+        await session.delete(run_orm)
+        await session.commit()
+
+
+# Changes to a run are announced on this PostgreSQL channel with payloads
+# `<run id>:<kind>`, kind being one of "state", "logs", "output" or "results".
+# The notifications are sent when the transaction commits. See `src.events`.
+NOTIFY_CHANNEL = "run_events"
+
+
+async def notify(session: AsyncSession, run_id: int, kind: str) -> None:
+    await session.execute(select(func.pg_notify(NOTIFY_CHANNEL, f"{run_id}:{kind}")))
+
+
+async def init() -> None:
+    """Create the missing tables and bring the schema up to date (see
+    `src.migrations`). Must be awaited before any other function of this
+    module is used."""
+    await migrations.migrate(engine, Base.metadata)
 
 
 # TODO: wait if postgresql not available yet
-engine = create_engine(
-        f"postgresql+psycopg2://{DB_USER}:{urllib.parse.quote_plus(DB_PASSWORD)}@{DB_HOST}:{DB_PORT}/postgres",
+engine = create_async_engine(
+        f"postgresql+asyncpg://{DB_USER}:{urllib.parse.quote_plus(DB_PASSWORD)}@{DB_HOST}:{DB_PORT}/postgres",
         echo = False,
-        future = True)
+        future = True,
+        pool_size = DB_POOL_SIZE,
+        max_overflow = DB_MAX_OVERFLOW,
+        pool_pre_ping = True)
+
+def new_session() -> AsyncSession:
+    # `expire_on_commit` is disabled so that ORM objects can still be converted
+    # to pydantic models after a commit without triggering new queries.
+    return AsyncSession(engine, expire_on_commit = False)
+
+
+def pool_checked_out() -> int:
+    pool = engine.sync_engine.pool
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
 
-Base.metadata.create_all(engine)
+DB_POOL_CHECKED_OUT.set_function(pool_checked_out)
 
@@ -0,0 +1,210 @@
+import asyncpg
+import json
+from asyncio import CancelledError, Queue, QueueEmpty, Task, TimeoutError, create_task, \
+        sleep, wait_for
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, Tuple
+from src.data import RunState
+from src.constants import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD
+from src import db
+from src.util import logger
+
+# Changes to runs are pushed to the clients as server-sent events. The db
+# functions that change a run send a PostgreSQL notification (see
+# `db.NOTIFY_CHANNEL`), which reaches every backend worker whatever the worker
+# that wrote the change. Each worker listens to the channel on a dedicated
+# connection and wakes up the streams of the corresponding run, which then
+# read what is new from the database. Nothing is read while nothing changes.
+#
+# When the listening connection is lost, the worker connects again, and the
+# streams read everything that changed meanwhile. Until then, they read the
+# database at each keep-alive instead of waiting for notifications.
+
+# Seconds between two keep-alive comments on an idle stream.
+KEEPALIVE_INTERVAL = 15
+
+# Seconds between two attempts to connect the listener again.
+RECONNECT_DELAY = 5
+
+# The kinds of changes to a run.
+KINDS = frozenset({"state", "logs", "output", "results"})
+
+# None while the listener is not connected.
+listener: Optional[asyncpg.Connection] = None
+
+reconnect_task: Optional[Task] = None
+
+# A stream cursor: the (timestamp, id) of the last log entry sent, and the end
+# of the output sent.
+Cursor = Tuple[float, Optional[int], int]
+
+# Queues of the streams currently open, by run id. Each receives the kinds of
+# the changes to the run.
+subscribers: defaultdict[int, set["Queue[str]"]] = defaultdict(set)
+
+
+async def init() -> None:
+    """Start listening to run notifications. Must be awaited before any stream
+    is opened."""
+    await connect()
+
+
+async def close() -> None:
+    global listener
+    if reconnect_task is not None:
+        reconnect_task.cancel()
+        try:
+            await reconnect_task
+        except CancelledError:
+            pass
+    if listener is not None:
+        connection, listener = listener, None
+        connection.remove_termination_listener(on_termination)
+        await connection.close()
+
+
+async def connect() -> None:
+    global listener
+    connection = await asyncpg.connect(host = DB_HOST, port = DB_PORT,
+            user = DB_USER, password = DB_PASSWORD, database = "postgres")
+    await connection.add_listener(db.NOTIFY_CHANNEL, dispatch)
+    connection.add_termination_listener(on_termination)
+    listener = connection
+
+
+def on_termination(connection: asyncpg.Connection) -> None:
+    global listener, reconnect_task
+    logger.error("Lost the connection listening to run notifications, reconnecting.")
+    listener = None
+    reconnect_task = create_task(reconnect())
+
+
+async def reconnect() -> None:
+    while True:
+        await sleep(RECONNECT_DELAY)
+        try:
+            await connect()
+        except Exception as e:
+            logger.error(f"Could not connect the listener of run notifications: {e!r}")
+            continue
+
+        # The notifications sent meanwhile are lost.
+        for queues in subscribers.values():
+            for queue in queues:
+                for kind in KINDS:
+                    queue.put_nowait(kind)
+        return
+
+
+def dispatch(connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+    run_id, kind = payload.split(":")
+    for queue in subscribers.get(int(run_id), ()):
+        queue.put_nowait(kind)
+
+
+@asynccontextmanager
+async def subscribe(run_id: int) -> AsyncIterator["Queue[str]"]:
+    queue: "Queue[str]" = Queue()
+    subscribers[run_id].add(queue)
+    try:
+        yield queue
+    finally:
+        subscribers[run_id].discard(queue)
+        if len(subscribers[run_id]) == 0:
+            del subscribers[run_id]
+
+
+def format_event(event: str, data: object, cursor: Cursor) -> str:
+    """A server-sent event. Its id is the stream cursor, so that a client that
+    reconnects resumes where it was (see `run_event_stream`)."""
+    log_time, log_id, output_end = cursor
+    log_id_str = "" if log_id is None else str(log_id)
+    return f"event: {event}\nid: {log_time}:{log_id_str}:{output_end}\ndata: {json.dumps(data)}\n\n"
+
+
+def parse_cursor(last_event_id: Optional[str]) -> Cursor:
+    """The cursor of an event id. An id of the former "log_time:output_end"
+    format resumes the logs after their timestamp."""
+    try:
+        if last_event_id is not None:
+            parts = last_event_id.split(":")
+            if len(parts) == 2:
+                return float(parts[0]), None, int(parts[1])
+            log_time, log_id, output_end = parts
+            return float(log_time), int(log_id) if log_id else None, int(output_end)
+    except ValueError:
+        pass
+    return 0.0, None, 0
+
+
+async def run_event_stream(run_id: int, last_event_id: Optional[str] = None) -> AsyncIterator[str]:
+    """Server-sent events describing run `run_id` as it changes:
+
+    - "state": the run, whenever its state changes,
+    - "logs": the new logs, as returned by the `/logs` endpoint,
+    - "output": the new output, as returned by the `/output` endpoint,
+    - "results": the posterior sample is available (no data),
+    - "end": nothing will change anymore (no data).
+
+    The stream starts with everything up to now, or everything since
+    `last_event_id` for a client that reconnects."""
+    log_time, log_id, output_end = parse_cursor(last_event_id)
+    state: Optional[RunState] = None
+    results = False
+
+    async with subscribe(run_id) as queue:
+        kinds = set(KINDS)
+
+        while True:
+            if "state" in kinds:
+                run = await db.get_run(run_id)
+                if run is None:
+                    yield format_event("end", None, (log_time, log_id, output_end))
+                    return
+                if run.state != state:
+                    state = run.state
+                    yield format_event("state", json.loads(run.json()),
+                            (log_time, log_id, output_end))
+
+            if "logs" in kinds:
+                logs, last = await db.get_logs_after(run_id,
+                        (log_time, log_id) if log_time > 0 or log_id is not None else None)
+                if last is not None:
+                    log_time, log_id = last
+                    context_dict = next(iter(logs.logs.values()))
+                    yield format_event("logs",
+                            {context: [l.dict() for l in log_list]
+                                for context, log_list in context_dict.items()},
+                            (log_time, log_id, output_end))
+
+            if "output" in kinds:
+                output = await db.get_run_output(run_id, output_end)
+                if output is not None and len(output.text) > 0:
+                    output_end = output.offset + len(output.text)
+                    yield format_event("output", output.dict(), (log_time, log_id, output_end))
+
+            if "results" in kinds and not results:
+                results = await db.has_posterior_sample(run_id)
+                if results:
+                    yield format_event("results", None, (log_time, log_id, output_end))
+
+            if state == RunState.FAILED or (state == RunState.FINISHED and results):
+                yield format_event("end", None, (log_time, log_id, output_end))
+                return
+
+            try:
+                kinds = {await wait_for(queue.get(), KEEPALIVE_INTERVAL)}
+            except TimeoutError:
+                yield ": keep-alive\n\n"
+                # Without a listener, the notifications do not come: read
+                # everything again.
+                kinds = set(KINDS) if listener is None else set()
+                continue
+
+            # Coalesce the notifications received in the meantime.
+            while True:
+                try:
+                    kinds.add(queue.get_nowait())
+                except QueueEmpty:
+                    break
@@ -0,0 +1,90 @@
+from asyncio import CancelledError, Task, create_task, sleep
+from functools import wraps
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Optional, TypeVar, cast
+from prometheus_client import Gauge, Histogram
+
+# Metrics of the backend, served at `/metrics` in the Prometheus text format
+# (see `src.app`):
+#
+# - the duration of each stage of the runs (see `src.timeline`), of each poll
+#   of OpenMOLE and of the parsing of each result file, apart from its wait
+#   for a parsing process,
+# - the duration of the writes to the database,
+# - the latency of the requests, by route,
+# - gauges of the runs being executed and watched, of the connections taken
+#   from the database pool, of the result files waiting to be parsed, and of
+#   the lag of the event loop.
+#
+# Each backend worker process has its own metrics: every worker must be
+# scraped.
+
+# From a few milliseconds (a poll) to hours (the execution of a job).
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+        1800, 3600, 7200, 14400, 43200)
+
+STAGE_SECONDS = Histogram("backend_run_stage_seconds",
+        "Duration of a stage of a run.", ["stage"], buckets = STAGE_BUCKETS)
+
+DB_WRITE_SECONDS = Histogram("backend_db_write_seconds",
+        "Duration of a write to the database.", ["operation"])
+
+REQUEST_SECONDS = Histogram("backend_request_seconds",
+        "Time from a request to the start of its response.",
+        ["method", "route", "status"])
+
+ACTIVE_RUNS = Gauge("backend_active_runs", "Runs executed by this worker.")
+
+WATCHED_RUNS = Gauge("backend_watched_runs", "Runs whose OpenMOLE job is watched.")
+
+DB_POOL_CHECKED_OUT = Gauge("backend_db_pool_checked_out",
+        "Connections taken from the database pool.")
+
+RESULTS_PARSE_PENDING = Gauge("backend_results_parse_pending",
+        "Result files being parsed or waiting for a parsing process.")
+
+EVENT_LOOP_LAG = Gauge("backend_event_loop_lag_seconds",
+        "How late a task woken up every `LAG_INTERVAL` seconds last was.")
+
+# Seconds between two measures of the event loop lag.
+LAG_INTERVAL = 0.5
+
+lag_task: Optional[Task] = None
+
+F = TypeVar("F", bound = Callable[..., Awaitable[Any]])
+
+
+def timed_db_write(f: F) -> F:
+    """Decorate a coroutine function writing to the database, to measure its
+    duration in `DB_WRITE_SECONDS`."""
+    histogram = DB_WRITE_SECONDS.labels(f.__name__)
+
+    @wraps(f)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with histogram.time():
+            return await f(*args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+async def measure_lag() -> None:
+    while True:
+        start = perf_counter()
+        await sleep(LAG_INTERVAL)
+        EVENT_LOOP_LAG.set(max(perf_counter() - start - LAG_INTERVAL, 0))
+
+
+async def start() -> None:
+    """Start measuring the event loop lag. Must be awaited with the application
+    startup."""
+    global lag_task
+    lag_task = create_task(measure_lag())
+
+
+async def stop() -> None:
+    if lag_task is not None:
+        lag_task.cancel()
+        try:
+            await lag_task
+        except CancelledError:
+            pass
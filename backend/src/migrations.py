@@ -0,0 +1,123 @@
+from asyncio import sleep
+from dataclasses import dataclass
+from sqlalchemy import MetaData, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from src.util import logger
+
+# Changes to the schema of the tables declared in `src.db`, applied in order
+# of version by `migrate`. The version of the schema is the highest version in
+# the table `schema_version`.
+#
+# Tables created from scratch by `Base.metadata.create_all` already have the
+# last schema, so every statement must also work on them, i.e. be written with
+# `IF NOT EXISTS` or the like. A migration must not take the tables away from
+# the running backend: columns are added with a constant default (which does
+# not rewrite the table) and indexes are built with `CONCURRENTLY` (which does
+# not block writes).
+
+@dataclass(frozen = True)
+class Migration:
+    version: int
+    description: str
+    statements: list[str]
+    # Statements with `CONCURRENTLY` cannot run inside a transaction: they are
+    # then run one at a time. If one of them fails, it leaves an invalid index
+    # behind, which must be dropped before the migration is retried.
+    concurrently: bool = False
+
+
+MIGRATIONS = [
+    Migration(1, "Time of the last change of each run", [
+        "ALTER TABLE run ADD COLUMN IF NOT EXISTS changed double precision NOT NULL DEFAULT 0",
+    ]),
+    Migration(2, "Indexes of the logs, runs and posterior samples of a run", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_log_run_id_timestamp ON log (run_id, timestamp, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posterior_sample_run_id ON posterior_sample (run_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_run_timestamp_id ON run (timestamp, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_run_changed ON run (changed)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_run_code_id_timestamp_id ON run (code_id, timestamp, id)",
+    ], concurrently = True),
+    Migration(3, "Id of the OpenMOLE job of each run", [
+        "ALTER TABLE run ADD COLUMN IF NOT EXISTS om_run_id varchar",
+    ]),
+    Migration(4, "Index of the spans of a run", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_run_span_run_id_start ON run_span (run_id, start)",
+    ], concurrently = True),
+    Migration(5, "Repeated and compressed logs", [
+        "ALTER TABLE log ADD COLUMN IF NOT EXISTS last_timestamp double precision",
+        "ALTER TABLE log ADD COLUMN IF NOT EXISTS repeat integer NOT NULL DEFAULT 1",
+        "ALTER TABLE log ADD COLUMN IF NOT EXISTS stdout_zlib bytea",
+        "ALTER TABLE log ADD COLUMN IF NOT EXISTS stderr_zlib bytea",
+    ]),
+    Migration(6, "Index of the last log of each context of a run", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_log_run_id_context_timestamp "
+            "ON log (run_id, context, timestamp, id)",
+    ], concurrently = True),
+    Migration(7, "Index of the commits of a branch", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_code_branch_commit_hash ON code (branch, commit_hash)",
+    ], concurrently = True),
+]
+
+# Held while creating the tables and migrating, so that backend workers
+# started together do it one after the other. The value is arbitrary.
+MIGRATION_LOCK_ID = 7254301
+
+# Seconds between two attempts to take the lock. A worker waits for the lock
+# between statements rather than in one: a waiting statement would hold a
+# snapshot, which `CREATE INDEX CONCURRENTLY` waits for.
+MIGRATION_LOCK_RETRY_DELAY = 0.5
+
+
+async def schema_version(conn: AsyncConnection) -> int:
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version integer PRIMARY KEY, "
+        "description varchar NOT NULL, "
+        "applied timestamp with time zone NOT NULL DEFAULT now())"))
+    version = (await conn.execute(text(
+        "SELECT coalesce(max(version), 0) FROM schema_version"))).scalar()
+    return version or 0
+
+
+async def record(conn: AsyncConnection, migration: Migration) -> None:
+    await conn.execute(
+        text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+        {"version": migration.version, "description": migration.description})
+
+
+async def apply(engine: AsyncEngine, autocommit_conn: AsyncConnection,
+        migration: Migration) -> None:
+    logger.info(f"Migrating the database to version {migration.version}: {migration.description}.")
+
+    if migration.concurrently:
+        for statement in migration.statements:
+            await autocommit_conn.execute(text(statement))
+        await record(autocommit_conn, migration)
+    else:
+        async with engine.begin() as conn:
+            for statement in migration.statements:
+                await conn.execute(text(statement))
+            await record(conn, migration)
+
+
+async def migrate(engine: AsyncEngine, metadata: MetaData) -> None:
+    """Create the missing tables of `metadata`, then apply the migrations that
+    are more recent than the schema of the database."""
+    async with engine.connect() as conn:
+        # Each statement commits on its own.
+        autocommit_conn = await conn.execution_options(isolation_level = "AUTOCOMMIT")
+
+        while not (await autocommit_conn.execute(text("SELECT pg_try_advisory_lock(:id)"),
+                {"id": MIGRATION_LOCK_ID})).scalar():
+            await sleep(MIGRATION_LOCK_RETRY_DELAY)
+        try:
+            async with engine.begin() as tables_conn:
+                await tables_conn.run_sync(metadata.create_all)
+
+            version = await schema_version(autocommit_conn)
+            for migration in MIGRATIONS:
+                if migration.version > version:
+                    await apply(engine, autocommit_conn, migration)
+        finally:
+            await autocommit_conn.execute(text("SELECT pg_advisory_unlock(:id)"),
+                    {"id": MIGRATION_LOCK_ID})
@@ -1,34 +1,99 @@
 import gzip
+import multiprocessing
 from aiofiles import open
-from asyncio import gather
+from asyncio import CancelledError, create_task, gather, get_running_loop, sleep
+from concurrent.futures import ProcessPoolExecutor
 from pydantic import BaseModel
-from typing import AsyncIterator, Tuple, Optional, TextIO
-from src.data import Code, RunState, Logs, Log, Run, PosteriorSample, Colony, \
-        list_colonies, RunOutput, log_now
-from httpx import AsyncClient
+from typing import AsyncIterator, Awaitable, Callable, Tuple, Optional, TextIO
+from src.data import Code, RunState, Logs, LogsBuilder, Log, Run, PosteriorSample, Colony, \
+        list_colonies, RunOutput, log_now, PosteriorSampleColumns, JobProgress, PROGRESS_CONTEXT
+from httpx import AsyncClient, Limits
 from src.repository import pack
 from src.constants import *
+from src.metrics import STAGE_SECONDS, RESULTS_PARSE_PENDING
+from src import timeline
 from src.util import logger
 from os import path
-from io import BytesIO
-
-async def send_job(repository_path: str, run: Run) -> Tuple[Logs, Optional["RunId"]]:
-    pack_log, archive = await pack(repository_path, run)
-
-    if archive is None:
-        return pack_log, None
-
-    else:
-        async with AsyncClient() as client:
-            async with open(archive, "rb") as f:
-                content = await f.read()
+from uuid import uuid4
+from time import perf_counter
+
+# Size of the chunks read from the archive while it is uploaded. This bounds
+# the memory used by each upload.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Seconds between two progress logs of an upload.
+UPLOAD_PROGRESS_INTERVAL = 2
+
+
+# Shared by all requests to OpenMOLE so that connections are kept alive between
+# polls. Opened by `init`.
+client: AsyncClient
+
+# Decompresses and parses the results, which would otherwise hold the event
+# loop (see `parse_results`). Started by `init`.
+results_pool: ProcessPoolExecutor
+
+
+async def init() -> None:
+    """Open the HTTP client used to talk to OpenMOLE and start the pool parsing
+    the results. Must be awaited before any other function of this module is
+    used."""
+    global client, results_pool
+    client = AsyncClient(limits = Limits(
+        max_connections = OPENMOLE_MAX_CONNECTIONS,
+        max_keepalive_connections = OPENMOLE_MAX_KEEPALIVE_CONNECTIONS))
+    # Forking a process running an event loop, threads and open connections
+    # copies them in a state they cannot be used from: the parsing processes
+    # are started afresh.
+    results_pool = ProcessPoolExecutor(max_workers = RESULTS_PARSE_WORKERS,
+            mp_context = multiprocessing.get_context("spawn"))
+
+
+async def close() -> None:
+    await client.aclose()
+    results_pool.shutdown(cancel_futures = True)
+
+
+async def send_job(repository_path: str, run: Run,
+        on_progress: Optional[Callable[[Logs], Awaitable[None]]] = None
+        ) -> Tuple[Logs, Optional["RunId"]]:
+    """Pack the run job directory and send it to OpenMOLE. The archive is
+    streamed from disk. Upload progress logs are passed to `on_progress` as
+    the upload goes, from a separate task so that a slow or failing
+    `on_progress` does not hold the upload."""
+    async with pack(repository_path, run) as (pack_log, archive):
+        if archive is None:
+            return pack_log, None
+
+        boundary = uuid4().hex
+        head, tail = multipart_envelope(boundary,
+                fields = {'script': path.join(run.job_dir, run.script)},
+                file_field = 'workDirectory',
+                filename = path.basename(archive))
+        progress = UploadProgress(path.getsize(archive))
+
+        reporter = create_task(report_upload_progress(run, progress, on_progress)) \
+                if on_progress is not None else None
+        try:
+            async with timeline.span("upload"):
                 response = await client.post(f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job",
-                        files = {
-                            'workDirectory': content,
+                        content = upload_stream(archive, head, tail, progress),
+                        headers = {
+                            'Content-Type': f"multipart/form-data; boundary={boundary}",
+                            'Content-Length': str(len(head) + progress.size + len(tail)),
                         },
-                        data = {'script': path.join(run.job_dir, run.script)},
                         timeout = OPENMOLE_SEND_JOB_TIMEOUT,
                         auth=("", OPENMOLE_PASSWORD))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+                try:
+                    await reporter
+                except CancelledError:
+                    pass
+
+        if on_progress is not None:
+            await put_upload_progress(run, progress, on_progress)
 
         logger.info(f"send_job query: {response.text}")
 
@@ -44,32 +109,95 @@ async def send_job(repository_path: str, run: Run) -> Tuple[Logs, Optional["RunI
             if "stackTrace" in json:
                 stderr += f"\n{json['stackTrace']}"
 
-            send_log = log_now( stdout = "", stderr = stderr)
+            logs = LogsBuilder()
+            logs.add_all(pack_log)
+            logs.add(run, "openmole", log_now(stdout = "", stderr = stderr))
 
-            return pack_log.add(run, "openmole", send_log), None
+            return logs.build(), None
 
         else:
             response.raise_for_status()
             raise #Silence mypy "missing return statement"
 
 
-async def watch_run(run: Run, run_id: "RunId") -> AsyncIterator[Tuple[Optional[RunState], Logs, RunOutput]]:
-    go = True
-    while go:
+def multipart_envelope(boundary: str, fields: dict[str, str],
+        file_field: str, filename: str) -> Tuple[bytes, bytes]:
+    """The bytes of a multipart/form-data body that come before and after the
+    content of its single file."""
+    head = ""
+    for name, value in fields.items():
+        head += f'--{boundary}\r\n'
+        head += f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+        head += f'{value}\r\n'
+    head += f'--{boundary}\r\n'
+    head += f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+    head += 'Content-Type: application/octet-stream\r\n\r\n'
+
+    tail = f'\r\n--{boundary}--\r\n'
+
+    return head.encode("utf-8"), tail.encode("utf-8")
+
+
+class UploadProgress:
+    """The bytes of an archive of `size` bytes sent so far, and how many of
+    them were last reported."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.sent = 0
+        self.reported = 0
+
+
+async def upload_stream(archive: str, head: bytes, tail: bytes,
+        progress: UploadProgress) -> AsyncIterator[bytes]:
+    yield head
+
+    async with open(archive, "rb") as f:
+        while chunk := await f.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+            progress.sent += len(chunk)
+
+    yield tail
+
+
+async def report_upload_progress(run: Run, progress: UploadProgress,
+        on_progress: Callable[[Logs], Awaitable[None]]) -> None:
+    """Report the progress of the upload every `UPLOAD_PROGRESS_INTERVAL`
+    seconds, until cancelled."""
+    while True:
+        await sleep(UPLOAD_PROGRESS_INTERVAL)
+        await put_upload_progress(run, progress, on_progress)
 
-        (logs1, run_state), run_output = await gather(
+
+async def put_upload_progress(run: Run, progress: UploadProgress,
+        on_progress: Callable[[Logs], Awaitable[None]]) -> None:
+    """Pass a progress log to `on_progress` if bytes were sent since the last
+    one. Its errors are only logged: the upload goes on without them."""
+    sent = progress.sent
+    if sent <= progress.reported:
+        return
+
+    try:
+        await on_progress(Logs.new((run, "upload", log_now(
+            stdout = f"Uploaded {sent} of {progress.size} bytes ({100 * sent // max(progress.size, 1)}%).\n",
+            stderr = ""))))
+        progress.reported = sent
+    except Exception as e:
+        logger.error(f"Could not report the upload progress of {run.job_dir}: {e!r}")
+
+
+async def poll_run(run: Run, run_id: "RunId") -> Tuple[Optional[RunState], Optional[JobProgress], Logs, RunOutput]:
+    """Query the current state, progress and output of a run."""
+    with STAGE_SECONDS.labels("poll").time():
+        (logs, run_state, progress), run_output = await gather(
                 get_run_state(run, run_id),
                 get_run_output(run, run_id))
 
-        if run_state in [RunState.FINISHED, RunState.FAILED]:
-            go = False
+    return run_state, progress, logs, run_output
 
-        yield run_state, logs1, run_output
 
-
-async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunState]]:
-    async with AsyncClient() as client:
-        response = await client.get(f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/state")
+async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunState], Optional[JobProgress]]:
+    response = await client.get(f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/state")
 
     json = response.json()
     if "state" in json:
@@ -80,11 +208,16 @@ async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunSt
         else:
             run_state = RunState.FAILED
 
+        progress = None
+
         if run_state == RunState.FINISHED:
             logs = Logs.empty()
 
         elif run_state == RunState.RUNNING:
 
+            progress = JobProgress(ready = json['ready'],
+                    running = json['running'], completed = json['completed'])
+
             stdout = f"Jobs ready: {json['ready']}, running: {json['running']}, completed: {json['completed']}.\n"
             stderr = ""
 
@@ -96,7 +229,7 @@ async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunSt
                     stderr += f"Error level {e['level']}: {e['message']}\n"
                     stderr += f"Stack trace: e['stackTrace']\n"
 
-            logs = Logs.new((run, "openmole", log_now(stdout = stdout, stderr = stderr)))
+            logs = Logs.new((run, PROGRESS_CONTEXT, log_now(stdout = stdout, stderr = stderr)))
 
         else: # run_state == RunState.FAILED
             stdout = ""
@@ -105,7 +238,7 @@ async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunSt
 
             logs = Logs.new((run, "openmole", log_now(stdout = stdout, stderr = stderr)))
 
-        return logs, run_state
+        return logs, run_state, progress
 
     else:
         response.raise_for_status()
@@ -113,16 +246,22 @@ async def get_run_state(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[RunSt
 
 
 async def get_run_output(run: Run, run_id: "RunId") -> RunOutput:
-    async with AsyncClient() as client:
-        response = await client.get(f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/output")
+    response = await client.get(f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/output")
 
     return RunOutput(text = response.text)
 
 
-async def get_results(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[PosteriorSample]]:
-    logs1, filenames = await get_most_recent_filenames(run, run_id)
-    logs2, results = await get_results_from_filenames(run, run_id, filenames)
-    return logs1.add_all(logs2), results
+async def get_results(run: Run, run_id: "RunId") -> Tuple[Logs, Optional[PosteriorSampleColumns]]:
+    logs = LogsBuilder()
+
+    async with timeline.span("results"):
+        filenames_logs, filenames = await get_most_recent_filenames(run, run_id)
+        logs.add_all(filenames_logs)
+
+        results_logs, results = await get_results_from_filenames(run, run_id, filenames)
+        logs.add_all(results_logs)
+
+    return logs.build(), results
 
 
 async def get_most_recent_filenames(run: Run, run_id: "RunId") -> Tuple[Logs, list[Tuple[Colony, str]]]:
@@ -130,14 +269,13 @@ async def get_most_recent_filenames(run: Run, run_id: "RunId") -> Tuple[Logs, li
     def route(colony: Colony) -> str:
         return f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/workDirectory/{run.output_dir}/ResultsABC_5params/posteriorSample_{colony.colony_id}"
 
-    async with AsyncClient() as client:
-        data = {"last": 1}
-        logger.info(f"Fetching {route(list_colonies()[0])}")
-        responses = await gather(
-                *[client.request( "PROPFIND", route(colony), data = data)
-                    for colony in list_colonies()])
+    data = {"last": 1}
+    logger.info(f"Fetching {route(list_colonies()[0])}")
+    responses = await gather(
+            *[client.request( "PROPFIND", route(colony), data = data)
+                for colony in list_colonies()])
 
-    logs = Logs.empty()
+    logs = LogsBuilder()
 
     most_recent_files = []
     for col, r in zip(list_colonies(), responses):
@@ -147,8 +285,7 @@ async def get_most_recent_filenames(run: Run, run_id: "RunId") -> Tuple[Logs, li
                 most_recent_files.append((col, rj["entries"][0]["name"]))
             else:
                 error = f"No result for colony {col} (no file in the corresponding output directory)"
-                logs = logs.add(run, "backend",
-                        log_now(stdout = "", stderr = error))
+                logs.add(run, "backend", log_now(stdout = "", stderr = error))
 
         elif "message" in rj:
             error = f"Could not get results for colony {col} from {route(col)}: {rj['message']}"
@@ -156,33 +293,57 @@ async def get_most_recent_filenames(run: Run, run_id: "RunId") -> Tuple[Logs, li
         else:
             rj.raise_for_status()
 
-    return logs, most_recent_files
+    return logs.build(), most_recent_files
 
 
-async def get_results_from_filenames(run: Run, run_id: "RunId", filenames: list[Tuple[Colony, str]]) -> Tuple[Logs, Optional[PosteriorSample]]:
+async def get_results_from_filenames(run: Run, run_id: "RunId", filenames: list[Tuple[Colony, str]]) -> Tuple[Logs, Optional[PosteriorSampleColumns]]:
 
     def route(colony: Colony, filename: str) -> str:
         return f"http://{OPENMOLE_HOST}:{OPENMOLE_PORT}/job/{run_id.val}/workDirectory/{run.output_dir}/ResultsABC_5params/posteriorSample_{colony.colony_id}/{filename}"
 
-    async with AsyncClient() as client:
-        responses = await gather(*[client.get(route(col, filename))
-            for col, filename in filenames])
+    loop = get_running_loop()
 
-    results = []
-    for (col, filename), r in zip(filenames, responses):
+    # Each file is parsed as soon as it is downloaded, while the others are
+    # still downloading.
+    async def download_and_parse(colony: Colony, filename: str) -> PosteriorSampleColumns:
+        r = await client.get(route(colony, filename))
+        RESULTS_PARSE_PENDING.inc()
         try:
-            with BytesIO(r.content) as b:
-                with gzip.open(b, 'r') as f:
-                    csv = f.read().decode("utf-8")
-            res = PosteriorSample.from_csv_string(csv, col)
-        except ValueError as e:
-            error = f"Error when reading results from file {filename}: {e}"
+            start = perf_counter()
+            columns, duration = await loop.run_in_executor(results_pool,
+                    parse_results, r.content, colony)
+            # The time spent waiting for a parsing process is kept apart from
+            # the parsing itself.
+            STAGE_SECONDS.labels("parse").observe(duration)
+            STAGE_SECONDS.labels("parse_wait").observe(max(perf_counter() - start - duration, 0))
+            return columns
+        finally:
+            RESULTS_PARSE_PENDING.dec()
+
+    parsed = await gather(*[download_and_parse(col, filename)
+        for col, filename in filenames], return_exceptions = True)
+
+    results = []
+    for (col, filename), res in zip(filenames, parsed):
+        if isinstance(res, (ValueError, OSError, EOFError)):
+            error = f"Error when reading results from file {filename}: {res}"
             logs = Logs.new((run, "backend", log_now(stdout = "", stderr = error)))
             return logs, None
+        elif isinstance(res, BaseException):
+            raise res
 
         results.append(res)
 
-    return Logs.empty(), PosteriorSample.from_list(results)
+    return Logs.empty(), PosteriorSampleColumns.from_list(results)
+
+
+def parse_results(content: bytes, colony: Colony) -> Tuple[PosteriorSampleColumns, float]:
+    """Decompress and parse a result file of the ABC, and how long it took in
+    seconds. Runs in `results_pool`, hence a plain function of picklable
+    arguments."""
+    start = perf_counter()
+    csv = gzip.decompress(content).decode("utf-8")
+    return PosteriorSampleColumns.from_csv_string(csv, colony), perf_counter() - start
 
 
 class RunId(BaseModel):
@@ -1,92 +1,297 @@
 from pydantic import BaseModel
-from typing import Iterator, Tuple, Optional
-from src.data import Code, Logs, Log, Run, log_now
-from asyncio import Lock, create_subprocess_shell, subprocess
+from typing import AsyncIterator, Tuple, Optional
+from src.data import Code, Logs, LogsBuilder, Log, Run, log_now
+from asyncio import Lock, create_subprocess_exec, subprocess, to_thread
 from collections import defaultdict
-from os import mkdir
-from os.path import join, dirname
+from contextlib import asynccontextmanager
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH, flock
+from hashlib import sha256
+from os import fstat, makedirs, remove, replace, scandir, stat, utime
+from os.path import join, dirname, exists
 from tempfile import gettempdir
+from uuid import uuid4
 from textwrap import dedent
 from src.constants import *
+from src import timeline
+from time import time
 
 lock: defaultdict[str, Lock] = defaultdict(Lock)
 
-async def pack(path: str, run: Run) -> Tuple[Logs, Optional[str]]:
-    async with lock[path]:
+ARCHIVE_CACHE_DIR = join(TMP_DIR, "archive_cache")
+
+@asynccontextmanager
+async def pack(path: str, run: Run) -> AsyncIterator[Tuple[Logs, Optional[str]]]:
+    """Build the archive of the run job directory. The archive is generated
+    from the object store of the repository with `git archive`, so the working
+    tree is never touched and launches of different commits are packed
+    concurrently. Only fetching missing commits is serialized. The archive is
+    not evicted from the cache until the block exits, so that it can be
+    uploaded."""
+    async with cache_hold(cache_path(run)) as held:
+        cached_path = await cache_lookup(run) if held else None
+        if cached_path is not None:
+            yield cache_hit_log(run, cached_path), cached_path
+            return
+
+    logs = LogsBuilder()
+
+    async with timeline.span("fetch"):
+        fetch_returncode, fetch_log = await fetch(path, run)
+    logs.add_all(fetch_log)
+
+    if fetch_returncode != 0:
+        yield logs.build(), None
+        return
+
+    tmp_path = cache_tmp_path(run)
+    try:
+        async with timeline.span("archive"):
+            archive_returncode, archive_log, archive_path = await archive(
+                    path, run, tmp_path)
+        logs.add_all(archive_log)
+
+        if archive_returncode != 0 or archive_path is None:
+            yield logs.build(), None
+            return
+
+        # Held before it enters the cache, so that it cannot be evicted in
+        # the meantime.
+        async with cache_hold(archive_path):
+            cached_path = await cache_insert(run, archive_path)
+            yield logs.build(), cached_path
+
+    finally:
+        # Left behind by a failed build only.
+        try:
+            remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+async def fetch(path: str, run: Run) -> Tuple[int, Logs]:
+    """Make sure the run commit is in the object store of the repository at
+    `path`, fetching it from origin if needed. Fetches into the same
+    repository are serialized with `lock`."""
 
-        checkout_returncode, checkout_log = await checkout(path, run)
+    has_commit_cmd = ["git", "-C", path, "cat-file", "-e",
+            f"{run.code.commit_hash}^{{commit}}"]
 
-        if checkout_returncode != 0:
-            return checkout_log, None
+    returncode, _ = await run_command(has_commit_cmd, run, "fetch")
+    if returncode == 0:
+        return returncode, Logs.new((run, "fetch", log_now(
+                stdout = f"Commit {run.code.commit_hash} already fetched.\n",
+                stderr = "")))
 
-        archive_returncode, archive_log, archive_path = await archive(
-                path, run)
+    waiting_since = time()
+    async with lock[path]:
+        await timeline.add(timeline.current_run.get(), "repository_lock",
+                waiting_since, time())
+        return await run_command(
+                ["git", "-C", path, "fetch", "origin", run.code.commit_hash],
+                run, "fetch")
 
-        if archive_returncode != 0:
-            return checkout_log.add_all(archive_log), None
 
-        return checkout_log.add_all(archive_log), archive_path
+async def archive(path: str, run: Run, archive_path: str) -> Tuple[int, Logs, Optional[str]]:
+    """Write the archive of the run job directory at the run commit to
+    `archive_path`. The commit must have been fetched."""
 
+    makedirs(dirname(archive_path), exist_ok = True)
 
-async def checkout(path: str, run: Run) -> Tuple[int, Logs]:
-    """This method must not be called directly. To function safely, it
-    relies on the lock acquired with the `pack` method."""
+    returncode, log = await run_command(
+            ["git", "-C", path, "archive", "--format=tar.gz",
+                "-o", archive_path, run.code.commit_hash, "--", run.job_dir],
+            run, "archive")
 
-    checkout_cmd = "\n".join([\
-        f"cd {path}",
-        f"git fetch origin {run.code.commit_hash} \\",
-        f"&& git reset --hard {run.code.commit_hash}"])
+    if returncode == 0:
+        return returncode, log, archive_path
+    else:
+        return returncode, log, None
 
 
-    proc = await create_subprocess_shell(
-            checkout_cmd,
+async def run_command(cmd: list[str], run: Run, context: str) -> Tuple[int, Logs]:
+    proc = await create_subprocess_exec(
+            *cmd,
             stdout = subprocess.PIPE,
             stderr = subprocess.PIPE)
 
     stdout, stderr = await proc.communicate()
-    log = Logs.new((run, "checkout", log_now(
-            stdout = f"Running command: \n{checkout_cmd}\n" +
+    log = Logs.new((run, context, log_now(
+            stdout = f"Running command: \n{' '.join(cmd)}\n" +
                 stdout.decode("utf-8"),
             stderr = stderr.decode("utf-8"))))
 
     if proc.returncode is None:
-        raise RuntimeError("Return code for checkout process says the job is still running.")
+        raise RuntimeError(f"Return code for {context} process says the job is still running.")
     else:
         return proc.returncode, log
 
 
-async def archive(path: str, run: Run) -> Tuple[int, Logs, Optional[str]]:
-    """This method must not be called directly. To function safely, it
-    relies on the lock acquired with the `pack` method."""
+# Archive cache
+#
+# The archive of a job only depends on the commit and on the job directory, so
+# it is stored under `ARCHIVE_CACHE_DIR` with a name derived from both. Next to
+# each archive `<key>.tar.gz`, the file `<key>.tar.gz.sha256` holds the digest
+# of the archive, with the size and modification time the archive had when it
+# was hashed. A hit only hashes the archive again if they changed. The
+# modification time of the digest file is the last use of the archive: when
+# the cache grows beyond `ARCHIVE_CACHE_MAX_SIZE` bytes, the least recently
+# used archives are removed.
+#
+# The cache is shared by the backend worker processes. An archive in use is
+# held with a shared `flock` (see `cache_hold`), and eviction skips the
+# archives it cannot lock exclusively.
+
+def cache_key(run: Run) -> str:
+    return sha256(f"{run.code.commit_hash}\0{run.job_dir}".encode("utf-8")).hexdigest()
+
+
+def cache_path(run: Run) -> str:
+    return join(ARCHIVE_CACHE_DIR, cache_key(run) + ".tar.gz")
+
+
+def cache_tmp_path(run: Run) -> str:
+    """Where an archive is built before it enters the cache. The path is unique
+    so that concurrent builds of the same code do not share a file."""
+    return join(ARCHIVE_CACHE_DIR, "tmp", f"{cache_key(run)}-{uuid4().hex}.tar.gz")
+
+
+def file_digest(file_path: str) -> str:
+    h = sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stamp(file_path: str) -> str:
+    """The size and modification time of a file, which change with its
+    content."""
+    st = stat(file_path)
+    return f"{st.st_size} {st.st_mtime_ns}"
+
 
-    tmp_archive_path = join(TMP_DIR, run.code.commit_hash + ".tar.gz")
+def cache_hit_log(run: Run, archive_path: str) -> Logs:
+    return Logs.new((run, "archive", log_now(
+            stdout = f"Using cached archive {archive_path} for commit {run.code.commit_hash} and job directory {run.job_dir}.\n",
+            stderr = "")))
+
+
+async def cache_lookup(run: Run) -> Optional[str]:
+    """Return the path of the cached archive for the run code and job
+    directory, or None if there is none or if it is corrupted. A corrupted
+    entry is removed."""
+    archive_path = cache_path(run)
+    digest_path = archive_path + ".sha256"
+
+    if not (exists(archive_path) and exists(digest_path)):
+        return None
 
     try:
-        mkdir(dirname(tmp_archive_path))
-    except FileExistsError:
-        pass
+        with open(digest_path) as f:
+            expected, _, stamp = f.read().strip().partition(" ")
+        if stamp == file_stamp(archive_path):
+            actual = expected
+        else:
+            actual = await to_thread(file_digest, archive_path)
+    except FileNotFoundError:
+        # Evicted in the meantime.
+        return None
 
-    archive_cmd = "\n".join([
-        f"cd {path} && \\",
-        f"tar -zcf {tmp_archive_path} {run.job_dir}"])
+    if actual != expected:
+        for p in (archive_path, digest_path):
+            try:
+                remove(p)
+            except FileNotFoundError:
+                pass
+        return None
 
-    proc = await create_subprocess_shell(
-            archive_cmd,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE)
+    try:
+        utime(digest_path)
+    except FileNotFoundError:
+        return None
+    return archive_path
 
-    stdout, stderr = await proc.communicate()
-    log = Logs.new((run, "archive", log_now(
-            stdout = f"Running command: \n{archive_cmd}\n" +
-                stdout.decode("utf-8"),
-            stderr = stderr.decode("utf-8"))))
 
-    if proc.returncode is None:
-        raise RuntimeError("Return code for checkout process says the job is still running.")
-    elif proc.returncode == 0:
-        return proc.returncode, log, tmp_archive_path
-    else:
-        return proc.returncode, log, None
+@asynccontextmanager
+async def cache_hold(archive_path: str) -> AsyncIterator[bool]:
+    """Keep the archive at `archive_path` from being evicted, by any process,
+    until the block exits. Gives False if there is no archive there."""
+    try:
+        f = open(archive_path, "rb")
+    except FileNotFoundError:
+        yield False
+        return
 
+    with f:
+        # Waits for an eviction of the archive in progress.
+        await to_thread(flock, f, LOCK_SH)
+        try:
+            # Not removed or replaced before it was locked.
+            held = stat(archive_path).st_ino == fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            held = False
+        yield held
 
 
+async def cache_insert(run: Run, tmp_archive_path: str) -> str:
+    """Move a freshly built archive into the cache, evicting the least recently
+    used archives if needed, and return its new path. The digest is written
+    once the archive is in place, so that it never describes another
+    archive."""
+    archive_path = cache_path(run)
+    digest_path = archive_path + ".sha256"
+
+    digest = await to_thread(file_digest, tmp_archive_path)
+    # Moving the archive keeps its size and modification time.
+    stamp = file_stamp(tmp_archive_path)
+    replace(tmp_archive_path, archive_path)
+
+    tmp_digest_path = f"{tmp_archive_path}.sha256"
+    with open(tmp_digest_path, "w") as f:
+        f.write(f"{digest} {stamp}")
+    replace(tmp_digest_path, digest_path)
+
+    cache_evict(keep = archive_path)
+
+    return archive_path
+
+
+def cache_evict(keep: str) -> None:
+    """Remove the least recently used archives until the cache fits in
+    `ARCHIVE_CACHE_MAX_SIZE`. The archive `keep` and the archives held (see
+    `cache_hold`) are never removed."""
+    entries = [(last_use(e.path), e.stat().st_size, e.path)
+            for e in scandir(ARCHIVE_CACHE_DIR)
+            if e.is_file() and e.name.endswith(".tar.gz")]
+
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, archive_path in sorted(entries):
+        if total <= ARCHIVE_CACHE_MAX_SIZE:
+            break
+        if archive_path == keep:
+            continue
+        try:
+            f = open(archive_path, "rb")
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                flock(f, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                continue
+            for p in (archive_path, archive_path + ".sha256"):
+                try:
+                    remove(p)
+                except FileNotFoundError:
+                    pass
+        total -= size
+
+
+def last_use(archive_path: str) -> float:
+    """When the cached archive was last used, or 0 if it has no digest: it is
+    then of no use."""
+    try:
+        return stat(archive_path + ".sha256").st_mtime
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,181 @@
+import gzip
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from hashlib import sha256
+from typing import Awaitable, Callable, Optional
+from fastapi import Request, Response, status
+from src.data import Run, RunState
+from src.constants import RESPONSE_CACHE_MAX_SIZE
+from src import db
+
+# Responses about a run, serialized once. The responses about a run that will
+# not change anymore (see `is_final`) are kept in memory and served again
+# without any database work, with headers that let browsers keep them forever.
+# They are compressed the first time a client accepting gzip needs their body.
+# The others are recomputed on each request and sent uncompressed, but their
+# ETag still spares sending them again when they did not change.
+#
+# The cache holds at most `RESPONSE_CACHE_MAX_SIZE` bytes of payloads. The
+# least recently used responses are dropped first.
+
+# Payloads smaller than this are not worth compressing.
+GZIP_MIN_SIZE = 1024
+
+FINAL_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CHANGING_CACHE_CONTROL = "no-cache"
+
+
+@dataclass(frozen = True)
+class CachedResponse:
+    body: bytes
+    # None until the body is compressed (see `with_gzip`), and for a body too
+    # small to be compressed.
+    gzip_body: Optional[bytes]
+    etag: str
+    media_type: str
+
+    def size(self) -> int:
+        return len(self.body) + (len(self.gzip_body) if self.gzip_body is not None else 0)
+
+
+# Responses of the runs that will not change anymore, by request path and
+# query, least recently used first.
+cache: OrderedDict[str, CachedResponse] = OrderedDict()
+cache_size = 0
+
+
+def cache_get(key: str) -> Optional[CachedResponse]:
+    entry = cache.get(key)
+    if entry is not None:
+        cache.move_to_end(key)
+    return entry
+
+
+def cache_put(key: str, entry: CachedResponse) -> None:
+    global cache_size
+
+    if entry.size() > RESPONSE_CACHE_MAX_SIZE:
+        return
+
+    previous = cache.pop(key, None)
+    if previous is not None:
+        cache_size -= previous.size()
+
+    cache[key] = entry
+    cache_size += entry.size()
+
+    while cache_size > RESPONSE_CACHE_MAX_SIZE:
+        _, evicted = cache.popitem(last = False)
+        cache_size -= evicted.size()
+
+
+def new_entry(body: bytes, media_type: str) -> CachedResponse:
+    return CachedResponse(
+            body = body,
+            gzip_body = None,
+            etag = '"' + sha256(body).hexdigest() + '"',
+            media_type = media_type)
+
+
+def with_gzip(entry: CachedResponse) -> CachedResponse:
+    """The entry with its body compressed, unless it already is or is too
+    small to be compressed."""
+    if entry.gzip_body is not None or len(entry.body) < GZIP_MIN_SIZE:
+        return entry
+    return replace(entry, gzip_body = gzip.compress(entry.body))
+
+
+async def is_final(run: Run, run_id: int) -> bool:
+    """Whether nothing about the run will change anymore: it failed, or it
+    finished and its posterior sample is stored (the logs of the results are
+    stored before it)."""
+    if run.state == RunState.FAILED:
+        return True
+    elif run.state == RunState.FINISHED:
+        return await db.has_posterior_sample(run_id)
+    else:
+        return False
+
+
+def not_modified(request: Request, entry: CachedResponse) -> bool:
+    """Whether the client already has the entry, according to the ETags of
+    its If-None-Match header (compared weakly, as the header requires)."""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == entry.etag for tag in tags)
+
+
+def accepts_gzip(request: Request) -> bool:
+    """Whether the Accept-Encoding header of the request allows gzip, without
+    a quality of 0."""
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, *params = [part.strip() for part in coding.split(";")]
+        if name.lower() in ("gzip", "x-gzip", "*"):
+            for param in params:
+                key, _, value = param.partition("=")
+                if key.strip() == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def respond(request: Request, entry: CachedResponse, cache_control: str) -> Response:
+    headers = {"ETag": entry.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+    if not_modified(request, entry):
+        return Response(status_code = status.HTTP_304_NOT_MODIFIED, headers = headers)
+
+    if entry.gzip_body is not None and accepts_gzip(request):
+        headers["Content-Encoding"] = "gzip"
+        return Response(entry.gzip_body, media_type = entry.media_type, headers = headers)
+
+    return Response(entry.body, media_type = entry.media_type, headers = headers)
+
+
+async def run_response(request: Request, run_id: int,
+        load: Callable[[Run], Awaitable[Optional[bytes]]],
+        media_type: str = "application/json") -> Response:
+    """The response to a request about run `run_id`, whose body is computed by
+    `load` from the run (None if there is nothing to send, answered with 404).
+    The response is cached if the run is final."""
+    key = request.url.path + "?" + request.url.query
+
+    entry = cache_get(key)
+    if entry is not None:
+        return respond_final(request, key, entry)
+
+    run = await db.get_run(run_id)
+    if run is None:
+        return Response(status_code = status.HTTP_404_NOT_FOUND)
+
+    # Checked before loading: the run might become final in the meantime,
+    # after the loaded data was read.
+    final = await is_final(run, run_id)
+
+    body = await load(run)
+    if body is None:
+        return Response(status_code = status.HTTP_404_NOT_FOUND)
+
+    entry = new_entry(body, media_type)
+
+    if final:
+        cache_put(key, entry)
+        return respond_final(request, key, entry)
+    else:
+        return respond(request, entry, CHANGING_CACHE_CONTROL)
+
+
+def respond_final(request: Request, key: str, entry: CachedResponse) -> Response:
+    """Respond with the cached entry `key`, compressing it for good if the
+    client is the first accepting gzip that needs its body."""
+    if entry.gzip_body is None and accepts_gzip(request) and not not_modified(request, entry):
+        compressed = with_gzip(entry)
+        if compressed is not entry:
+            cache_put(key, compressed)
+            entry = compressed
+    return respond(request, entry, FINAL_CACHE_CONTROL)
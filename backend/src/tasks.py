@@ -1,48 +1,208 @@
-from asyncio import sleep, gather, create_task
-from src.data import Run, Code, RunState, RunOutput, RunWithId
+from asyncio import Event, Task, TimeoutError, create_task, gather, wait_for
+from os import getpid
+from socket import gethostname
+from typing import Optional
+from uuid import uuid4
+from src.data import Run, Code, RunState, RunWithId, Logs, JobStage, RunJob, log_now
 from src.constants import *
 from src import openmole
 from src import db
+from src import watcher
+from src import timeline
+from src.metrics import ACTIVE_RUNS
 from src.util import do_nothing, logger
 
-def launch_run(run: Run) -> RunWithId:
-    run = db.create_run(run)
+# Runs are executed through a queue stored in the database (see `db.RunJob`),
+# so that they survive the backend: a run is queued with its creation, and
+# each backend worker leases the jobs it executes, at most
+# `RUN_QUEUE_CONCURRENCY` at a time. The leases of a worker are renewed as long
+# as it is alive. When a worker stops, its jobs are resumed by another one
+# (or by itself once restarted) at the stage where they were:
+#
+# - SUBMIT: the job directory is sent to OpenMOLE, whose job id is stored,
+# - WATCH: the OpenMOLE job is watched until it is finished or failed,
+# - RESULTS: the posterior sample is fetched and stored.
+#
+# A stage that fails is retried later, waiting twice as long after each
+# failure, and the run fails after `RUN_QUEUE_MAX_ATTEMPTS` attempts.
 
-    create_task(do_run(run))
+# Longest wait before retrying a stage, in seconds.
+MAX_RETRY_DELAY = 3600
 
-    return run
+# Identifies the leases of this worker.
+WORKER_ID = f"{gethostname()}-{getpid()}-{uuid4().hex[:8]}"
 
+# Jobs executed by this worker, by run id.
+active: dict[int, Task] = {}
 
-async def do_run(run: RunWithId) -> None:
-    logs, om_run_id = await openmole.send_job(REPOSITORY_PATH, run)
+ACTIVE_RUNS.set_function(lambda: len(active))
 
-    logger.info(logs.pretty())
+queue_task: Optional[Task] = None
 
-    db.put_logs(run.id, logs)
-    db.put_run_output(run.id, RunOutput(text = ""))
+# Set to lease new jobs without waiting for the next poll.
+wakeup: Optional[Event] = None
 
-    if om_run_id is None:
-        db.put_run_state(run.id, RunState.FAILED)
+
+class LeaseLost(Exception):
+    """Another worker took over the job."""
+
+
+class RunError(Exception):
+    """The run cannot succeed: attempting it again would fail the same way."""
+
+
+async def launch_run(run: Run) -> RunWithId:
+    run_with_id = await db.create_run(run)
+
+    if wakeup is not None:
+        wakeup.set()
+
+    return run_with_id
+
+
+async def start() -> None:
+    """Start executing the queued runs. Must be awaited with the application
+    startup."""
+    global queue_task, wakeup
+    wakeup = Event()
+    queue_task = create_task(queue_loop(wakeup))
+
+
+async def stop() -> None:
+    """Stop executing runs and give them up to the other workers."""
+    if queue_task is not None:
+        queue_task.cancel()
+    for task in active.values():
+        task.cancel()
+    await gather(*active.values(), return_exceptions = True)
+    await db.release_leases(WORKER_ID)
+
+
+async def queue_loop(wakeup: Event) -> None:
+    while True:
+        try:
+            await db.renew_leases(WORKER_ID, list(active), RUN_QUEUE_LEASE_DURATION)
+
+            # A job still executed here may have seen its lease expire, if it
+            # could not be renewed: it must not be executed twice.
+            free = RUN_QUEUE_CONCURRENCY - len(active)
+            if free > 0:
+                for job in await db.lease_jobs(WORKER_ID, free, RUN_QUEUE_LEASE_DURATION,
+                        exclude = list(active)):
+                    active[job.run.id] = create_task(run_job(job))
+        except Exception as e:
+            logger.error(f"Could not lease runs to execute: {e!r}")
+
+        try:
+            await wait_for(wakeup.wait(), RUN_QUEUE_POLL_INTERVAL)
+        except TimeoutError:
+            pass
+        wakeup.clear()
+
+
+def retry_delay(attempts: int) -> Optional[float]:
+    """Delay before the next attempt at a stage that failed `attempts` times,
+    or None if the run should fail."""
+    if attempts >= RUN_QUEUE_MAX_ATTEMPTS:
+        return None
     else:
-        async for run_state, run_logs, run_output in openmole.watch_run(run, om_run_id):
+        return min(RUN_QUEUE_RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+async def run_job(job: RunJob) -> None:
+    run_id = job.run.id
+
+    try:
+        await do_run(job)
+
+    except LeaseLost:
+        logger.info(f"Run {run_id} was taken over by another worker.")
+
+    except RunError as e:
+        logger.error(f"Run {run_id} failed at stage {job.stage.name}: {e}")
+        try:
+            await db.put_logs(run_id, Logs.new((job.run, "backend",
+                log_now(stdout = "", stderr = f"Error: {e}"))))
+            await db.put_run_state(run_id, RunState.FAILED)
+            await db.finish_job(run_id, WORKER_ID)
+        except Exception as e:
+            logger.error(f"Could not record the failure of run {run_id}: {e!r}")
+
+    except Exception as e:
+        logger.error(f"Run {run_id} failed at stage {job.stage.name}: {e!r}")
+        try:
+            await db.put_logs(run_id, Logs.new((job.run, "backend",
+                log_now(stdout = "", stderr = f"Error, the run will be retried if possible: {e!r}"))))
+            if not await db.retry_job(run_id, WORKER_ID, repr(e), retry_delay):
+                await db.put_run_state(run_id, RunState.FAILED)
+                await db.finish_job(run_id, WORKER_ID)
+        except Exception as e:
+            # The lease expires and the job is attempted again.
+            logger.error(f"Could not record the failure of run {run_id}: {e!r}")
+
+    finally:
+        active.pop(run_id, None)
+        if wakeup is not None:
+            wakeup.set()
+
+
+async def do_run(job: RunJob) -> None:
+    """Execute the run from the stage of the job on."""
+    run = job.run
+    stage = job.stage
+    timeline.current_run.set(run.id)
+    om_run_id = openmole.RunId(val = job.om_run_id) if job.om_run_id is not None else None
+
+    if stage == JobStage.SUBMIT:
+        async def put_upload_logs(logs: Logs) -> None:
+            await db.put_logs(run.id, logs)
+
+        logs, om_run_id = await openmole.send_job(REPOSITORY_PATH, run,
+                on_progress = put_upload_logs)
+
+        # The OpenMOLE job id is stored before anything else can fail, so that
+        # an attempt again watches the job instead of submitting a duplicate.
+        if om_run_id is not None:
+            stage = JobStage.WATCH
+            if not await db.put_job_stage(run.id, WORKER_ID, stage, om_run_id.val):
+                raise LeaseLost()
+
+        await db.put_logs(run.id, logs)
+
+        # The commit could not be packed or OpenMOLE rejected the job, see the
+        # logs: sending it again would not do better.
+        if om_run_id is None:
+            raise RunError("Could not send the job to OpenMOLE, see the logs of the run.")
+
+    if om_run_id is None:
+        raise RunError(f"No OpenMOLE job id for run {run.id} at stage {stage.name}.")
+
+    if stage == JobStage.WATCH:
+        async def reset_attempts() -> None:
+            # OpenMOLE answers again: the failures so far were transient, and
+            # only consecutive ones count against the run.
+            await db.put_job_stage(run.id, WORKER_ID, JobStage.WATCH)
 
-            logger.info(run_logs.pretty())
-            logger.info(f"Run output: {run_output}")
+        run_state = await watcher.watch(run, om_run_id,
+                on_first_poll = reset_attempts if job.attempts > 0 else None)
 
-            if run_state is not None:
-                db.put_run_state(run.id, run_state)
-            db.put_logs(run.id, run_logs)
-            db.put_run_output(run.id, run_output)
+        # Nothing is written about a failed run after its state.
+        if run_state == RunState.FAILED:
+            await db.finish_job(run.id, WORKER_ID)
+            return
 
-            await sleep(OPENMOLE_STATE_PULL_DELAY)
+        stage = JobStage.RESULTS
+        if not await db.put_job_stage(run.id, WORKER_ID, stage):
+            raise LeaseLost()
 
+    if stage == JobStage.RESULTS:
         logs, results = await openmole.get_results(run, om_run_id)
-        logger.info(logs.pretty())
 
-        db.put_logs(run.id, logs)
+        await db.put_logs(run.id, logs)
 
         if results is None:
-            raise RuntimeError(f"Did not get the run results from openmole. Logs: {logs.pretty()}")
-        else:
-            db.put_posterior_sample(run.id, results)
+            raise RuntimeError("Did not get the run results from openmole, see the logs of the run.")
 
+        async with timeline.span("store_results"):
+            await db.put_posterior_sample(run.id, results)
+        await db.finish_job(run.id, WORKER_ID)
@@ -0,0 +1,53 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from time import time
+from typing import AsyncIterator, Optional
+from src.data import Span
+from src.metrics import STAGE_SECONDS
+from src import db
+from src.util import logger
+
+# Where the time of each run goes. The steps of its execution are timed as
+# spans, stored in the database (one row per span, a handful per run) and
+# served as a waterfall by `/run/{run_id}/timeline`. The spans are:
+#
+# - repository_lock: waiting for another fetch into the job repository,
+# - fetch: getting the commit into the job repository (includes the lock),
+# - archive: building the archive of the job directory,
+# - upload: sending the archive to OpenMOLE,
+# - openmole_queue: from the submission until OpenMOLE reports jobs running
+#   or completed,
+# - openmole_execution: from then until the job is finished or failed,
+# - results: downloading and parsing the posterior sample,
+# - store_results: writing it to the database.
+#
+# The duration of each span is also measured in `metrics.STAGE_SECONDS`. A
+# stage attempted several times (see `src.tasks`) has a span per attempt that
+# got to its end.
+
+# The run executed by the current task, whose spans `span` records. Set by
+# `tasks.do_run`: tasks started from there inherit it.
+current_run: ContextVar[Optional[int]] = ContextVar("current_run", default = None)
+
+
+async def add(run_id: Optional[int], name: str, start: float, end: float) -> None:
+    """Record a span of run `run_id`, or only measure it if the run is None.
+    Failing to store it does not fail the run."""
+    STAGE_SECONDS.labels(name).observe(end - start)
+
+    if run_id is None:
+        return
+
+    try:
+        await db.put_span(run_id, Span(name = name, start = start, end = end))
+    except Exception as e:
+        logger.error(f"Could not store span {name} of run {run_id}: {e!r}")
+
+
+@asynccontextmanager
+async def span(name: str) -> AsyncIterator[None]:
+    """Time the block as the span `name` of the current run (see
+    `current_run`). Nothing is recorded for a block that raises."""
+    start = time()
+    yield
+    await add(current_run.get(), name, start, time())
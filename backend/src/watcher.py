@@ -0,0 +1,213 @@
+from asyncio import Event, Future, Semaphore, Task, TimeoutError, gather, \
+        create_task, get_running_loop, wait_for
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import Awaitable, Callable, Optional, Tuple, Union
+from src.data import RunState, RunWithId, Logs, RunOutput, JobProgress
+from src.constants import *
+from src import openmole
+from src import db
+from src import timeline
+from src.metrics import WATCHED_RUNS
+from src.util import logger
+
+# A single loop watches all the running OpenMOLE jobs: at each tick, the runs
+# that are due are polled (at most `OPENMOLE_WATCH_CONCURRENCY` at a time) and
+# all the resulting updates are written to the database in one transaction,
+# with a savepoint per run: a run whose updates cannot be written fails alone.
+#
+# Each run has its own polling delay. It starts at `OPENMOLE_STATE_PULL_DELAY`
+# and is multiplied by `OPENMOLE_STATE_PULL_BACKOFF` after each poll where the
+# job progress did not change, up to `OPENMOLE_STATE_PULL_MAX_DELAY`. It goes
+# back to the minimum as soon as the progress changes, and stays there once
+# the run is nearly complete.
+
+# Fraction of completed jobs above which a run is polled as often as possible.
+NEAR_COMPLETION = 0.9
+
+
+@dataclass
+class WatchedRun:
+    run: RunWithId
+    om_run_id: openmole.RunId
+    # Resolved with the final state of the run.
+    done: "Future[RunState]"
+    # Resolved after the first successful poll.
+    first_poll: "Future[None]"
+    delay: float
+    next_poll: float
+    progress: Optional[JobProgress] = None
+    # Length of the output already written to the database.
+    output_end: int = 0
+    # When the watch started, and when OpenMOLE first reported jobs running
+    # or completed (see `timeline`).
+    watched_since: float = 0.0
+    running_since: Optional[float] = None
+
+
+# Watched runs by run id.
+watched: dict[int, WatchedRun] = {}
+
+WATCHED_RUNS.set_function(lambda: len(watched))
+
+loop_task: Optional[Task] = None
+
+# Set when a run starts being watched, so that it is polled right away. Created
+# with the loop task, to be bound to the running event loop.
+wakeup: Optional[Event] = None
+
+
+async def watch(run: RunWithId, om_run_id: openmole.RunId,
+        on_first_poll: Optional[Callable[[], Awaitable[None]]] = None) -> RunState:
+    """Watch the run until it is finished or failed and return its final
+    state. Its state, logs and output are written to the database along the
+    way. The run may have been watched before, by a worker that stopped: the
+    output is written from where it stopped. `on_first_poll` is called once
+    OpenMOLE answered a first poll about the run."""
+    global loop_task, wakeup
+
+    output_end = await db.get_run_output_length(run.id)
+
+    loop = get_running_loop()
+    done: "Future[RunState]" = loop.create_future()
+    w = WatchedRun(run = run, om_run_id = om_run_id, done = done,
+            first_poll = loop.create_future(),
+            delay = OPENMOLE_STATE_PULL_DELAY, next_poll = monotonic(),
+            output_end = output_end, watched_since = time())
+    watched[run.id] = w
+
+    async def after_first_poll(callback: Callable[[], Awaitable[None]]) -> None:
+        await w.first_poll
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"Could not handle the first poll of run {run.id}: {e!r}")
+
+    first_poll_task = create_task(after_first_poll(on_first_poll)) \
+            if on_first_poll is not None else None
+
+    if loop_task is None or loop_task.done() \
+            or loop_task.get_loop() is not get_running_loop() or wakeup is None:
+        wakeup = Event()
+        loop_task = create_task(watch_loop(wakeup))
+    else:
+        wakeup.set()
+
+    try:
+        run_state = await done
+    finally:
+        if first_poll_task is not None:
+            first_poll_task.cancel()
+
+    await add_spans(w, time())
+    return run_state
+
+
+async def add_spans(w: WatchedRun, end: float) -> None:
+    """Record the time the OpenMOLE job spent queued and executing. A run
+    that was watched before by a stopped worker only counts from the current
+    watch on. A job never seen running is counted as executing."""
+    if w.running_since is not None:
+        await timeline.add(w.run.id, "openmole_queue", w.watched_since, w.running_since)
+        await timeline.add(w.run.id, "openmole_execution", w.running_since, end)
+    else:
+        await timeline.add(w.run.id, "openmole_execution", w.watched_since, end)
+
+
+def next_delay(delay: float, previous: Optional[JobProgress],
+        current: Optional[JobProgress]) -> float:
+    """Polling delay of a run after a poll that moved its progress from
+    `previous` to `current`, `delay` being the delay before that poll."""
+    if current is not None and current.completed_fraction() >= NEAR_COMPLETION:
+        return OPENMOLE_STATE_PULL_DELAY
+    elif current != previous:
+        return OPENMOLE_STATE_PULL_DELAY
+    else:
+        return min(delay * OPENMOLE_STATE_PULL_BACKOFF,
+                OPENMOLE_STATE_PULL_MAX_DELAY)
+
+
+async def watch_loop(wakeup: Event) -> None:
+    """Poll the watched runs until there are none left."""
+    semaphore = Semaphore(OPENMOLE_WATCH_CONCURRENCY)
+
+    async def poll(w: WatchedRun
+            ) -> Tuple[Optional[RunState], Optional[JobProgress], Logs, RunOutput]:
+        async with semaphore:
+            return await openmole.poll_run(w.run, w.om_run_id)
+
+    while len(watched) > 0:
+        # Runs whose watcher was cancelled.
+        for run_id in [run_id for run_id, w in watched.items() if w.done.done()]:
+            del watched[run_id]
+
+        now = monotonic()
+        due = [w for w in watched.values() if w.next_poll <= now]
+
+        results = await gather(*[poll(w) for w in due], return_exceptions = True)
+
+        updates = []
+        output_ends = []
+        ended: list[Tuple[WatchedRun, Union[RunState, BaseException]]] = []
+        for w, result in zip(due, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Could not poll run {w.run.id}: {result!r}")
+                ended.append((w, result))
+                continue
+
+            run_state, progress, run_logs, run_output = result
+
+            if not w.first_poll.done():
+                w.first_poll.set_result(None)
+
+            # OpenMOLE always sends the whole output: only the new part is
+            # written.
+            new_output = RunOutput(text = run_output.text[w.output_end:],
+                    offset = w.output_end)
+            output_ends.append((w, max(w.output_end, len(run_output.text))))
+
+            updates.append((w.run.id, run_state, run_logs, new_output))
+
+            if w.running_since is None and progress is not None \
+                    and progress.running + progress.completed > 0:
+                w.running_since = time()
+
+            if run_state in [RunState.FINISHED, RunState.FAILED]:
+                ended.append((w, run_state))
+            else:
+                w.delay = next_delay(w.delay, w.progress, progress)
+                w.progress = progress
+                w.next_poll = monotonic() + w.delay
+
+        try:
+            failed = await db.put_run_updates(updates)
+        except Exception as e:
+            # The runs still going will be updated at their next poll, but the
+            # final state of the ended ones is lost.
+            logger.error(f"Could not put the updates of {len(updates)} runs into db: {e!r}")
+            ended = [(w, e) for w, _ in ended]
+        else:
+            for w, output_end in output_ends:
+                if w.run.id not in failed:
+                    w.output_end = output_end
+
+            # Only the runs whose updates failed stop being watched: their
+            # watchers fail with the error.
+            ended = [(w, outcome) for w, outcome in ended if w.run.id not in failed]
+            ended.extend((w, failed[w.run.id]) for w, _ in output_ends if w.run.id in failed)
+
+        for w, outcome in ended:
+            del watched[w.run.id]
+            if not w.done.done():
+                if isinstance(outcome, BaseException):
+                    w.done.set_exception(outcome)
+                else:
+                    w.done.set_result(outcome)
+
+        if len(watched) > 0:
+            timeout = min(w.next_poll for w in watched.values()) - monotonic()
+            try:
+                await wait_for(wakeup.wait(), max(timeout, 0))
+            except TimeoutError:
+                pass
+            wakeup.clear()
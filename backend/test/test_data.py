@@ -5,15 +5,15 @@ from datetime import datetime
 code1 = Code(commit_hash = "code1hash", description = "whatevs", branch="test")
 code2 = Code(commit_hash = "code2hash", description = "whatevs", branch="test")
 
-run1 = Run(code = code1, timestamp = datetime.fromisoformat("2021-01-01 12:34"),
+run1 = Run(code = code1, timestamp = datetime.fromisoformat("2021-01-01 12:34").timestamp(),
         job_dir = "job/1/", output_dir = "output", script = "pi.sh",
         state = RunState.RUNNING)
-run2 = Run(code = code2, timestamp = datetime.fromisoformat("2080-08-08 01:48"),
+run2 = Run(code = code2, timestamp = datetime.fromisoformat("2080-08-08 01:48").timestamp(),
         job_dir = "job/2/", output_dir = "output", script = "tau.sh",
         state = RunState.RUNNING)
 
-log1 = Log(timestamp = "2021-01-01 12:34", stdout = "a", stderr = "b")
-log2 = Log(timestamp = "2021-01-01 12:34", stdout = "c", stderr = "e")
+log1 = Log(timestamp = datetime.fromisoformat("2021-01-01 12:34").timestamp(), stdout = "a", stderr = "b")
+log2 = Log(timestamp = datetime.fromisoformat("2021-01-01 12:34").timestamp(), stdout = "c", stderr = "e")
 
 
 def test_log_append() -> None:
@@ -61,3 +61,147 @@ def test_logs_add_all() -> None:
     assert combined[(run1, "context")] == [log1, log2]
     assert combined[(run2, "context2")] == [log2]
 
+
+def test_logs_builder() -> None:
+    builder = LogsBuilder()
+    assert builder.is_empty()
+
+    builder.add(run1, "context", log1)
+    builder.add_all(Logs.new((run1, "context", log2), (run2, "context2", log1)))
+    logs = builder.build()
+    assert logs[(run1, "context")] == [log1, log2]
+    assert logs[(run2, "context2")] == [log1]
+
+    # The builder starts over after building
+    assert builder.is_empty()
+    builder.add(run1, "context", log1)
+    assert logs[(run1, "context")] == [log1, log2]
+
+    # Logs of equal runs go together, whichever run was added last
+    builder.add(run2, "context", log2)
+    builder.add(run1.copy(), "context", log2)
+    logs = builder.build()
+    assert logs[(run1, "context")] == [log1, log2]
+    assert logs[(run2, "context")] == [log2]
+
+
+def test_posterior_sample_columns() -> None:
+    point1 = PosteriorSamplePoint(colony_id = 1,
+            nest_quality_assessment_error = 0.1, percentage_foragers = 20.0,
+            number_nests = 4, exploring_phase = 5000)
+    point2 = PosteriorSamplePoint(colony_id = 2,
+            nest_quality_assessment_error = 0.3, percentage_foragers = 10.0,
+            number_nests = 10, exploring_phase = 1000)
+    sample = PosteriorSample(data = [point1, point2])
+
+    columns = PosteriorSampleColumns.from_sample(sample)
+    assert len(columns) == 2
+    assert columns.to_dict()["colony_id"] == [1, 2]
+    assert columns.to_sample() == sample
+
+    # Round trip through the raw buffers stored in the database
+    assert PosteriorSampleColumns.from_buffers(2, columns.to_buffers()) == columns
+
+    # Truncated buffers are detected
+    buffers = columns.to_buffers()
+    buffers["percentage_foragers"] = buffers["percentage_foragers"][:-1]
+    with pytest.raises(ValueError):
+        PosteriorSampleColumns.from_buffers(2, buffers)
+
+    combined = PosteriorSampleColumns.from_list([columns, columns])
+    assert combined.to_dict()["exploring_phase"] == [5000, 1000, 5000, 1000]
+    assert len(PosteriorSampleColumns.empty()) == 0
+
+
+def test_job_progress_completed_fraction() -> None:
+    assert JobProgress(ready = 1, running = 2, completed = 1).completed_fraction() == 0.25
+    assert JobProgress(ready = 0, running = 0, completed = 0).completed_fraction() == 0.0
+
+
+def test_run_timeline() -> None:
+    spans = [Span(name = "upload", start = 12.0, end = 15.0),
+            Span(name = "fetch", start = 10.0, end = 11.0),
+            Span(name = "repository_lock", start = 10.0, end = 10.5)]
+
+    timeline = RunTimeline.from_spans(1, spans)
+    assert timeline.start == 10.0
+    assert timeline.duration == 5.0
+    assert [(b.name, b.offset, b.duration) for b in timeline.bars] == [
+            ("fetch", 0.0, 1.0), ("repository_lock", 0.0, 0.5), ("upload", 2.0, 3.0)]
+    assert RunTimeline.from_spans(2, []).bars == []
+
+    summary = TimelineSummary.from_spans({1: spans,
+        2: [Span(name = "fetch", start = 0.0, end = 3.0)]})
+    assert summary.runs == 2
+    assert [s.name for s in summary.spans] == ["fetch", "upload", "repository_lock"]
+    assert summary.spans[0].count == 2
+    assert summary.spans[0].mean == 2.0
+    assert summary.spans[0].max == 3.0
+
+
+def test_posterior_summary() -> None:
+    rng = np.random.default_rng(0)
+    size = 2000
+    columns = PosteriorSampleColumns(
+            colony_id = np.repeat([3, 1], size // 2),
+            nest_quality_assessment_error = rng.normal(0.5, 0.1, size),
+            percentage_foragers = rng.uniform(0, 100, size),
+            number_nests = np.full(size, 4),
+            exploring_phase = rng.integers(0, 10000, size))
+
+    summary = PosteriorSummary.from_columns(columns)
+
+    assert [c.colony_id for c in summary.colonies] == [1, 3]
+    assert [c.size for c in summary.colonies] == [size // 2, size // 2]
+
+    error = summary.colonies[0].parameters["nest_quality_assessment_error"]
+    assert len(error.x) == len(error.density) == DENSITY_STEPS
+    assert abs(error.mean - 0.5) < 0.02
+    assert abs(error.quantiles[QUANTILE_LEVELS.index(0.5)] - 0.5) < 0.02
+    # The density integrates to about 1
+    assert abs(sum(error.density) * (error.x[1] - error.x[0]) - 1) < 0.01
+
+    # All values equal
+    nests = summary.colonies[0].parameters["number_nests"]
+    assert nests.mean == 4
+    assert max(nests.density) > 0
+
+
+def test_posterior_sample_columns_from_csv_string() -> None:
+    colony = Colony(colony_id = 3)
+    header = "nest_quality_assessment_error,percentage_foragers,number_nests_dbl,exploring_phase_dbl\n"
+
+    columns = PosteriorSampleColumns.from_csv_string(
+            header + "0.1,20,4.7,5000.2\n0.2,30,3,100\n", colony)
+    assert columns.to_dict() == {
+            "colony_id": [3, 3],
+            "nest_quality_assessment_error": [0.1, 0.2],
+            "percentage_foragers": [20.0, 30.0],
+            "number_nests": [4, 3],
+            "exploring_phase": [5000, 100]}
+
+    assert len(PosteriorSampleColumns.from_csv_string(header, colony)) == 0
+
+    # Quoted and padded fields are read like the header
+    quoted = PosteriorSampleColumns.from_csv_string(
+            '"nest_quality_assessment_error", "percentage_foragers",number_nests_dbl,exploring_phase_dbl\n'
+            '"0.1", 20 ,"4.7", "5000.2"\n0.2,30,3,100\n', colony)
+    assert quoted == columns
+
+    # The row at fault is reported, the header being row 1
+    with pytest.raises(ValueError, match = "Row 3"):
+        PosteriorSampleColumns.from_csv_string(header + "0.1,20,4,5000\n0.2,120,3,100\n", colony)
+    with pytest.raises(ValueError, match = "Row 2"):
+        PosteriorSampleColumns.from_csv_string(header + "0.1,abc,4,5000\n", colony)
+
+    # Blank lines are counted, whichever the error
+    with pytest.raises(ValueError, match = "Row 4"):
+        PosteriorSampleColumns.from_csv_string(header + "0.1,20,4,5000\n\n0.2,120,3,100\n", colony)
+    with pytest.raises(ValueError, match = "Row 4"):
+        PosteriorSampleColumns.from_csv_string(header + "\n0.1,20,4,5000\n0.1,abc,4,5000\n", colony)
+
+    # Integers out of range are not wrapped around
+    with pytest.raises(ValueError, match = "Row 2, number_nests"):
+        PosteriorSampleColumns.from_csv_string(header + "0.1,20,4e12,5000\n", colony)
+    with pytest.raises(ValueError, match = "Row 2, exploring_phase"):
+        PosteriorSampleColumns.from_csv_string(header + "0.1,20,4,-3e9\n", colony)
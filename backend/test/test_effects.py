@@ -1,11 +1,20 @@
 import pytest
+import pytest_asyncio
 from src import openmole
 from src import db
 from src import tasks
+from src import repository
+from src import response_cache
 from src.data import *
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.sql import Select
 from datetime import datetime
+from typing import AsyncIterator, Optional
+from fastapi import Request
+from prometheus_client import REGISTRY, generate_latest
+from os import makedirs
+from os.path import dirname, exists
+from uuid import uuid4
 
 code = Code(
         commit_hash = 'ed74e56c08c7ca3ea5df392f3517ca4ae3f006e8',
@@ -14,19 +23,33 @@ code = Code(
 
 run = Run(
         code = code,
-        timestamp=datetime(2020, 1, 1, 12, 13),
+        timestamp=datetime(2020, 1, 1, 12, 13).timestamp(),
         job_dir = 'openmole',
         output_dir = 'output',
         script ='Colony_fission_ABC.oms',
         state = RunState.RUNNING)
 
 
+@pytest_asyncio.fixture(autouse = True)
+async def database() -> AsyncIterator[None]:
+    await db.init()
+    await openmole.init()
+    yield
+    # Pooled connections are bound to the event loop of the test that opened
+    # them.
+    await openmole.close()
+    await db.engine.dispose()
+
+
 @pytest.mark.asyncio
 async def test_do_run() -> None:
 
-    run_id = await tasks.do_run(run)
+    run_id = (await db.create_run(run)).id
+    jobs = {j.run.id: j for j in await db.lease_jobs(tasks.WORKER_ID, 1000, 60)}
+
+    await tasks.do_run(jobs[run_id])
 
-    sample = db.get_posterior_sample(run_id)
+    sample = await db.get_posterior_sample(run_id)
 
     if sample is not None:
         assert len(sample.data) == 9500
@@ -34,52 +57,55 @@ async def test_do_run() -> None:
         assert False, f"Posterior sample for run {run_id} is None."
 
 
-def test_db_create_run() -> None:
-    run_id = db.create_run(run)
+@pytest.mark.asyncio
+async def test_db_create_run() -> None:
+    run_id = (await db.create_run(run)).id
 
-    result = db.get_run(run_id)
+    result = await db.get_run(run_id)
 
     assert result == run
 
 
-def test_db_put_logs() -> None:
+@pytest.mark.asyncio
+async def test_db_put_logs() -> None:
     context = "some context"
     log1 = Log(
-            timestamp = "2021-09-01 12:00:00",
+            timestamp = datetime.fromisoformat("2021-09-01 12:00:00").timestamp(),
             stdout = "some output",
             stderr = "some error")
     log2 = Log(
-            timestamp = "2021-09-01 13:00:00",
+            timestamp = datetime.fromisoformat("2021-09-01 13:00:00").timestamp(),
             stdout = "some output",
             stderr = "some error")
     logs = Logs.new((run, context, log1), (run, context, log2))
 
-    run_id = db.create_run(run)
+    run_id = (await db.create_run(run)).id
 
-    db.put_logs(run_id, logs)
+    await db.put_logs(run_id, logs)
 
     for l_run, l_context, l in logs.items():
-        res = db.get_logs(run_id)
+        res = await db.get_logs(run_id)
         assert res == logs
 
 
-def test_db_get_logs() -> None:
+@pytest.mark.asyncio
+async def test_db_get_logs() -> None:
     context = "get_logs_context"
     log1 = Log(
-            timestamp = "2021-09-01 12:00:00",
+            timestamp = datetime.fromisoformat("2021-09-01 12:00:00").timestamp(),
             stdout = "some output",
             stderr = "some error")
     log2 = Log(
-            timestamp = "2021-09-01 13:00:00",
+            timestamp = datetime.fromisoformat("2021-09-01 13:00:00").timestamp(),
             stdout = "some output",
             stderr = "some error")
     logs = Logs.new((run, context, log1), (run, context, log2))
 
-    run_id = db.create_run(run)
+    run_id = (await db.create_run(run)).id
 
-    db.put_logs(run_id, logs)
+    await db.put_logs(run_id, logs)
 
-    res = db.get_logs(run_id)
+    res = await db.get_logs(run_id)
     if res is None:
         assert False, "res is None"
     else:
@@ -87,7 +113,8 @@ def test_db_get_logs() -> None:
         assert log1 in log_list
         assert log2 in log_list
 
-    res = db.get_logs(run_id, datetime.fromisoformat("2021-09-01 13:00:00"))
+    # Only the logs strictly after the time
+    res = await db.get_logs(run_id, datetime.fromisoformat("2021-09-01 12:00:00").timestamp())
     if res is None:
         assert False, "res is None"
     else:
@@ -95,36 +122,110 @@ def test_db_get_logs() -> None:
         assert log1 not in log_list
         assert log2 in log_list
 
-    res = db.get_logs(run_id, datetime.fromisoformat("2021-09-01 14:00:00"))
+    res = await db.get_logs(run_id, datetime.fromisoformat("2021-09-01 14:00:00").timestamp())
     if res is None:
         assert False, "res is None"
     else:
         assert res == Logs.empty()
 
 
-def test_db_put_run_output() -> None:
+@pytest.mark.asyncio
+async def test_db_logs_after() -> None:
+    context = "logs_after_context"
+    first = Log(timestamp = 1.0, stdout = "first", stderr = "")
+    second = Log(timestamp = 1.0, stdout = "second", stderr = "")
+
+    run_id = (await db.create_run(run)).id
+
+    await db.put_logs(run_id, Logs.new((run, context, first)))
+    logs, cursor = await db.get_logs_after(run_id)
+    assert logs == Logs.new((run, context, first))
+    assert cursor is not None
+
+    # An entry with the same timestamp as the last one read is not missed
+    await db.put_logs(run_id, Logs.new((run, context, second)))
+    logs, cursor = await db.get_logs_after(run_id, cursor)
+    assert logs == Logs.new((run, context, second))
+
+    assert await db.get_logs_after(run_id, cursor) == (Logs.empty(), None)
+
+
+@pytest.mark.asyncio
+async def test_db_repeated_logs() -> None:
+    context = PROGRESS_CONTEXT
+    progress = [Log(timestamp = t, stdout = "Jobs ready: 1", stderr = "") for t in [1.0, 2.0, 3.0]]
+    changed = Log(timestamp = 4.0, stdout = "Jobs ready: 0", stderr = "")
+    long_error = "Error\n" * 1000
+
+    run_id = (await db.create_run(run)).id
+
+    await db.put_logs(run_id, Logs.new((run, context, progress[0])))
+    await db.put_logs(run_id, Logs.new((run, context, progress[1]), (run, context, progress[2])))
+
+    repeated = Log(timestamp = 1.0, stdout = "Jobs ready: 1", stderr = "",
+            last_timestamp = 3.0, repeat = 3)
+    assert await db.get_logs(run_id) == Logs.new((run, context, repeated))
+    # Not sent again to the clients that had the first occurrence
+    assert await db.get_logs(run_id, 1.0) == Logs.empty()
+
+    await db.put_run_updates([(run_id, None, Logs.new((run, context, changed),
+        (run, "backend", Log(timestamp = 5.0, stdout = "", stderr = long_error))),
+        RunOutput(text = "", offset = 0))])
+
+    res = await db.get_logs(run_id)
+    assert res[(run, context)] == [repeated, changed]
+    assert res[(run, "backend")][0].stderr == long_error
+
+    # The long text is stored compressed
+    async with db.new_session() as session:
+        stored = (await session.execute(select(db.Log).where(db.Log.run_id == run_id,
+            db.Log.context == "backend"))).scalars().one()
+    assert stored.stderr == ""
+    assert stored.stderr_zlib is not None and len(stored.stderr_zlib) < len(long_error)
+
+    # Only progress entries are collapsed
+    await db.put_logs(run_id, Logs.new((run, "backend", Log(timestamp = 6.0, stdout = "",
+        stderr = long_error))))
+    assert len((await db.get_logs(run_id))[(run, "backend")]) == 2
+
+
+@pytest.mark.asyncio
+async def test_db_put_run_output() -> None:
     run_output = RunOutput(text = "some run output")
 
-    run_id = db.create_run(run)
+    run_id = (await db.create_run(run)).id
 
-    db.put_run_output(run_id, run_output)
+    await db.put_run_output(run_id, run_output)
 
-    result = db.get_run_output(run_id)
+    result = await db.get_run_output(run_id)
 
     if result is not None:
         assert run_output == RunOutput.from_orm(result)
     else:
         assert False, f"Run output for run {run_id} is None."
 
+    # Output is appended
+    await db.put_run_output(run_id, RunOutput(text = ", continued", offset = 15))
 
-def test_db_put_run_state() -> None:
-    run_id = db.create_run(run)
+    assert (await db.get_run_output(run_id)) == \
+            RunOutput(text = "some run output, continued")
+    assert (await db.get_run_output(run_id, 5)) == \
+            RunOutput(text = "run output, continued", offset = 5)
+    assert (await db.get_run_output(run_id, 15)) == \
+            RunOutput(text = ", continued", offset = 15)
+    assert (await db.get_run_output(run_id, 26)) == \
+            RunOutput(text = "", offset = 26)
 
-    db.put_run_state(run_id, RunState.FINISHED)
 
-    with Session(db.engine) as session:
+@pytest.mark.asyncio
+async def test_db_put_run_state() -> None:
+    run_id = (await db.create_run(run)).id
+
+    await db.put_run_state(run_id, RunState.FINISHED)
+
+    async with db.new_session() as session:
             stmt = select(db.Run).where(db.Run.id == run_id)
-            res_run = session.execute(stmt).scalar_one()
+            res_run = (await session.execute(stmt)).scalar_one()
             assert res_run.state == RunState.FINISHED
             assert res_run.code_id == run.code.commit_hash
             assert res_run.timestamp == run.timestamp
@@ -133,7 +234,41 @@ def test_db_put_run_state() -> None:
             assert res_run.script == run.script
 
 
-def test_db_put_posterior_sample() -> None:
+@pytest.mark.asyncio
+async def test_db_put_run_updates() -> None:
+    run_id1 = (await db.create_run(run)).id
+    run_id2 = (await db.create_run(run)).id
+
+    log = Log(
+            timestamp = datetime.fromisoformat("2021-09-01 12:00:00").timestamp(),
+            stdout = "some output",
+            stderr = "")
+
+    await db.put_run_updates([
+        (run_id1, RunState.FINISHED, Logs.new((run, "openmole", log)), RunOutput(text = "output 1")),
+        (run_id2, None, Logs.empty(), RunOutput(text = "output 2"))])
+
+    finished_run = run.copy(update = {"state": RunState.FINISHED})
+    assert (await db.get_run(run_id1)) == finished_run
+    assert (await db.get_run(run_id2)) == run
+    assert (await db.get_logs(run_id1))[(finished_run, "openmole")] == [log]
+    assert (await db.get_run_output(run_id1)) == RunOutput(text = "output 1")
+    assert (await db.get_run_output(run_id2)) == RunOutput(text = "output 2")
+
+    # A run whose updates fail does not keep the others from being written,
+    # and output written again at the same offset is ignored.
+    missing_run_id = max(run_id1, run_id2) + 1000
+    failed = await db.put_run_updates([
+        (missing_run_id, None, Logs.empty(), RunOutput(text = "output")),
+        (run_id1, None, Logs.empty(), RunOutput(text = "output 1")),
+        (run_id2, None, Logs.empty(), RunOutput(text = " and more", offset = 8))])
+    assert list(failed) == [missing_run_id]
+    assert (await db.get_run_output(run_id1)) == RunOutput(text = "output 1")
+    assert (await db.get_run_output(run_id2)) == RunOutput(text = "output 2 and more")
+
+
+@pytest.mark.asyncio
+async def test_db_put_posterior_sample() -> None:
 
     posterior_sample = PosteriorSample(
             data = [PosteriorSamplePoint(
@@ -150,9 +285,10 @@ def test_db_put_posterior_sample() -> None:
                      exploring_phase = 1000)
                     ])
 
-    run_id = db.create_run(run)
-    db.put_posterior_sample(run_id, posterior_sample)
-    result = db.get_posterior_sample(run_id)
+    run_id = (await db.create_run(run)).id
+    await db.put_posterior_sample(run_id,
+            PosteriorSampleColumns.from_sample(posterior_sample))
+    result = await db.get_posterior_sample(run_id)
 
     if result is not None:
         assert posterior_sample.data[0] in result.data
@@ -160,23 +296,32 @@ def test_db_put_posterior_sample() -> None:
     else:
         assert False, f"Posterior sample for run {run_id} is None."
 
+    result_columns = await db.get_posterior_sample_columns(run_id)
+
+    if result_columns is not None:
+        assert result_columns == PosteriorSampleColumns.from_sample(posterior_sample)
+    else:
+        assert False, f"Posterior sample columns for run {run_id} is None."
 
 
-def test_db_delete_run() -> None:
 
-    run_id = db.create_run(run)
+@pytest.mark.asyncio
+async def test_db_delete_run() -> None:
+
+    run_id = (await db.create_run(run)).id
 
-    db.delete_run(run_id)
-    result = db.get_run(run_id)
+    await db.delete_run(run_id)
+    result = await db.get_run(run_id)
 
     assert result is None
 
 
-def test_db_all_runs() -> None:
+@pytest.mark.asyncio
+async def test_db_all_runs() -> None:
 
     run1 = Run(
             code = code,
-            timestamp=datetime(2020, 1, 1, 12, 13),
+            timestamp=datetime(2020, 1, 1, 12, 13).timestamp(),
             job_dir = 'openmole',
             output_dir = 'output',
             script ='Colony_fission_ABC.oms',
@@ -184,19 +329,97 @@ def test_db_all_runs() -> None:
 
     run2 = Run(
             code = code,
-            timestamp=datetime(2021, 1, 1, 12, 13),
+            timestamp=datetime(2021, 1, 1, 12, 13).timestamp(),
             job_dir = 'openmole',
             output_dir = 'output',
             script ='Colony_fission_ABC.oms',
             state = RunState.RUNNING)
 
-    db.create_run(run1)
-    db.create_run(run2)
+    run1_with_id = await db.create_run(run1)
+    run2_with_id = await db.create_run(run2)
+
+    runs = await db.get_all_runs()
+
+    assert run1_with_id in runs
+    assert run2_with_id in runs
+
+
+@pytest.mark.asyncio
+async def test_db_all_runs_pages() -> None:
+    # Unique to this test run, so that the runs of earlier ones are not listed.
+    paged_name = f"test_db_all_runs_pages_{uuid4().hex}"
+    paged_code = Code(commit_hash = paged_name, description = "whatevs",
+            branch = paged_name)
+    paged_runs = [await db.create_run(Run(
+            code = paged_code,
+            timestamp = datetime(2019, 1, 1, 12, i).timestamp(),
+            job_dir = 'openmole',
+            output_dir = 'output',
+            script ='Colony_fission_ABC.oms',
+            state = RunState.RUNNING)) for i in range(5)]
+
+    # Most recent first, two at a time
+    page1 = await db.get_all_runs(limit = 2, branch = paged_code.branch)
+    assert [r.id for r in page1] == [paged_runs[4].id, paged_runs[3].id]
+    page2 = await db.get_all_runs(limit = 2, branch = paged_code.branch,
+            after = (page1[-1].timestamp, page1[-1].id))
+    assert [r.id for r in page2] == [paged_runs[2].id, paged_runs[1].id]
 
-    runs = db.get_all_runs()
+    # Only the runs whose state changed
+    changed_since = datetime.now().timestamp()
+    await db.put_run_state(paged_runs[1].id, RunState.FINISHED)
+    changed = await db.get_all_runs(changed_since = changed_since - 0.001,
+            commit_hash = paged_code.commit_hash)
+    assert [r.id for r in changed] == [paged_runs[1].id]
 
-    assert run1 in runs
-    assert run2 in runs
+    finished = await db.get_all_runs(state = RunState.FINISHED, branch = paged_code.branch)
+    assert [r.id for r in finished] == [paged_runs[1].id]
+
+
+@pytest.mark.asyncio
+async def test_archive_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    cached_run = Run(
+            code = code,
+            timestamp=datetime(2022, 1, 1, 12, 13).timestamp(),
+            job_dir = 'test_archive_cache',
+            output_dir = 'output',
+            script ='Colony_fission_ABC.oms',
+            state = RunState.RUNNING)
+
+    tmp_path = repository.cache_tmp_path(cached_run)
+    makedirs(dirname(tmp_path), exist_ok = True)
+    with open(tmp_path, "wb") as f:
+        f.write(b"some archive")
+
+    archive_path = await repository.cache_insert(cached_run, tmp_path)
+    assert await repository.cache_lookup(cached_run) == archive_path
+
+    # An unchanged archive is not hashed again on a hit.
+    def no_digest(file_path: str) -> str:
+        raise AssertionError(f"{file_path} hashed again")
+    with monkeypatch.context() as m:
+        m.setattr(repository, "file_digest", no_digest)
+        assert await repository.cache_lookup(cached_run) == archive_path
+
+    # A corrupted archive is a cache miss and is removed.
+    with open(archive_path, "wb") as f:
+        f.write(b"some corrupted archive")
+    assert await repository.cache_lookup(cached_run) is None
+    assert not exists(archive_path)
+
+    # An archive in use is not evicted, even from a cache over its size.
+    monkeypatch.setattr(repository, "ARCHIVE_CACHE_MAX_SIZE", 0)
+    with open(tmp_path, "wb") as f:
+        f.write(b"some archive")
+    archive_path = await repository.cache_insert(cached_run, tmp_path)
+    async with repository.cache_hold(archive_path) as held:
+        assert held
+        repository.cache_evict(keep = "")
+        assert await repository.cache_lookup(cached_run) == archive_path
+    repository.cache_evict(keep = "")
+    assert not exists(archive_path)
+    async with repository.cache_hold(archive_path) as held:
+        assert not held
 
 
 # @pytest.mark.asyncio
@@ -258,3 +481,166 @@ def test_db_all_runs() -> None:
 #         session.merge(child)
 #         session.commit()
 #         print("child.id = " + str(child.id))
+
+
+@pytest.mark.asyncio
+async def test_response_cache() -> None:
+    run_id = (await db.create_run(run)).id
+
+    def request(if_none_match: str = "", accept_encoding: str = "",
+            path: str = "test_response_cache") -> Request:
+        return Request({"type": "http", "method": "GET",
+            "path": f"/{path}/{run_id}", "query_string": b"",
+            "headers": [(b"if-none-match", if_none_match.encode("utf-8")),
+                (b"accept-encoding", accept_encoding.encode("utf-8"))]})
+
+    loads = 0
+    async def load(r: Run) -> Optional[bytes]:
+        nonlocal loads
+        loads += 1
+        return r.json().encode("utf-8")
+
+    # Not cached while the run is running, but not sent again if unchanged
+    response = await response_cache.run_response(request(), run_id, load)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    response = await response_cache.run_response(request(etag), run_id, load)
+    assert response.status_code == 304
+    assert loads == 2
+
+    # Cached once the run failed
+    await db.put_run_state(run_id, RunState.FAILED)
+    response = await response_cache.run_response(request(), run_id, load)
+    assert "immutable" in response.headers["cache-control"]
+    response = await response_cache.run_response(request(), run_id, load)
+    assert response.status_code == 200
+    assert loads == 3
+
+    # ETags are compared whole, weak or in a list
+    etag = response.headers["etag"]
+    response = await response_cache.run_response(request(f'"other", W/{etag}'), run_id, load)
+    assert response.status_code == 304
+    response = await response_cache.run_response(request(etag[:-2] + '"'), run_id, load)
+    assert response.status_code == 200
+
+    # Compressed once cached, for the clients accepting gzip only
+    async def load_large(r: Run) -> Optional[bytes]:
+        return r.json().encode("utf-8") * 100
+
+    await db.put_run_state(run_id, RunState.RUNNING)
+    response = await response_cache.run_response(
+            request(accept_encoding = "gzip", path = "large"), run_id, load_large)
+    assert "content-encoding" not in response.headers
+    await db.put_run_state(run_id, RunState.FAILED)
+    response = await response_cache.run_response(
+            request(accept_encoding = "gzip;q=0", path = "large"), run_id, load_large)
+    assert "content-encoding" not in response.headers
+    response = await response_cache.run_response(
+            request(accept_encoding = "br, gzip", path = "large"), run_id, load_large)
+    assert response.headers["content-encoding"] == "gzip"
+
+
+async def query_plan(stmt: Select) -> str:
+    """The plan of the query, with sequential scans made as expensive as
+    possible: the planner only uses one if no index fits."""
+    sql = str(stmt.compile(dialect = db.engine.dialect,
+        compile_kwargs = {"literal_binds": True}))
+    async with db.engine.begin() as conn:
+        await conn.execute(text("SET LOCAL enable_seqscan = off"))
+        rows = (await conn.execute(text("EXPLAIN " + sql))).all()
+    return "\n".join(row[0] for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_query_plans() -> None:
+    """The queries behind the endpoints use the indexes of the tables."""
+    queries = {
+        "all_runs": db.all_runs_query(limit = 100),
+        "all_runs after": db.all_runs_query(limit = 100, after = (run.timestamp, 1)),
+        "all_runs by commit": db.all_runs_query(limit = 100, commit_hash = code.commit_hash),
+        "all_runs by branch": db.all_runs_query(limit = 100, branch = code.branch),
+        "all_runs changed_since": db.all_runs_query(changed_since = run.timestamp),
+        "logs": db.logs_query(1),
+        "logs from_time": db.logs_query(1, (run.timestamp, None)),
+        "logs after": db.logs_query(1, (run.timestamp, 1)),
+        "output": db.run_output_query(1, 10),
+        "posterior_sample": db.posterior_sample_query(1),
+    }
+
+    for name, stmt in queries.items():
+        plan = await query_plan(stmt)
+        assert "Seq Scan" not in plan, f"Sequential scan for {name}:\n{plan}"
+
+    # The commits of a branch are found with its index, not by a full scan of
+    # the primary key of the codes
+    plan = await query_plan(select(db.Code.commit_hash).where(db.Code.branch == code.branch))
+    assert "ix_code_branch_commit_hash" in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_run_queue() -> None:
+    run_id = (await db.create_run(run)).id
+
+    # Created runs are queued, and leased by a single worker
+    jobs = {j.run.id: j for j in await db.lease_jobs("worker1", 1000, 60)}
+    assert jobs[run_id].stage == JobStage.SUBMIT
+    assert run_id not in [j.run.id for j in await db.lease_jobs("worker2", 1000, 60)]
+
+    # Only the worker holding the lease moves the job on
+    assert not await db.put_job_stage(run_id, "worker2", JobStage.WATCH, "om_id")
+    assert await db.put_job_stage(run_id, "worker1", JobStage.WATCH, "om_id")
+
+    # Released jobs are resumed at their stage
+    await db.release_leases("worker1")
+    jobs = {j.run.id: j for j in await db.lease_jobs("worker2", 1000, 60)}
+    assert jobs[run_id].stage == JobStage.WATCH
+    assert jobs[run_id].om_run_id == "om_id"
+
+    # A failed attempt is retried after the delay, until there are no attempts
+    # left
+    assert await db.retry_job(run_id, "worker2", "error", lambda attempts: 0)
+    jobs = {j.run.id: j for j in await db.lease_jobs("worker2", 1000, 60)}
+    assert jobs[run_id].attempts == 1
+    assert not await db.retry_job(run_id, "worker2", "error", lambda attempts: None)
+
+    await db.finish_job(run_id, "worker2")
+    assert run_id not in [j.run.id for j in await db.lease_jobs("worker2", 1000, 0)]
+
+    # A worker does not lease again the jobs it still executes, whose lease
+    # expired
+    other_run_id = (await db.create_run(run)).id
+    assert other_run_id in [j.run.id for j in await db.lease_jobs("worker3", 1000, 0)]
+    assert other_run_id not in [j.run.id for j in
+            await db.lease_jobs("worker3", 1000, 0, exclude = [other_run_id])]
+    await db.finish_job(other_run_id, "worker3")
+
+
+@pytest.mark.asyncio
+async def test_db_spans() -> None:
+    run_id = (await db.create_run(run)).id
+    other_run_id = (await db.create_run(run)).id
+
+    await db.put_span(run_id, Span(name = "upload", start = 2.0, end = 3.0))
+    await db.put_span(run_id, Span(name = "fetch", start = 1.0, end = 2.0))
+    await db.put_span(other_run_id, Span(name = "fetch", start = 4.0, end = 6.0))
+
+    assert [s.name for s in await db.get_spans(run_id)] == ["fetch", "upload"]
+
+    recent = await db.get_recent_spans(1)
+    assert list(recent) == [other_run_id]
+    assert recent[other_run_id] == [Span(name = "fetch", start = 4.0, end = 6.0)]
+
+    await db.delete_run(run_id)
+    assert await db.get_spans(run_id) == []
+
+
+@pytest.mark.asyncio
+async def test_metrics() -> None:
+    def create_run_count() -> float:
+        return REGISTRY.get_sample_value("backend_db_write_seconds_count",
+                {"operation": "create_run"}) or 0.0
+
+    before = create_run_count()
+    await db.create_run(run)
+    assert create_run_count() == before + 1
+    assert b"backend_watched_runs" in generate_latest()
@@ -1,12 +1,11 @@
 import {useReducer, useEffect, memo} from 'react';
 import './App.css';
 import {UiState, HomeView, newHomeView, RunView, mkRun, LaunchNotInitiated, 
-  LaunchInitiated, LaunchSuccessful, LaunchFailed, addLogs, getLastLogTimestamp, 
+  LaunchInitiated, LaunchSuccessful, LaunchFailed, addLogs, mergeRuns,
   runStateColor} from './Core';
-import {fetchBranches, fetchCommits, fetchAllRuns, launchRun, fetchNewLogs,
-  fetchRun, fetchRunOutput, fetchRunResults} from './Requests';
-import {RUN_STATE_UPDATE_INTERVAL, RUN_OUTPUT_UPDATE_INTERVAL,
-  RUN_RESULTS_UPDATE_INTERVAL, RUN_LOGS_UPDATE_INTERVAL} from './Constants';
+import {fetchBranches, fetchCommits, fetchRunPage, launchRun,
+  fetchRunResults, subscribeRunEvents} from './Requests';
+import {RUN_STATE_UPDATE_INTERVAL} from './Constants';
 import {formatDate, shortDate, set_, equals, dateFromUnixEpoch} from './Util';
 import embed from 'vega-embed';
 
@@ -33,12 +32,22 @@ function reducer(state, action) {
     case "homeView.runListView.runList/addRun":
       return set_("view", "runListView", "runList")([action.value, ...state.view.runListView.runList])(state);
 
-    case "homeView.runListView.runList/set":
-      if (!equals(state.view.runListView.runList, action.value)) {
-        return set_("view", "runListView", "runList")(action.value)(state);
-      } else {
-        return state
+    case "homeView.runListView/setFirstPage":
+      state = set_("view", "runListView", "runList")(action.value.runs)(state);
+      state = set_("view", "runListView", "next")(action.value.next)(state);
+      return set_("view", "runListView", "changedSince")(action.value.changedSince)(state);
+
+    case "homeView.runListView/addPage":
+      state = set_("view", "runListView", "runList")(
+        mergeRuns(state.view.runListView.runList, action.value.runs, action.value.next))(state);
+      return set_("view", "runListView", "next")(action.value.next)(state);
+
+    case "homeView.runListView/mergeChanges":
+      if (action.value.runs.length > 0) {
+        state = set_("view", "runListView", "runList")(
+          mergeRuns(state.view.runListView.runList, action.value.runs, state.view.runListView.next))(state);
       }
+      return set_("view", "runListView", "changedSince")(action.value.changedSince)(state);
 
     case "runView.runLogsView.logs/set":
       let newLogs = action.value;
@@ -63,14 +72,15 @@ function reducer(state, action) {
         return state;
       }
 
-    case "runView.runOutputView.output/set":
-      const output = state.view.runOutputView.output;
-      const newOutput = action.value;
-      if (!equals(output, newOutput)) {
+    case "runView.runOutputView.output/add":
+      const {text, offset} = action.value;
+      const end = state.view.runOutputView.end;
+      // Ignore responses to outdated requests.
+      if (offset === end && text.length !== 0) {
+        const output = state.view.runOutputView.output || "";
         state = set_("view", "runOutputView", "notification")(undefined)(state);
-        if (newOutput) {
-          state = set_("view", "runOutputView", "output")(newOutput)(state);
-        }
+        state = set_("view", "runOutputView", "output")(output + text)(state);
+        state = set_("view", "runOutputView", "end")(end + [...text].length)(state);
       }
       return state;
 
@@ -81,11 +91,11 @@ function reducer(state, action) {
         return state;
       }
 
-    case "runView.runResultsView.posteriorSample/set":
-      if (!equals(action.value, state.view.runResultsView.posteriorSample)) {
+    case "runView.runResultsView.posteriorDensities/set":
+      if (!equals(action.value, state.view.runResultsView.posteriorDensities)) {
         if (action.value.length !== 0) {
           return set_("view", "runResultsView", "notification")(undefined)(
-            set_("view", "runResultsView", "posteriorSample")(action.value)(state)
+            set_("view", "runResultsView", "posteriorDensities")(action.value)(state)
           );
         } else if (!equals(state.view.runResultsView.notification, "Waiting for some results…")) {
           return set_("view", "runResultsView", "notification")("Waiting for some results…")(state);
@@ -183,23 +193,37 @@ function App(props) {
 const RunViewComp = memo((props) => {
    const dispatch = props.dispatch;
 
+   const runId = props.runView.run.id;
+
+   // All the updates of the run are pushed by the backend.
    useEffect(() => {
-     const fetch_ = () => {
-       (fetchRun(props.runView.run.id)
-         .then(newRun => {
-           props.dispatch({type: "runView.run/set", value: newRun});
+     let isMounted = true;
+
+     const fetchResults = () => (
+       fetchRunResults(runId)
+         .then(newResults => {
+           if (isMounted) {
+             dispatch({type: "runView.runResultsView.posteriorDensities/set", value: newResults});
+           }
          })
-       );
-     }
-
-     if (props.runView.run.isRunning()) {
-       fetch_();
-       let timer = setInterval(fetch_, RUN_STATE_UPDATE_INTERVAL);
-       return () => {
-         clearInterval(timer)
-       };
-     }
-   });
+         .catch(err => {
+           dispatch({type: "runView.runResultsView.notification/set", value: err.toString()});
+         })
+     );
+
+     const close = subscribeRunEvents(runId, {
+       onRun: newRun => dispatch({type: "runView.run/set", value: newRun}),
+       onLogs: newLogs => dispatch({type: "runView.runLogsView.logs/set", value: newLogs}),
+       onOutput: newOutput => dispatch({type: "runView.runOutputView.output/add", value: newOutput}),
+       onResults: fetchResults,
+       onError: err => dispatch({type: "runView.runLogsView.notification/set", value: err.toString()}),
+     });
+
+     return () => {
+       isMounted = false;
+       close();
+     };
+   }, [runId, dispatch]);
 
   return (
     <div>
@@ -235,36 +259,9 @@ const RunViewComp = memo((props) => {
 
 
 const RunResultsViewComp = memo((props) => {
-  const results = props.runResultsView.posteriorSample;
-  const run = props.run;
+  const results = props.runResultsView.posteriorDensities;
   const notification = props.runResultsView.notification;
   const visu = props.runResultsView.vegaSpec;
-  const dispatch = props.dispatch;
-
-  useEffect(() => {
-    let isMounted = true;
-    const fetch_ = () => {
-      (fetchRunResults(run.id)
-        .then(newResults => {
-          if(isMounted) {
-            dispatch({type: "runView.runResultsView.posteriorSample/set", value: newResults});
-          }
-        })
-        .catch(err => {
-            dispatch({type: "runView.runResults.notification/set", value: "Waiting for some results…"});
-        })
-      );
-    };
-
-    if (run.isRunning() || results === undefined) {
-      fetch_();
-      let timer = setInterval(fetch_, RUN_RESULTS_UPDATE_INTERVAL)
-      return () => {
-        isMounted = false;
-        clearInterval(timer)
-      };
-    }
-  });
 
   useEffect(() => {
     if (results) {
@@ -283,30 +280,8 @@ const RunResultsViewComp = memo((props) => {
 
 
 const RunOutputViewComp = memo((props) => {
-  const run = props.run;
   const output = props.runOutputView.output;
   const notification = props.runOutputView.notification;
-  const dispatch = props.dispatch;
-
-  useEffect(() => {
-    const fetch_ = () => {
-      (fetchRunOutput(run.id)
-        .then(newOutput => {
-          dispatch({type: "runView.runOutputView.output/set", value: newOutput});
-        })
-        .catch(err => {
-          dispatch({type: "runView.runOutputView.notification/set", value: "Waiting for some output…"})
-        })
-      );
-    }
-
-
-    if (run.isRunning() || output === undefined) {
-      fetch_();
-      let timer = setInterval(fetch_, RUN_OUTPUT_UPDATE_INTERVAL);
-      return () => clearInterval(timer);
-    }
-  });
 
   return (
     <div className="columns">
@@ -322,30 +297,7 @@ const RunOutputViewComp = memo((props) => {
 
 const RunLogsViewComp = memo((props) => {
   const logs = props.runLogsView.logs;
-  const run = props.run;
   const notification = props.runLogsView.notification;
-  const dispatch = props.dispatch;
-
-  useEffect(() => {
-    let lastLogTimestamp = getLastLogTimestamp(logs);
-    const fetch_ = () => (
-      fetchNewLogs(run.id, lastLogTimestamp)
-      .then(newLogs => {
-        dispatch({type: "runView.runLogsView.logs/set", value: newLogs});
-        const newLastLogTimestamp = getLastLogTimestamp(newLogs);
-        lastLogTimestamp = Math.max(lastLogTimestamp, newLastLogTimestamp);
-      })
-      .catch(err => {
-        dispatch({type: "runView.runLogsView.notification/set", value: err});
-      })
-    );
-
-    if (run.isRunning() || logs === undefined) {
-      fetch_();
-      let timer = setInterval(fetch_, RUN_LOGS_UPDATE_INTERVAL);
-      return () => clearInterval(timer);
-    }
-  });
 
   let logElements = [];
   for (let context in logs) {
@@ -355,6 +307,8 @@ const RunLogsViewComp = memo((props) => {
           <div className="column is-2">
             <p className="tag">{context}</p>
             <p className="">{shortDate(dateFromUnixEpoch(log.timestamp))}</p>
+            {log.repeat > 1 &&
+              <p className="">{log.repeat} times until {shortDate(dateFromUnixEpoch(log.last_timestamp))}</p>}
           </div>
           <div className="column">
             <p className="block is-family-monospace break-words p-3 m-0 mb-3 has-background-white">Stdout: {log.stdout}</p>
@@ -786,27 +740,51 @@ const CommitItem = memo((props) => {
 
 
 const RunListViewComp = memo((props) => {
+  const changedSince = props.runListView.changedSince;
+  const dispatch = props.dispatch;
+
+  // The first page is loaded once, then only the runs that changed are
+  // fetched. Each update sets a new `changedSince`, which restarts the timer.
   useEffect(() => {
     let isMounted = true;
 
-    const fetch_ = () => (fetchAllRuns()
-      .then(rs => {
+    const onError = err => {
+      dispatch({type: "homeView.runListView.notification/set", value: err});
+    };
+
+    if (changedSince === undefined) {
+      fetchRunPage()
+        .then(page => {
+          if (isMounted) {
+            dispatch({type: "homeView.runListView/setFirstPage", value: page});
+          }
+        })
+        .catch(onError);
+      return () => { isMounted = false; };
+    }
+
+    const fetchChanges = () => (fetchRunPage({changedSince: changedSince})
+      .then(page => {
         if (isMounted) {
-          props.dispatch({type: "homeView.runListView.runList/set", value: rs});
+          dispatch({type: "homeView.runListView/mergeChanges", value: page});
         }
       })
-      .catch(err => {
-        props.dispatch({type: "homeView.runListView.notification/set", value: err});
-      })
+      .catch(onError)
     );
 
-    fetch_();
-    let timer = setInterval(fetch_, RUN_STATE_UPDATE_INTERVAL);
+    let timer = setInterval(fetchChanges, RUN_STATE_UPDATE_INTERVAL);
     return () => {
       isMounted = false;
       clearInterval(timer);
     }
-  });
+  }, [changedSince, dispatch]);
+
+  const fetchNextPage = () => (fetchRunPage({after: props.runListView.next})
+    .then(page => dispatch({type: "homeView.runListView/addPage", value: page}))
+    .catch(err => {
+      dispatch({type: "homeView.runListView.notification/set", value: err});
+    })
+  );
 
   return (
     <div className="columns">
@@ -827,6 +805,15 @@ const RunListViewComp = memo((props) => {
               ))
           }</ul>
         </div>
+        {props.runListView.next !== undefined &&
+          <button
+            className="button is-fullwidth"
+            type="button"
+            onClick={fetchNextPage}
+          >
+            Load more runs.
+          </button>
+        }
       </div>
     </div>
   );
@@ -7,7 +7,7 @@ export function UiState(view) {
   this.openRunView = run => new RunView(
     run,
     new RunResultsView(undefined, visu, "Loading…"),
-    new OutputView(undefined, "Loading…"),
+    new OutputView(undefined, "Loading…", 0),
     new LogsView(undefined, "Loading…"),
     undefined);
 }
@@ -20,12 +20,18 @@ export function HomeView(runSetupTool, runListView) {
 export const newHomeView = () => (
   new HomeView(
     new RunSetupToolView(false, undefined, undefined, undefined, undefined, DEFAULT_JOB_DIR, DEFAULT_OUTPUT_DIR, DEFAULT_SCRIPT),
-    new RunListView([], undefined))
+    new RunListView([], undefined, undefined, undefined))
 );
 
-export function RunListView(runList, notification) {
+// `next` is the cursor of the next page of runs, undefined if all the runs are
+// loaded. `changedSince` is to be sent to the backend to get the runs that
+// changed since the list was last updated, undefined until the first page is
+// loaded.
+export function RunListView(runList, notification, next, changedSince) {
   this.runList = runList;
   this.notification = notification;
+  this.next = next;
+  this.changedSince = changedSince;
 
   this.addRun = x => this.runList.slice().unshift(x);
 }
@@ -53,15 +59,19 @@ export function RunView(run, runResultsView, runOutputView, runLogsView, notific
   this.close = () => newHomeView();
 }
 
-export function RunResultsView(posteriorSample, vegaSpec, notification) {
-  this.posteriorSample = posteriorSample;
+// `posteriorDensities` are the rows plotted by `vegaSpec`.
+export function RunResultsView(posteriorDensities, vegaSpec, notification) {
+  this.posteriorDensities = posteriorDensities;
   this.vegaSpec = vegaSpec;
   this.notification = notification;
 }
 
-export function OutputView(output, notification) {
+// `end` is the length of `output` in characters as counted by the backend, i.e.
+// in code points.
+export function OutputView(output, notification, end) {
   this.output = output;
   this.notification = notification;
+  this.end = end;
 }
 
 export function LogsView(logs, notification) {
@@ -118,6 +128,14 @@ export function LaunchFailed(error) {
   this.error = error;
 };
 
+// An entry read again with a new repeat count (see the backend `data.Log`)
+// keeps the timestamp of its first occurrence: it replaces the entry it
+// repeats.
+const repeats = (log, newLog) => (
+  newLog.last_timestamp != null && log.timestamp === newLog.timestamp &&
+    log.stdout === newLog.stdout && log.stderr === newLog.stderr
+);
+
 export const addLogs = (logs1, logs2) => {
     let result = {};
 
@@ -126,16 +144,45 @@ export const addLogs = (logs1, logs2) => {
     }
 
     for (let context in logs2) {
-      if (context in result) {
-        result[context] = [...result[context], ...logs2[context]];
-      } else {
-        result[context] = logs2[context];
+      let logs = [...(result[context] ?? [])];
+      for (let newLog of logs2[context]) {
+        if (logs.length > 0 && repeats(logs[logs.length - 1], newLog)) {
+          logs[logs.length - 1] = newLog;
+        } else {
+          logs.push(newLog);
+        }
       }
+      result[context] = logs;
     }
 
     return result;
 }
 
+// Most recent first, as sent by the backend.
+const compareRuns = (run1, run2) => (
+  run2.timestamp - run1.timestamp || run2.id - run1.id
+);
+
+// Merge the runs that changed into the run list, replacing the runs with the
+// same id. New runs are added unless they belong to pages that are not loaded
+// yet.
+export const mergeRuns = (runList, changedRuns, next) => {
+  const last = runList[runList.length - 1];
+  const changedById = new Map(changedRuns.map(r => [r.id, r]));
+
+  const result = runList.map(r => changedById.get(r.id) ?? r);
+  const ids = new Set(runList.map(r => r.id));
+
+  for (let run of changedRuns) {
+    if (!ids.has(run.id)
+        && (next === undefined || last === undefined || compareRuns(run, last) < 0)) {
+      result.push(run);
+    }
+  }
+
+  return result.sort(compareRuns);
+}
+
 export const getLastLogTimestamp = (logs) => {
   let result = 0;
 
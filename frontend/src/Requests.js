@@ -29,14 +29,24 @@ export async function fetchCommits(branch) {
 }
 
 
-export async function fetchAllRuns(branch) {
+// A page of the run list: the runs after the cursor `after` (from the
+// beginning if undefined), or only those that changed since `changedSince`.
+export async function fetchRunPage({after, changedSince} = {}) {
   let req = new URL("all_runs", BACKEND_BASE_URL);
+  if (after !== undefined) {
+    req.searchParams.set("after", after);
+  }
+  if (changedSince !== undefined) {
+    req.searchParams.set("changed_since", changedSince);
+  }
   const errorMsg = "Could not fetch run list.";
   return (fetch(req)
     .catch(throwNetworkError(req,errorMsg))
     .then(jsonOrThrowHttpError(req, errorMsg))
-    .then(json => json.map(run => {
-      return new Run(
+    .then(json => ({
+      next: json.next ?? undefined,
+      changedSince: json.changed_since,
+      runs: json.runs.map(run => new Run(
         run.id,
         new Code(
           run.code.commit_hash,
@@ -48,7 +58,7 @@ export async function fetchAllRuns(branch) {
         run.output_dir,
         run.script,
         runStateLabel(run.state)
-      )
+      ))
     }))
   );
 }
@@ -122,30 +132,90 @@ export async function fetchRun(runId) {
 }
 
 
-export async function fetchRunOutput(runId) {
+// Resolves to {text, offset}: the output from `fromOffset` characters on.
+export async function fetchRunOutput(runId, fromOffset) {
   let req = new URL("output/" + runId, BACKEND_BASE_URL);
+  req.searchParams.set("from_offset", fromOffset);
   const errorMsg = "Could not fetch run output.";
 
   return (fetch(req)
     .catch(throwNetworkError(req, errorMsg))
     .then(jsonOrThrowHttpError(req, errorMsg))
-    .then(json => json.text)
   );
 }
 
 
+// The densities of the parameters of each colony, computed by the backend from
+// the posterior sample, as rows {colony_id, parameter, value, density, mean}.
 export async function fetchRunResults(runId) {
-  let req = new URL("posterior_sample/" + runId, BACKEND_BASE_URL);
-  const errorMsg = "Could not fetch posterior sample.";
+  let req = new URL("posterior_summary/" + runId, BACKEND_BASE_URL);
+  const errorMsg = "Could not fetch posterior summary.";
 
   return (fetch(req)
     .catch(throwNetworkError(req, errorMsg))
     .then(jsonOrThrowHttpError(req, errorMsg))
-    .then(json => json.data)
+    .then(densityRows)
   );
 }
 
 
+// Opens the stream of server-sent events of a run (see the backend
+// `/events/{run_id}` endpoint) and calls the handler matching each event.
+// The browser reconnects by itself and the backend resumes where the stream
+// stopped. Returns a function that closes the stream.
+export function subscribeRunEvents(runId, {onRun, onLogs, onOutput, onResults, onError}) {
+  const req = new URL("events/" + runId, BACKEND_BASE_URL);
+  const source = new EventSource(req);
+
+  source.addEventListener("state", e => {
+    const json = JSON.parse(e.data);
+    onRun(new Run(
+      runId,
+      new Code(
+        json.code.commit_hash,
+        json.code.branch,
+        json.code.description
+      ),
+      json.timestamp,
+      json.job_dir,
+      json.output_dir,
+      json.script,
+      runStateLabel(json.state)
+    ));
+  });
+  source.addEventListener("logs", e => onLogs(JSON.parse(e.data)));
+  source.addEventListener("output", e => onOutput(JSON.parse(e.data)));
+  source.addEventListener("results", e => onResults());
+  source.addEventListener("end", e => source.close());
+  source.onerror = e => {
+    if (source.readyState === EventSource.CLOSED) {
+      onError(new NetworkError(req, "Could not follow run events.", e));
+    }
+  };
+
+  return () => source.close();
+}
+
+
+const densityRows = summary => {
+  let rows = [];
+  for (const colony of summary.colonies) {
+    for (const [parameter, s] of Object.entries(colony.parameters)) {
+      for (let i = 0; i < s.x.length; i++) {
+        rows.push({
+          colony_id: colony.colony_id,
+          parameter: parameter,
+          value: s.x[i],
+          density: s.density[i],
+          mean: s.mean,
+        });
+      }
+    }
+  }
+  return rows;
+};
+
+
 class NetworkError extends Error {
   constructor(url, message, cause) {
     super(message + " Unable to reach '" + url.toString() + "' Cause: " + cause.toString())
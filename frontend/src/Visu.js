@@ -1,24 +1,11 @@
-export const visu = results => {
+// `densities` are rows {colony_id, parameter, value, density}, as computed by
+// the backend (see `fetchRunResults`).
+export const visu = densities => {
   return {
     $schema: "https://vega.github.io/schema/vega-lite/v5.json",
     data: {
-      values: results,
+      values: densities,
     },
-    transform: [
-      {
-        fold: [
-          "nest_quality_assessment_error",
-          "percentage_foragers",
-          "number_nests",
-          "exploring_phase",
-        ],
-        as: ["parameter", "value"]
-      },
-      {
-        density: "value",
-        groupby: ["colony_id", "parameter"],
-      }
-    ],
     facet: {
       row: {
         field: "colony_id",